@@ -7,8 +7,10 @@ __version__ = '0.7.0'
 # flake8: noqa
 
 from .dataset import Dataset
+from .ids import IdCodec
 from .evaluate import GenericEvaluator
 from .question_answering import QASystemForMCOffline
+from .predictions_writer import PredictionsWriter
 from .threshold import Threshold
 
 from .answer import (
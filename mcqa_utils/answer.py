@@ -1,11 +1,14 @@
-from typing import List, Tuple, Optional, Union
+import numpy as np
+
+from typing import List, Tuple, Optional, Sequence, Union
 from mcqa_utils.utils import argmax, label_to_id, id_to_label
+from mcqa_utils.confidence import derived_fields, apply_derived_field
 
 
 class Answer(object):
     def __init__(
         self,
-        example_id: str,
+        example_id: int,
         pred_label: str,
         label: str = None,
         probs: List[float] = None,
@@ -15,29 +18,59 @@ class Answer(object):
         no_answer: float = -1.0,
         no_answer_text: str = None,
         is_no_answer: bool = False,
+        no_answer_option: Optional[int] = None,
+        option_table=None,
+        option_row: Optional[int] = None,
     ):
         self.example_id = example_id
         self.pred_label = pred_label
         self.label = label
         self.probs = probs
         self.endings = endings
+        # endings can also be a row of a shared OptionTable
+        self.option_table = option_table
+        self.option_row = option_row
         self.logits = logits
         self.threshold = threshold
         self.no_answer = no_answer
         self.no_answer_text = no_answer_text
         self.probs_field = 'probs'
         self.is_no_answer = is_no_answer
+        # position of the option with `no_answer_text` (-1 if none), when
+        # resolved beforehand endings are not needed
+        self.no_answer_option = no_answer_option
         if not is_no_answer and self.pred_label is not None:
             self.is_no_answer = label_to_id(self.pred_label) == self.no_answer
 
+    @property
+    def endings(self) -> Optional[List[str]]:
+        if self._endings is None and self.option_table is not None:
+            return self.option_table.row(self.option_row)
+        return self._endings
+
+    @endings.setter
+    def endings(self, endings: Optional[List[str]]):
+        self._endings = endings
+
+    def get_scores(self) -> Union[List[float], float, None]:
+        # per option scores, or a single confidence for derived fields
+        # like the margin
+        return self.__getattribute__(self.probs_field)
+
+    def get_choice(self) -> int:
+        scores = self.get_scores()
+        if isinstance(scores, (float, int, np.number)):
+            scores = self.probs if self.probs is not None else self.logits
+        return argmax(scores)
+
     def get_answer(self, accept_no_answer=True) -> int:
         ans = label_to_id(self.pred_label)
         if self.is_no_answer:
             ans = self.no_answer
-        elif self.__getattribute__(self.probs_field) is not None:
+        elif self.get_scores() is not None:
             ans = self.no_answer
-            if max(self.__getattribute__(self.probs_field)) > self.threshold:
-                ans = argmax(self.__getattribute__(self.probs_field))
+            if self.get_max_prob() > self.threshold:
+                ans = self.get_choice()
 
         if ans == self.no_answer and not accept_no_answer:
             ans = self.search_unanswerable_option()
@@ -50,12 +83,22 @@ class Answer(object):
         return (self.example_id, self.pred_label)
 
     def get_max_prob(self) -> float:
-        return max(self.__getattribute__(self.probs_field))
+        scores = self.get_scores()
+        if isinstance(scores, (float, int, np.number)):
+            return scores
+        return max(scores)
 
     def get_min_prob(self) -> float:
-        return min(self.__getattribute__(self.probs_field))
+        scores = self.get_scores()
+        if isinstance(scores, (float, int, np.number)):
+            return scores
+        return min(scores)
 
     def search_unanswerable_option(self):
+        if self.no_answer_option is not None:
+            if self.no_answer_option < 0:
+                return self.no_answer
+            return self.no_answer_option
         unanswerable_option_index = self.no_answer
         if self.no_answer_text is not None and self.endings is not None:
             for idx, end in enumerate(self.endings):
@@ -68,9 +111,9 @@ class Answer(object):
     @staticmethod
     def clone(answer):
         probs = answer.probs.copy() if answer.probs is not None else None
-        ends = answer.endings.copy() if answer.endings is not None else None
+        ends = answer._endings.copy() if answer._endings is not None else None
         logits = answer.logits.copy() if answer.logits is not None else None
-        return Answer(
+        clone = Answer(
             example_id=answer.example_id,
             probs=probs,
             endings=ends,
@@ -81,7 +124,14 @@ class Answer(object):
             no_answer=answer.no_answer,
             no_answer_text=answer.no_answer_text,
             is_no_answer=answer.is_no_answer,
+            no_answer_option=answer.no_answer_option,
+            option_table=answer.option_table,
+            option_row=answer.option_row,
         )
+        if answer.probs_field in derived_fields:
+            setattr(clone, answer.probs_field, answer.get_scores())
+        clone.probs_field = answer.probs_field
+        return clone
 
 
 def parse_answer(answer_id, answer_value):
@@ -90,7 +140,7 @@ def parse_answer(answer_id, answer_value):
         answer_dict.update(
             probs=answer_value['probs'],
             pred_label=answer_value['pred_label'],
-            label=answer_value['label']
+            label=answer_value.get('label', None)
         )
         if 'logits' in answer_value:
             answer_dict.update(logits=answer_value['logits'])
@@ -108,9 +158,16 @@ def unparse_answer(answer: Answer) -> Union[dict, int, str]:
     return output
 
 
-def apply_threshold_to_answers(answers: List[Answer], threshold: float):
-    for ans in answers:
-        ans.threshold = threshold
+def apply_threshold_to_answers(
+    answers: List[Answer], threshold: Union[float, Sequence[float]]
+):
+    # one threshold for all the answers or one per answer (i.e.: groups)
+    if np.ndim(threshold) == 0:
+        for ans in answers:
+            ans.threshold = threshold
+    else:
+        for ans, ans_threshold in zip(answers, np.asarray(threshold).tolist()):
+            ans.threshold = ans_threshold
     return answers
 
 
@@ -120,6 +177,14 @@ def apply_no_answer(answers: List[Answer], no_answer_label_ids: List[str]):
             ans.is_no_answer = True
 
 
-def apply_prob_field_to_answers(answers: List[Answer], field: str):
+def apply_prob_field_to_answers(
+    answers: List[Answer], field: str, temperature: Optional[float] = None
+):
+    # derived fields are computed at once for all the answers missing them
+    if field in derived_fields and (
+        temperature is not None or
+        any(not hasattr(ans, field) for ans in answers)
+    ):
+        apply_derived_field(answers, field, temperature)
     for ans in answers:
         ans.probs_field = field
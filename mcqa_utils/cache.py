@@ -0,0 +1,209 @@
+import os
+import time
+import sqlite3
+import hashlib
+
+from glob import glob
+from pathlib import Path
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from mcqa_utils import json_codec
+
+default_cache_dir = os.environ.get(
+    'MCQA_UTILS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'mcqa_utils'),
+)
+default_cache_max_bytes = 256 * 1024 * 1024
+counter_keys = ('hits', 'misses', 'evictions')
+
+
+def hash_file(path: str, digest=None, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=20) if digest is None else digest
+    with open(path, 'rb') as fstream:
+        for chunk in iter(lambda: fstream.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_paths(paths: List[str]) -> str:
+    # content hash of files and (recursively) directories, in sorted order
+    digest = hashlib.blake2b(digest_size=20)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                str(sub) for sub in Path(path).rglob('*') if sub.is_file()
+            )
+        elif os.path.isfile(path):
+            files.append(path)
+    for file in sorted(files):
+        digest.update(os.path.basename(file).encode('utf-8'))
+        digest.update(hash_file(file).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def package_hash() -> str:
+    # results depend on the code, not only on the released version
+    return hash_paths(glob(os.path.join(os.path.dirname(__file__), '*.py')))
+
+
+def dataset_split_paths(data_path: str, split: str) -> List[str]:
+    # files or directories named after the split (dev.json, dev/...),
+    # otherwise the whole dataset
+    paths = sorted(glob(os.path.join(data_path, f'{split}*')))
+    return paths if len(paths) > 0 else [data_path]
+
+
+def make_key(inputs: Dict[str, str], flags: Dict) -> str:
+    # flags must already be normalized (sorted lists, no output options)
+    document = json_codec.dumps(
+        {'inputs': inputs, 'flags': flags}, compact=True
+    )
+    return hashlib.blake2b(
+        document.encode('utf-8'), digest_size=20
+    ).hexdigest()
+
+
+class ResultsCache(object):
+    """
+    On disk cache of results documents, keyed by content. Entries are
+    evicted in least recently used order (by file mtime, refreshed on
+    every hit) once the cache grows over `max_bytes`. Every run adds its
+    counters to the totals in stats.db, a single row per counter updated
+    in a transaction, so concurrent runs (i.e.: --watch workers) never
+    overwrite each other's updates and the file does not grow.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = default_cache_dir,
+        max_bytes: int = default_cache_max_bytes,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.stats_path = self.cache_dir / 'stats.db'
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.json'
+
+    def _entries(self) -> List[Tuple[float, int, Path]]:
+        # (mtime, size, path), skipping entries evicted meanwhile
+        entries = []
+        for path in self.cache_dir.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _stats_bytes(self) -> int:
+        try:
+            return self.stats_path.stat().st_size
+        except OSError:
+            return 0
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._entry_path(key)
+        try:
+            results = json_codec.load(str(path))
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        now = time.time()
+        os.utime(path, (now, now))
+        self.hits += 1
+        return results
+
+    def put(self, key: str, results: Dict):
+        path = self._entry_path(key)
+        # write then rename, concurrent readers never see partial entries
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as fout:
+            fout.write(json_codec.dumps(results, compact=True))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total_bytes = self._stats_bytes() + sum(
+            size for _, size, _ in entries
+        )
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total_bytes -= size
+            self.evictions += 1
+
+    def _connect_stats(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            str(self.stats_path), timeout=60.0, isolation_level=None
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS counters '
+            '(key TEXT PRIMARY KEY, value INTEGER NOT NULL)'
+        )
+        return conn
+
+    def _summary(self, totals: Dict[str, int]) -> Dict[str, int]:
+        stats = dict(
+            hits=self.hits, misses=self.misses, evictions=self.evictions
+        )
+        for key in counter_keys:
+            stats[key] += int(totals.get(key, 0))
+        entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['bytes'] = self._stats_bytes() + sum(
+            size for _, size, _ in entries
+        )
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def stats(self) -> Dict[str, int]:
+        # counters are accumulated across runs and processes
+        totals = {}
+        if self.stats_path.exists():
+            conn = self._connect_stats()
+            try:
+                totals = dict(conn.execute('SELECT key, value FROM counters'))
+            finally:
+                conn.close()
+        return self._summary(totals)
+
+    def save_stats(self) -> Dict[str, int]:
+        counters = dict(
+            hits=self.hits, misses=self.misses, evictions=self.evictions
+        )
+        conn = self._connect_stats()
+        try:
+            # BEGIN IMMEDIATE takes the write lock up front, concurrent
+            # runs add their counters one after the other
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for key, value in counters.items():
+                    conn.execute(
+                        'INSERT OR IGNORE INTO counters VALUES (?, 0)', (key,)
+                    )
+                    conn.execute(
+                        'UPDATE counters SET value = value + ? WHERE key = ?',
+                        (value, key)
+                    )
+                totals = dict(conn.execute('SELECT key, value FROM counters'))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        self.hits = self.misses = self.evictions = 0
+        return self._summary(totals)
@@ -0,0 +1,140 @@
+import numpy as np
+
+from typing import List, Optional
+
+
+def stack_field(
+    answers: List, field: str, fill_value: float = np.nan
+) -> np.ndarray:
+    # (answers x options) matrix, padded when option counts differ
+    rows = [ans.__getattribute__(field) for ans in answers]
+    widths = [len(row) for row in rows]
+    if len(set(widths)) == 1:
+        return np.asarray(rows, dtype=np.float64)
+    matrix = np.full((len(rows), max(widths)), fill_value, dtype=np.float64)
+    for index, row in enumerate(rows):
+        matrix[index, :len(row)] = row
+    return matrix
+
+
+def softmax(logits: np.ndarray, temperature: float = 1.0) -> np.ndarray:
+    # padded options must come as -inf
+    scaled = logits / temperature
+    scaled = scaled - scaled.max(axis=1, keepdims=True)
+    exp = np.exp(scaled)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def margin(probs: np.ndarray) -> np.ndarray:
+    # difference between the two best options, padded options must be 0
+    if probs.shape[1] < 2:
+        return probs[:, 0].copy()
+    top_two = -np.partition(-probs, 1, axis=1)[:, :2]
+    return top_two[:, 0] - top_two[:, 1]
+
+
+def neg_entropy(probs: np.ndarray) -> np.ndarray:
+    # negated so that, as with probs, higher means more confident
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(probs > 0, probs * np.log(probs), 0.0)
+    return terms.sum(axis=1)
+
+
+# derived fields and whether they hold one value per option
+derived_fields = {
+    'softmax': True,
+    'margin': False,
+    'neg_entropy': False,
+}
+
+
+def _logits_matrix(answers: List) -> np.ndarray:
+    if all(ans.logits is not None for ans in answers):
+        return stack_field(answers, 'logits', fill_value=-np.inf)
+    # answers without logits (i.e.: filled ones) use log(probs), which
+    # softmax maps back to the same probs
+    probs = _probs_matrix(answers)
+    with np.errstate(divide='ignore'):
+        log_probs = np.log(probs)
+    if any(ans.logits is not None for ans in answers):
+        has_logits = [
+            i for i, ans in enumerate(answers) if ans.logits is not None
+        ]
+        logits = stack_field(
+            [answers[i] for i in has_logits], 'logits', fill_value=-np.inf
+        )
+        log_probs[has_logits, :logits.shape[1]] = logits
+    return log_probs
+
+
+def _probs_matrix(answers: List) -> np.ndarray:
+    if any(ans.probs is None for ans in answers):
+        raise ValueError(
+            'Derived confidence fields need `probs` on every answer, '
+            'use nbest predictions!'
+        )
+    return stack_field(answers, 'probs', fill_value=0.0)
+
+
+def compute_derived_field(
+    answers: List, field: str, temperature: Optional[float] = None
+) -> np.ndarray:
+    if field not in derived_fields:
+        raise ValueError('Unknown derived field! %r' % field)
+    if field == 'softmax':
+        temperature = 1.0 if temperature is None else temperature
+        return softmax(_logits_matrix(answers), temperature)
+    if temperature is not None:
+        probs = softmax(_logits_matrix(answers), temperature)
+    else:
+        probs = _probs_matrix(answers)
+    if field == 'margin':
+        return margin(probs)
+    return neg_entropy(probs)
+
+
+def apply_derived_field(
+    answers: List, field: str, temperature: Optional[float] = None
+):
+    # one vectorized pass, then each answer gets its row (or scalar)
+    values = compute_derived_field(answers, field, temperature)
+    per_option = derived_fields[field]
+    for ans, value in zip(answers, values):
+        if per_option:
+            scores = ans.probs if ans.probs is not None else ans.logits
+            nof_options = len(scores)
+            value = value[:nof_options].tolist()
+        else:
+            value = float(value)
+        setattr(ans, field, value)
+    return answers
+
+
+def _base_probs(answers: List) -> np.ndarray:
+    if all(ans.probs is not None for ans in answers):
+        return _probs_matrix(answers)
+    return softmax(_logits_matrix(answers))
+
+
+def probability_matrix(answers: List) -> np.ndarray:
+    # per option probabilities behind the answers' confidence field: the
+    # field itself when it holds one value per option (logits normalized),
+    # the base probs for single value fields (margin, neg_entropy)
+    field = answers[0].probs_field
+    if field == 'logits':
+        return softmax(_logits_matrix(answers))
+    if derived_fields.get(field, False):
+        return stack_field(answers, field, fill_value=0.0)
+    return _base_probs(answers)
+
+
+def scores_matrix(answers: List) -> np.ndarray:
+    # per option scores answers rank options by, padded options last
+    field = answers[0].probs_field
+    if field == 'logits':
+        return _logits_matrix(answers)
+    if derived_fields.get(field, False):
+        return stack_field(answers, field, fill_value=-np.inf)
+    if all(ans.probs is not None for ans in answers):
+        return stack_field(answers, 'probs', fill_value=-np.inf)
+    return _logits_matrix(answers)
@@ -1,14 +1,176 @@
-import random
+import bz2
+import gzip
+import lzma
+import numpy as np
 
 from glob import glob
-from typing import List, Union, Callable
-from collections import defaultdict
+from pathlib import Path
+from collections import OrderedDict
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
+from mcqa_utils import json_codec
 from mcqa_utils.answer import Answer
+from mcqa_utils.ids import IdCodec
+from mcqa_utils.options import OptionTable
 from mcqa_utils.utils import label_to_id, id_to_label
 from mc_transformers.utils_mc import processors, DataProcessor, InputExample
 
 
+compressors = {
+    None: (open, ''),
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.open, '.bz2'),
+    'xz': (lzma.open, '.xz'),
+}
+
+
+class _ShardedJsonWriter(object):
+    # writes dataset documents ({'version': 1.0, 'data': [...]}) one
+    # context at a time, spreading them over several files if requested
+
+    def __init__(
+        self,
+        path: str,
+        nof_shards: Optional[int] = None,
+        max_shard_bytes: Optional[int] = None,
+        compression: Optional[str] = None,
+    ):
+        if compression not in compressors:
+            raise ValueError('Unknown compression! %r' % compression)
+        if nof_shards is not None and max_shard_bytes is not None:
+            raise ValueError(
+                'Shard either by number of files or by size, not both'
+            )
+        self.path = Path(path)
+        self.nof_shards = nof_shards
+        self.max_shard_bytes = max_shard_bytes
+        self.open_fn, self.suffix = compressors[compression]
+        self.sharded = nof_shards is not None or max_shard_bytes is not None
+        self.paths = []
+        self._streams = []
+        self._sizes = []
+        self._counts = []
+        self._nof_written = 0
+
+    def _shard_path(self, index: int) -> Path:
+        if not self.sharded:
+            return Path(str(self.path) + self.suffix)
+        name = f'{self.path.stem}.{index:05d}{self.path.suffix}{self.suffix}'
+        return self.path.with_name(name)
+
+    def _open_shard(self):
+        shard_path = self._shard_path(len(self._streams))
+        shard_path.parent.mkdir(parents=True, exist_ok=True)
+        fstream = self.open_fn(shard_path, 'wt', encoding='utf-8')
+        header = '{"version": 1.0, "data": ['
+        fstream.write(header)
+        self.paths.append(str(shard_path))
+        self._streams.append(fstream)
+        self._sizes.append(len(header))
+        self._counts.append(0)
+
+    def _current_shard(self) -> int:
+        if self.nof_shards is not None:
+            # round robin keeps shards balanced without knowing the total
+            index = self._nof_written % self.nof_shards
+            if index >= len(self._streams):
+                self._open_shard()
+            return index
+        if len(self._streams) == 0 or (
+            self.max_shard_bytes is not None and
+            self._counts[-1] > 0 and
+            self._sizes[-1] >= self.max_shard_bytes
+        ):
+            if len(self._streams) > 0:
+                self._close_shard(len(self._streams) - 1)
+            self._open_shard()
+        return len(self._streams) - 1
+
+    def write(self, json_context: dict):
+        index = self._current_shard()
+        sep = ', ' if self._counts[index] else ''
+        data = sep + json_codec.dumps(json_context, compact=True)
+        self._streams[index].write(data)
+        self._sizes[index] += len(data.encode('utf-8'))
+        self._counts[index] += 1
+        self._nof_written += 1
+
+    def _close_shard(self, index: int):
+        fstream = self._streams[index]
+        if fstream is not None and not fstream.closed:
+            fstream.write(']}\n')
+            fstream.close()
+
+    def close(self) -> List[str]:
+        if len(self._streams) == 0:
+            self._open_shard()
+        for index in range(len(self._streams)):
+            self._close_shard(index)
+        return self.paths
+
+
+class SplitIndex(object):
+    """
+    Lookups built once over parsed examples: packed id to row, gold labels
+    (-1 when unlabeled), the rows of their endings in the dataset's option
+    table and the position of the no answer option for each text asked for.
+    """
+
+    def __init__(
+        self,
+        examples: List[InputExample],
+        example_ids: np.ndarray,
+        options: OptionTable,
+        option_rows: np.ndarray,
+    ):
+        self.examples = examples
+        self.example_ids = example_ids
+        self.options = options
+        self.option_rows = option_rows
+        self.rows = {
+            example_id: row
+            for row, example_id in enumerate(example_ids.tolist())
+        }
+        labels = (label_to_id(ex.label) for ex in examples)
+        self.labels = np.fromiter(
+            (-1 if label is None else label for label in labels),
+            dtype=np.int64, count=len(examples)
+        )
+        self._no_answer_positions = {}
+
+    def __len__(self):
+        return len(self.examples)
+
+    def get_rows(self, example_ids: Sequence[int]) -> np.ndarray:
+        return np.fromiter(
+            (self.rows[example_id] for example_id in example_ids),
+            dtype=np.int64, count=len(example_ids)
+        )
+
+    def no_answer_positions(self, text: str) -> np.ndarray:
+        key = text.lower()
+        if key not in self._no_answer_positions:
+            self._no_answer_positions[key] = self.options.text_positions(
+                self.option_rows, key
+            )
+        return self._no_answer_positions[key]
+
+    def gold_text_mask(self, text: str) -> np.ndarray:
+        # whether the gold option contains `text`, as answer_mask_fn
+        return self.options.gold_contains(
+            self.option_rows, self.labels, text
+        )
+
+
 # wrapper class around transfomers' DataProcessor
 class Dataset(object):
 
@@ -17,10 +179,13 @@ class Dataset(object):
         data_path: str,
         task: str,
         processor: DataProcessor = None,
-        name: str = None
+        name: str = None,
+        id_codec: IdCodec = None,
+        max_cached_splits: int = 4,
     ):
         self.data_path = data_path
         self.task = task
+        self.id_codec = IdCodec() if id_codec is None else id_codec
         if processor is None:
             self.processor_cls = processors[task]
         else:
@@ -33,6 +198,13 @@ class Dataset(object):
             'dev': self.get_dev_examples,
             'test': self.get_test_examples,
         }
+        # parsed splits and their indexes, least recently used go first
+        self.max_cached_splits = max_cached_splits
+        self._cached_splits = OrderedDict()
+        self._cached_indexes = OrderedDict()
+        # option texts of every indexed split, stored once
+        self.options = OptionTable()
+        self._option_rows = {}
 
     def _make_contiguous_ids(self, global_id, examples):
         correct_examples = []
@@ -79,33 +251,101 @@ class Dataset(object):
             all_examples.extend(examples)
         return all_examples
 
+    def _cache(self, cache: OrderedDict, key, load_fn: Callable):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = load_fn()
+        if self.max_cached_splits > 0:
+            cache[key] = value
+            while len(cache) > self.max_cached_splits:
+                cache.popitem(last=False)
+        return value
+
+    def invalidate(self, split: Optional[str] = None):
+        # forget parsed splits (all of them by default), i.e.: when the
+        # files changed on disk
+        if split is None:
+            self._cached_splits.clear()
+            self._cached_indexes.clear()
+            self._option_rows.clear()
+            self.options = OptionTable()
+            return
+        self._cached_splits.pop(split, None)
+        for key in [key for key in self._cached_indexes if split in key]:
+            del self._cached_indexes[key]
+        if self._option_rows.pop(split, None) is not None:
+            self._rebuild_options()
+
+    def _rebuild_options(self):
+        # rows are only appended to the option table, the rows of the
+        # other splits are copied to a new one (the cached indexes point
+        # to it) so re-read splits do not pile up
+        options = OptionTable()
+        option_rows = {
+            split: options.add_rows([self.options.row(row) for row in rows])
+            for split, rows in self._option_rows.items()
+        }
+        for key, index in self._cached_indexes.items():
+            index.options = options
+            index.option_rows = np.concatenate(
+                [option_rows[split] for split in key]
+            )
+        self.options = options
+        self._option_rows = option_rows
+
+    def _split_names(self, splits: Union[List[str], str, None]) -> List[str]:
+        if splits is None:
+            return self.splits[1:]
+        if not isinstance(splits, list):
+            return [splits]
+        return splits
+
     def get_split(self, split: str) -> List[InputExample]:
         if split not in self.splits:
             raise ValueError('Unknown split! %r' % split)
-        return self.split_to_get_map[split]()
+        examples = self._cache(
+            self._cached_splits, split, self.split_to_get_map[split]
+        )
+        # callers may modify the list, not the cached one
+        return list(examples)
 
     def get_splits(self, splits: List[str]) -> List[InputExample]:
         data = []
-        if splits is None:
-            splits = self.splits[1:]
-
-        if not isinstance(splits, list):
-            splits = [splits]
-
-        for split in splits:
+        for split in self._split_names(splits):
             data.extend(self.get_split(split))
         return data
 
+    def get_index(self, splits: Union[List[str], str] = None) -> SplitIndex:
+        def build_index():
+            examples = []
+            option_rows = []
+            for split in key:
+                split_examples = self.get_split(split)
+                if split not in self._option_rows:
+                    self._option_rows[split] = self.options.add_rows(
+                        [ex.endings for ex in split_examples]
+                    )
+                examples.extend(split_examples)
+                option_rows.append(self._option_rows[split])
+            example_ids = np.fromiter(
+                (self.get_example_id(ex) for ex in examples),
+                dtype=np.int64, count=len(examples)
+            )
+            return SplitIndex(
+                examples, example_ids, self.options,
+                np.concatenate(option_rows),
+            )
+
+        key = tuple(self._split_names(splits))
+        return self._cache(self._cached_indexes, key, build_index)
+
     def get_available_labels(self) -> List[str]:
         return self.processor.get_labels()
 
     def get_labels(self, splits: Union[List[str], str] = None) -> List[int]:
-        if isinstance(splits, str):
-            splits = [splits]
-        id_ans = {}
-        for test in self.get_splits(splits):
-            id_ans[test.example_id] = [label_to_id(a) for a in test]
-        return id_ans
+        index = self.get_index(splits)
+        return dict(zip(index.example_ids.tolist(), index.labels.tolist()))
 
     def encode_id(self, id: str):
         return self.processor._encode_id(id)
@@ -113,22 +353,34 @@ class Dataset(object):
     def decode_id(self, id: str) -> str:
         return self.processor._decode_id(id)
 
+    def get_example_id(self, example: Union[InputExample, Answer]) -> int:
+        # packed (context, question) id, shared with the qa system
+        if isinstance(example, Answer):
+            return example.example_id
+        return self.id_codec.encode(*self.decode_id(example.example_id))
+
     def get_gold_answers(
         self,
         splits: Union[List[str], str],
         with_text_values: bool = False
     ) -> List[Answer]:
         answers = []
-        data = self.get_splits(splits)
-        for example in data:
-            example_id = '-'.join(self.decode_id(example.example_id))
+        index = self.get_index(splits)
+        for example, example_id, option_row in zip(
+            index.examples,
+            index.example_ids.tolist(),
+            index.option_rows.tolist(),
+        ):
             answer_dict = dict(
                 example_id=example_id,
                 label=example.label,
                 pred_label=example.label
             )
             if with_text_values:
-                answer_dict.update(endings=example.endings)
+                # endings are referenced in the option table, not copied
+                answer_dict.update(
+                    option_table=index.options, option_row=option_row
+                )
 
             answers.append(Answer(**answer_dict))
 
@@ -143,46 +395,272 @@ class Dataset(object):
                 mask.append(0)
         return mask
 
+    def find_text_mask(
+        self,
+        examples: List[Union[InputExample, Answer]],
+        text: str,
+        match: bool = True,
+        splits: Union[List[str], str] = None,
+    ) -> List[bool]:
+        # find_mask with get_mask_matching_text(text, match), looked up in
+        # the index of the splits holding the examples
+        index = self.get_index(splits)
+        rows = index.get_rows([self.get_example_id(ex) for ex in examples])
+        return (index.gold_text_mask(text)[rows] == match).tolist()
+
+    def _context_to_json(self, grouped: List[InputExample]) -> dict:
+        context_id, _ = self.decode_id(grouped[0].example_id)
+        try:
+            context_id = int(context_id)
+        except Exception:
+            pass
+        return {
+            'id': context_id,
+            'article': grouped[0].contexts[0],
+            'answers': [id_to_label(ex.label) for ex in grouped],
+            'options': [ex.endings for ex in grouped],
+            'questions': [ex.question for ex in grouped],
+        }
+
+    def _grouped_order(self, examples: List[InputExample]) -> Iterable[int]:
+        # examples are normally grouped by context, otherwise fall back to
+        # buffering positions (not examples) by order of first appearance
+        context_ranks = {}
+        ranks = []
+        grouped = True
+        for example in examples:
+            context = self.id_codec.context_index(
+                self.get_example_id(example)
+            )
+            if context not in context_ranks:
+                context_ranks[context] = len(context_ranks)
+            elif context_ranks[context] != len(context_ranks) - 1:
+                grouped = False
+            ranks.append(context_ranks[context])
+        if grouped:
+            return range(len(examples))
+        return sorted(range(len(examples)), key=ranks.__getitem__)
+
+    def iter_json_contexts(
+        self, examples: Iterable[InputExample]
+    ) -> Iterator[dict]:
+        # yields each context as soon as its last question is seen, lists
+        # are reordered when not grouped, iterators must come grouped
+        if isinstance(examples, list):
+            order = self._grouped_order(examples)
+            examples = map(examples.__getitem__, order)
+        done_contexts = set()
+        current, grouped = None, []
+        for example in examples:
+            context = self.id_codec.context_index(
+                self.get_example_id(example)
+            )
+            if context != current:
+                if len(grouped) > 0:
+                    yield self._context_to_json(grouped)
+                if context in done_contexts:
+                    context_id, _ = self.decode_id(example.example_id)
+                    raise ValueError(
+                        'Examples must be grouped by context to be streamed,'
+                        f' context {context_id} found twice'
+                    )
+                done_contexts.add(context)
+                current, grouped = context, []
+            grouped.append(example)
+        if len(grouped) > 0:
+            yield self._context_to_json(grouped)
+
     def to_json(self, examples):
         json_examples = {'version': 1.0, 'data': []}
-        raw_examples = defaultdict(list)
-        for sample in examples:
-            context_id, _ = self.processor._decode_id(sample.example_id)
-            try:
-                context_id = int(context_id)
-            except Exception:
-                pass
-            raw_examples[context_id].append(sample)
-        for id, grouped in raw_examples.items():
-            json_ex = {
-                'id': id,
-                'article': grouped[0].contexts[0],
-                'answers': [id_to_label(ex.label) for ex in grouped],
-                'options': [ex.endings for ex in grouped],
-                'questions': [ex.question for ex in grouped],
-            }
-            json_examples['data'].append(json_ex)
+        json_examples['data'].extend(self.iter_json_contexts(examples))
         return json_examples
 
-    def split_examples(self, examples, proportions, seed=None):
-        if seed is not None:
-            random.seed(seed)
-        randomized = random.sample(examples, len(examples))
+    def write_json(
+        self,
+        examples: Iterable[InputExample],
+        path: str,
+        nof_shards: Optional[int] = None,
+        max_shard_bytes: Optional[int] = None,
+        compression: Optional[str] = None,
+    ) -> List[str]:
+        writer = _ShardedJsonWriter(
+            path,
+            nof_shards=nof_shards,
+            max_shard_bytes=max_shard_bytes,
+            compression=compression,
+        )
+        try:
+            for json_context in self.iter_json_contexts(examples):
+                writer.write(json_context)
+        finally:
+            paths = writer.close()
+        return paths
+
+    def _strata_keys(
+        self,
+        examples: List[InputExample],
+        stratify: Union[str, Callable, Sequence, None],
+    ) -> Optional[np.ndarray]:
+        # stratify by 'label', by a per-example callable (e.g.
+        # get_mask_matching_text(no_answer_text, match=True)) or by
+        # precomputed keys
+        if stratify is None:
+            return None
+        if isinstance(stratify, str):
+            if stratify != 'label':
+                raise ValueError('Unknown stratification! %r' % stratify)
+            return np.fromiter(
+                (label_to_id(ex.label) for ex in examples),
+                dtype=np.int64, count=len(examples)
+            )
+        if isinstance(stratify, Callable):
+            return np.asarray([stratify(ex) for ex in examples])
+        keys = np.asarray(stratify)
+        if len(keys) != len(examples):
+            raise ValueError(
+                'Stratification keys and examples differ in size '
+                f'({len(keys)} != {len(examples)})'
+            )
+        return keys
+
+    def _split_units(
+        self,
+        examples: List[InputExample],
+        stratify: Union[str, Callable, Sequence, None] = None,
+        group_by_context: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # splitting works on units: single examples or whole contexts, so
+        # questions from one article never straddle splits. Returns the
+        # unit of each example, the size of each unit and its stratum.
+        nof_examples = len(examples)
+        if group_by_context:
+            contexts = np.fromiter(
+                (
+                    self.id_codec.context_index(self.get_example_id(ex))
+                    for ex in examples
+                ),
+                dtype=np.int64, count=nof_examples
+            )
+            _, units = np.unique(contexts, return_inverse=True)
+            units = units.reshape(-1)
+        else:
+            units = np.arange(nof_examples)
+        nof_units = int(units.max()) + 1 if nof_examples > 0 else 0
+        weights = np.bincount(units, minlength=nof_units)
+        keys = self._strata_keys(examples, stratify)
+        if keys is None:
+            strata = np.zeros(nof_units, dtype=np.int64)
+        else:
+            _, key_ids = np.unique(keys, return_inverse=True)
+            key_ids = key_ids.reshape(-1)
+            # a context takes the most common key among its questions
+            counts = np.zeros((nof_units, int(key_ids.max()) + 1))
+            np.add.at(counts, (units, key_ids), 1)
+            strata = counts.argmax(axis=1)
+        return units, weights, strata
+
+    def split_indices(
+        self,
+        examples: List[InputExample],
+        proportions: List[float],
+        seed: Optional[int] = None,
+        stratify: Union[str, Callable, Sequence, None] = None,
+        group_by_context: bool = False,
+    ) -> List[np.ndarray]:
         if round(sum(proportions)) != 1:
             raise ValueError(
                 'Proportions must sum to 1 for splitting! '
                 f'Got ({proportions} = {sum(proportions)}) instead.'
             )
-        splits = []
-        start_idx, end_idx = 0, 0
-        total_size = len(randomized)
-        for prop in proportions:
-            split_size = round(total_size * prop)
-            end_idx = min(end_idx + split_size, total_size)
-            splits.append(randomized[start_idx:end_idx])
-            start_idx = end_idx
+        rng = np.random.default_rng(seed)
+        units, weights, strata = self._split_units(
+            examples, stratify, group_by_context
+        )
+        cum_proportions = np.cumsum(proportions)[:-1]
+        unit_split = np.zeros(len(weights), dtype=np.int64)
+        for stratum in np.unique(strata):
+            stratum_units = rng.permutation(np.flatnonzero(strata == stratum))
+            stratum_weights = weights[stratum_units]
+            bounds = np.round(stratum_weights.sum() * cum_proportions)
+            # a unit goes to the split where its first example falls
+            starts = np.cumsum(stratum_weights) - stratum_weights
+            unit_split[stratum_units] = np.searchsorted(
+                bounds, starts, side='right'
+            )
+        example_split = unit_split[units]
+        return [
+            np.flatnonzero(example_split == index)
+            for index in range(len(proportions))
+        ]
 
-        return splits
+    def split_examples(
+        self,
+        examples,
+        proportions,
+        seed=None,
+        stratify=None,
+        group_by_context=False,
+    ):
+        splits = self.split_indices(
+            examples,
+            proportions,
+            seed=seed,
+            stratify=stratify,
+            group_by_context=group_by_context,
+        )
+        return [[examples[index] for index in split] for split in splits]
+
+    def iter_folds(
+        self,
+        examples: List[InputExample],
+        nof_folds: int,
+        seed: Optional[int] = None,
+        stratify: Union[str, Callable, Sequence, None] = None,
+        group_by_context: bool = False,
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        # lazily yields (train_indices, test_indices) for each fold
+        if nof_folds < 2:
+            raise ValueError('At least two folds are needed! %r' % nof_folds)
+        rng = np.random.default_rng(seed)
+        units, weights, strata = self._split_units(
+            examples, stratify, group_by_context
+        )
+        if nof_folds > len(weights):
+            # some folds would be left without examples to test on
+            unit_name = 'contexts' if group_by_context else 'examples'
+            raise ValueError(
+                f'{nof_folds} folds need at least as many {unit_name}, '
+                f'there are {len(weights)}'
+            )
+        unit_fold = np.zeros(len(weights), dtype=np.int64)
+        fold_sizes = np.zeros(nof_folds, dtype=np.int64)
+        for stratum in np.unique(strata):
+            stratum_units = rng.permutation(np.flatnonzero(strata == stratum))
+            if not group_by_context:
+                # round robin, starting on the currently smallest fold
+                order = np.argsort(fold_sizes, kind='stable')
+                folds = order[np.arange(len(stratum_units)) % nof_folds]
+                unit_fold[stratum_units] = folds
+                fold_sizes += np.bincount(folds, minlength=nof_folds)
+                continue
+            # contexts differ in size, place the biggest first on the
+            # lightest fold for this stratum (ties broken globally)
+            stratum_units = stratum_units[
+                np.argsort(-weights[stratum_units], kind='stable')
+            ]
+            stratum_sizes = np.zeros(nof_folds, dtype=np.int64)
+            for unit in stratum_units:
+                fold = np.lexsort((fold_sizes, stratum_sizes))[0]
+                unit_fold[unit] = fold
+                stratum_sizes[fold] += weights[unit]
+                fold_sizes[fold] += weights[unit]
+
+        example_fold = unit_fold[units]
+        for fold in range(nof_folds):
+            yield (
+                np.flatnonzero(example_fold != fold),
+                np.flatnonzero(example_fold == fold),
+            )
 
     def iter_examples(self, examples):
         for ex in examples:
@@ -215,16 +693,20 @@ class Dataset(object):
         answers: List[Answer],
         text: str,
     ):
-        data = self.get_splits(split)
-        if len(data) != len(answers):
+        index = self.get_index(split)
+        if len(index) != len(answers):
             raise ValueError(
                 'Asked to set no answer on a list with different size '
                 'from dataset, maybe you asked for the wrong split?'
-                f'(dataset size {len(data)}, nof answers: {len(answers)})'
+                f'(dataset size {len(index)}, nof answers: {len(answers)})'
             )
-        for datapoint, answer in zip(data, answers):
-            assert(str(datapoint.example_id) == str(answer.example_id))
-            ans_index = label_to_id(datapoint.label)
+        for datapoint, example_id, ans_index, answer in zip(
+            index.examples,
+            index.example_ids.tolist(),
+            index.labels.tolist(),
+            answers,
+        ):
+            assert(example_id == answer.example_id)
             answer_text = datapoint.endings[ans_index]
             found = answer_text.find(text) != -1
             if found and answer.get_answer() == ans_index:
@@ -0,0 +1,213 @@
+"""Ensembles of several models' nbest predictions."""
+import numpy as np
+
+from typing import Callable, Dict, List, Optional
+
+from mcqa_utils.ids import IdCodec
+from mcqa_utils.answer import Answer
+from mcqa_utils.utils import id_to_label
+from mcqa_utils.confidence import stack_field, softmax, _logits_matrix
+from mcqa_utils.question_answering import (
+    QASystemForMCOffline,
+    no_answer_positions,
+)
+
+ensemble_methods = ('mean_probs', 'mean_logits', 'vote')
+# ensembled answers only carry probs, no logits to scale or report
+ensemble_fields = ('probs', 'margin', 'neg_entropy')
+
+
+class StackedPredictions(object):
+    """
+    Predictions of several models aligned to the gold answers. `probs` and
+    `logits` are (models x questions x options) arrays, padded with 0 and
+    -inf when questions have different numbers of options.
+    """
+
+    def __init__(
+        self,
+        paths: List[str],
+        probs: np.ndarray,
+        logits: Optional[np.ndarray],
+        widths: List[int],
+    ):
+        self.paths = paths
+        self.probs = probs
+        self.logits = logits
+        self.widths = widths
+        self._votes = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def load(
+        cls,
+        paths: List[str],
+        gold_answers: List[Answer],
+        id_codec: IdCodec = None,
+        missing_strategy: Optional[str] = None,
+        missing_seed: Optional[int] = None,
+    ) -> 'StackedPredictions':
+        probs = []
+        logits = []
+        widths = None
+        for path in paths:
+            qa_system = QASystemForMCOffline(path, id_codec=id_codec)
+            qa_system.missing_strategy = missing_strategy
+            qa_system.missing_seed = missing_seed
+            answers, missing = qa_system.get_answers(gold_answers)
+            if len(missing) > 0:
+                raise ValueError(
+                    f'{path} has no answer for {len(missing)} questions, '
+                    'pass --fill_missing to ensemble it'
+                )
+            if any(ans.probs is None for ans in answers):
+                raise ValueError(
+                    f'Ensembles need nbest predictions, {path} has no probs'
+                )
+            probs.append(stack_field(answers, 'probs', fill_value=0.0))
+            if any(ans.logits is not None for ans in answers):
+                logits.append(_logits_matrix(answers))
+            if widths is None:
+                widths = [len(ans.probs) for ans in answers]
+        # logits ensembles need them from every model
+        logits = np.stack(logits) if len(logits) == len(paths) else None
+        return cls(paths, np.stack(probs), logits, widths)
+
+    def member_scores(self, method: str) -> np.ndarray:
+        # per model terms the ensemble sums
+        if method == 'mean_probs':
+            return self.probs
+        if method == 'mean_logits':
+            if self.logits is None:
+                raise ValueError(
+                    'Mean logits ensembles need logits in every nbest file!'
+                )
+            return self.logits
+        if method == 'vote':
+            if self._votes is None:
+                nof_options = self.probs.shape[-1]
+                self._votes = np.eye(nof_options)[self.probs.argmax(axis=-1)]
+            return self._votes
+        raise ValueError('Unknown ensemble method! %r' % method)
+
+
+def combine(method: str, total: np.ndarray, count: int) -> np.ndarray:
+    # ensemble confidences from the sum of `count` member terms, votes
+    # become the share of models choosing each option
+    if method == 'mean_logits':
+        return softmax(total / count)
+    return total / count
+
+
+def ensemble_scores(stacked: StackedPredictions, method: str) -> np.ndarray:
+    members = stacked.member_scores(method)
+    return combine(method, members.sum(axis=0), len(stacked))
+
+
+def build_answers(
+    gold_answers: List[Answer],
+    scores: np.ndarray,
+    widths: List[int],
+    no_answer_text: Optional[str] = None,
+) -> List[Answer]:
+    positions = [None] * len(gold_answers)
+    if no_answer_text:
+        positions = no_answer_positions(gold_answers, no_answer_text).tolist()
+    answers = [
+        Answer(
+            example_id=gold.example_id,
+            pred_label=None,
+            no_answer_text=no_answer_text,
+            no_answer_option=position,
+        )
+        for gold, position in zip(gold_answers, positions)
+    ]
+    return update_answers(answers, scores, widths)
+
+
+def update_answers(
+    answers: List[Answer], scores: np.ndarray, widths: List[int]
+) -> List[Answer]:
+    # answer objects are reused between candidates, only scores change
+    choices = scores.argmax(axis=1).tolist()
+    for ans, row, choice, width in zip(
+        answers, scores.tolist(), choices, widths
+    ):
+        ans.probs = row[:width]
+        ans.pred_label = id_to_label(choice)
+    return answers
+
+
+class EnsembleAccumulator(object):
+    """
+    Running sum of the selected members' terms. A candidate is scored by
+    adding one member to the sum, instead of combining the whole subset
+    again.
+    """
+
+    def __init__(self, stacked: StackedPredictions, method: str):
+        self.method = method
+        self.members = stacked.member_scores(method)
+        self.total = np.zeros(self.members.shape[1:])
+        self.selected = []
+
+    def candidate(self, index: int) -> np.ndarray:
+        return combine(
+            self.method,
+            self.total + self.members[index],
+            len(self.selected) + 1
+        )
+
+    def add(self, index: int):
+        self.total += self.members[index]
+        self.selected.append(index)
+
+    def scores(self) -> np.ndarray:
+        return combine(self.method, self.total, len(self.selected))
+
+
+def greedy_selection(
+    stacked: StackedPredictions,
+    method: str,
+    gold_answers: List[Answer],
+    score_fn: Callable[[List[Answer]], float],
+    max_size: Optional[int] = None,
+    no_answer_text: Optional[str] = None,
+) -> Dict:
+    """
+    Forward selection: starting from an empty ensemble, repeatedly add the
+    model whose addition scores best (higher is better) under `score_fn`,
+    stopping when no model improves the score or `max_size` is reached.
+    """
+    max_size = len(stacked) if max_size is None else max_size
+    accumulator = EnsembleAccumulator(stacked, method)
+    answers = build_answers(
+        gold_answers, accumulator.members[0], stacked.widths, no_answer_text
+    )
+    remaining = list(range(len(stacked)))
+    best_score = -np.inf
+    history = []
+    while len(remaining) > 0 and len(accumulator.selected) < max_size:
+        candidate_scores = []
+        for index in remaining:
+            update_answers(
+                answers, accumulator.candidate(index), stacked.widths
+            )
+            candidate_scores.append(score_fn(answers))
+        best = int(np.argmax(candidate_scores))
+        if candidate_scores[best] <= best_score:
+            break
+        best_score = candidate_scores[best]
+        index = remaining.pop(best)
+        accumulator.add(index)
+        history.append(dict(model=stacked.paths[index], score=best_score))
+
+    return dict(
+        method=method,
+        models=[stacked.paths[index] for index in accumulator.selected],
+        score=best_score,
+        history=history,
+        scores=accumulator.scores(),
+    )
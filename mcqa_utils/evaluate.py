@@ -1,6 +1,6 @@
 from typing import List, Union
 
-from mcqa_utils.metric import Metric
+from mcqa_utils.metric import Metric, UtilityFunction, evaluate_utilities
 from mcqa_utils.answer import Answer
 
 
@@ -27,8 +27,21 @@ class GenericEvaluator(Evaluator):
         answers: List[Answer],
     ) -> float:
         results = {}
+        # utility functions share one count of the outcomes
+        utilities = [
+            metric for metric in self.metrics
+            if isinstance(metric, UtilityFunction)
+        ]
+        outputs = {}
+        if len(utilities) > 0:
+            outputs = dict(zip(
+                map(id, utilities),
+                evaluate_utilities(utilities, gold_answers, answers)
+            ))
         for metric in self.metrics:
-            metric_output = metric(gold_answers, answers)
+            metric_output = outputs.get(id(metric), None)
+            if metric_output is None:
+                metric_output = metric(gold_answers, answers)
             results[metric.name] = metric_output.value
             for key, value in vars(metric_output).items():
                 if key != "value" and value is not None:
@@ -0,0 +1,216 @@
+import math
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+from mcqa_utils.answer import Answer
+from mcqa_utils.metric import Metric, C_at_1, Average, UtilityFunction
+
+# Expected value (and variance) of count based metrics when some answers
+# are filled at random. Each filled question is an independent categorical
+# outcome (correct, unanswered, incorrect), observed answers are constant.
+# Moments of the (correct, unanswered) counts come from the product of the
+# per question generating functions, so no sampling is involved.
+
+# Stirling numbers of the second kind, S(a, i) for a, i <= 2
+_stirling = np.array([[1, 0, 0], [0, 1, 0], [0, 1, 1]])
+
+
+def irwin_hall_cdf(value: float, nof_terms: int) -> float:
+    # P(sum of `nof_terms` iid U(0, 1) <= value)
+    if value <= 0:
+        return 0.0
+    if value >= nof_terms:
+        return 1.0
+    total = sum(
+        (-1) ** j * math.comb(nof_terms, j) * (value - j) ** nof_terms
+        for j in range(int(math.floor(value)) + 1)
+    )
+    return total / math.factorial(nof_terms)
+
+
+def fill_unanswered_prob(
+    strategy: str, nof_choices: int, threshold: float
+) -> float:
+    # probability that a filled answer falls below the threshold
+    strategy = strategy.lower()
+    if strategy == 'random':
+        return float(1.0 <= threshold)
+    if strategy == 'uniform':
+        # scaled by the max, the other k - 1 uniforms are iid U(0, 1), so
+        # max share = 1 / (1 + irwin_hall(k - 1))
+        if threshold <= 0:
+            return 0.0
+        return 1.0 - irwin_hall_cdf(1.0 / threshold - 1.0, nof_choices - 1)
+    value = float(strategy)
+    max_prob = 1.0 / nof_choices if value > 0 else 0.0
+    return float(max_prob <= threshold)
+
+
+def fill_outcome_probs(
+    strategy: str,
+    nof_choices: int,
+    threshold: float,
+    gold_ids: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # per filled question: P(correct), P(unanswered)
+    p_unanswered = fill_unanswered_prob(strategy, nof_choices, threshold)
+    p_unanswered = np.full(len(gold_ids), p_unanswered)
+    if strategy.lower() in ('uniform', 'random'):
+        # argmax is uniform among the options by symmetry
+        p_correct = (1.0 - p_unanswered) / nof_choices
+    else:
+        # constant probs always pick the first option
+        p_correct = (1.0 - p_unanswered) * (gold_ids == 0)
+    return p_correct, p_unanswered
+
+
+def _truncated_product(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    out = np.zeros((3, 3))
+    for r in range(3):
+        for s in range(3):
+            out[r, s] = sum(
+                left[i, j] * right[r - i, s - j]
+                for i in range(r + 1) for j in range(s + 1)
+            )
+    return out
+
+
+def count_moments(
+    p_x: np.ndarray,
+    p_y: np.ndarray,
+    x_offset: float = 0.0,
+    y_offset: float = 0.0,
+) -> np.ndarray:
+    """
+    E[X^a Y^b] for a, b <= 2, where X (Y) counts the questions with outcome
+    x (y), given exclusive per question probabilities, plus constant
+    offsets for the observed part.
+    """
+    # log of prod_i (1 + p_x a + p_y b), truncated to degree 2 in a and b
+    log_series = np.zeros((3, 3))
+    for r in range(3):
+        for s in range(3):
+            n = r + s
+            if n == 0:
+                continue
+            coef = (-1) ** (n + 1) * math.comb(n, r) / n
+            log_series[r, s] = coef * np.sum(p_x ** r * p_y ** s)
+    # exp of a series without constant term needs up to the 4th power
+    series = np.zeros((3, 3))
+    series[0, 0] = 1.0
+    term = series.copy()
+    for k in range(1, 5):
+        term = _truncated_product(term, log_series) / k
+        series += term
+    # taylor coefficients around 1 are factorial moments
+    factorials = np.array([1, 1, 2])
+    factorial_moments = series * np.outer(factorials, factorials)
+    raw = _stirling @ factorial_moments @ _stirling.T
+    # shift by the observed counts
+    moments = np.zeros((3, 3))
+    for a in range(3):
+        for b in range(3):
+            moments[a, b] = sum(
+                math.comb(a, i) * math.comb(b, j) *
+                x_offset ** (a - i) * y_offset ** (b - j) * raw[i, j]
+                for i in range(a + 1) for j in range(b + 1)
+            )
+    return moments
+
+
+def expected_linear(
+    moments: np.ndarray, weight_x: float, weight_y: float
+) -> Tuple[float, float]:
+    # mean and variance of weight_x * X + weight_y * Y
+    mean = weight_x * moments[1, 0] + weight_y * moments[0, 1]
+    var_x = moments[2, 0] - moments[1, 0] ** 2
+    var_y = moments[0, 2] - moments[0, 1] ** 2
+    cov = moments[1, 1] - moments[1, 0] * moments[0, 1]
+    variance = (
+        weight_x ** 2 * var_x + weight_y ** 2 * var_y +
+        2 * weight_x * weight_y * cov
+    )
+    return mean, max(variance, 0.0)
+
+
+def expected_c_at_1(moments: np.ndarray, total: int) -> Tuple[float, float]:
+    # C_at_1 = X / n + X Y / n^2, X = correct, Y = unanswered
+    mean = moments[1, 0] / total + moments[1, 1] / total ** 2
+    second = (
+        moments[2, 0] / total ** 2 +
+        2 * moments[2, 1] / total ** 3 +
+        moments[2, 2] / total ** 4
+    )
+    return mean, max(second - mean ** 2, 0.0)
+
+
+def expected_metrics(
+    metrics: List[Metric],
+    gold_answers: List[Answer],
+    answers: List[Answer],
+    filled_mask: List[bool],
+    strategy: str,
+    nof_choices: int,
+    threshold: float = 0.0,
+) -> Dict[str, float]:
+    total = len(gold_answers)
+    observed_correct = 0
+    observed_unanswered = 0
+    observed_avg_correct = 0
+    filled_gold = []
+    filled_no_answer_option = []
+    for gold, ans, filled in zip(gold_answers, answers, filled_mask):
+        gold_value = gold.get_answer()
+        if filled:
+            filled_gold.append(gold_value)
+            filled_no_answer_option.append(ans.search_unanswerable_option())
+            continue
+        answer_value = ans.get_answer()
+        if answer_value == gold_value:
+            observed_correct += 1
+        elif answer_value == ans.no_answer:
+            observed_unanswered += 1
+        if ans.get_answer(accept_no_answer=False) == gold_value:
+            observed_avg_correct += 1
+
+    filled_gold = np.asarray(filled_gold, dtype=np.int64)
+    p_correct, p_unanswered = fill_outcome_probs(
+        strategy, nof_choices, threshold, filled_gold
+    )
+    moments = count_moments(
+        p_correct, p_unanswered, observed_correct, observed_unanswered
+    )
+    # avg sends unanswered questions to the no answer option (if any)
+    no_answer_is_gold = (
+        np.asarray(filled_no_answer_option, dtype=np.int64) == filled_gold
+    )
+    p_avg_correct = p_correct + p_unanswered * no_answer_is_gold
+    avg_moments = count_moments(
+        p_avg_correct, np.zeros_like(p_avg_correct), observed_avg_correct
+    )
+
+    results = {}
+    for metric in metrics:
+        if isinstance(metric, C_at_1):
+            mean, variance = expected_c_at_1(moments, total)
+        elif isinstance(metric, UtilityFunction):
+            unanswered_w, incorrect_w, correct_w = metric.utility
+            # incorrect = total - correct - unanswered
+            mean, variance = expected_linear(
+                moments, correct_w - incorrect_w, unanswered_w - incorrect_w
+            )
+            mean = (mean + incorrect_w * total) / total
+            variance /= total ** 2
+            utility_str = '_'.join([str(u) for u in metric.utility])
+            metric.name = f"utility_function_{utility_str}"
+        elif isinstance(metric, Average):
+            mean, variance = expected_linear(avg_moments, 1.0, 0.0)
+            mean /= total
+            variance /= total ** 2
+        else:
+            continue
+        results[metric.name] = mean
+        results[f'{metric.name}_variance'] = variance
+
+    return results
@@ -0,0 +1,83 @@
+import numpy as np
+
+from typing import Dict, List, Tuple, Union
+
+
+class IdCodec(object):
+    """
+    Packs (context_id, question_id) pairs into a single int64.
+
+    Context ids are interned in order of first appearance, so when the
+    dataset is encoded first, sorting packed ids preserves gold order and
+    grouping by context is a shift. String ids (`<context>-<question>`)
+    are only produced at the output boundary.
+    """
+
+    question_bits = 16
+    question_mask = (1 << question_bits) - 1
+
+    def __init__(self):
+        self._context_index: Dict[str, int] = {}
+        self._context_names: List[str] = []
+
+    def __len__(self):
+        return len(self._context_names)
+
+    @property
+    def context_names(self) -> List[str]:
+        # position i is the context interned as index i
+        return list(self._context_names)
+
+    def intern_context(self, context_id: Union[str, int]) -> int:
+        context_id = str(context_id)
+        index = self._context_index.get(context_id, None)
+        if index is None:
+            index = len(self._context_names)
+            self._context_index[context_id] = index
+            self._context_names.append(context_id)
+        return index
+
+    def encode(
+        self, context_id: Union[str, int], question_id: Union[str, int]
+    ) -> int:
+        question_id = int(question_id)
+        if question_id < 0 or question_id > self.question_mask:
+            raise ValueError('Question id out of range %r' % question_id)
+        context_index = self.intern_context(context_id)
+        return (context_index << self.question_bits) | question_id
+
+    def decode(self, example_id: int) -> Tuple[str, int]:
+        example_id = int(example_id)
+        context_index = example_id >> self.question_bits
+        return (
+            self._context_names[context_index],
+            example_id & self.question_mask,
+        )
+
+    def context_index(self, example_ids):
+        # works both on scalars and int64 arrays
+        return example_ids >> self.question_bits
+
+    def question_index(self, example_ids):
+        return example_ids & self.question_mask
+
+    def context_name(self, example_id: int) -> str:
+        return self._context_names[int(example_id) >> self.question_bits]
+
+    def to_str(self, example_id: int) -> str:
+        context_id, question_id = self.decode(example_id)
+        return f'{context_id}-{question_id:02d}'
+
+    def from_str(self, str_id: str) -> int:
+        context_id, _, question_id = str(str_id).rpartition('-')
+        if len(context_id) == 0 or not question_id.isdigit():
+            raise ValueError(
+                f'Example ids must look like <context>-<question>, got '
+                f'{str_id!r}'
+            )
+        return self.encode(context_id, question_id)
+
+    def as_id(self, example_id: Union[str, int, np.integer]) -> int:
+        if isinstance(example_id, (int, np.integer)):
+            return int(example_id)
+        return self.from_str(example_id)
@@ -0,0 +1,64 @@
+import os
+import json
+import mmap
+import numpy as np
+
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _stdlib_default(obj):
+    # orjson handles contiguous numpy natively, this covers the rest and
+    # the stdlib fallback
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(
+        f'Object of type {type(obj).__name__} is not JSON serializable'
+    )
+
+
+def loads(data: Union[str, bytes, bytearray, memoryview, mmap.mmap]) -> Any:
+    if isinstance(data, mmap.mmap):
+        data = memoryview(data)
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def load(path: str, use_mmap: bool = True) -> Any:
+    with open(path, 'rb') as fstream:
+        # mmap refuses empty files, let the parser complain instead
+        if not use_mmap or os.fstat(fstream.fileno()).st_size == 0:
+            return loads(fstream.read())
+        with mmap.mmap(fstream.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                return loads(view)
+            finally:
+                view.release()
+
+
+def dumps(obj: Any, compact: bool = False) -> str:
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if not compact:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(
+            obj, option=option, default=_stdlib_default
+        ).decode('utf-8')
+    if compact:
+        return json.dumps(obj, separators=(',', ':'), default=_stdlib_default)
+    return json.dumps(obj, indent=2, default=_stdlib_default)
+
+
+def dump(obj: Any, path: str, compact: bool = False):
+    with open(path, 'w') as fout:
+        fout.write(dumps(obj, compact=compact) + '\n')
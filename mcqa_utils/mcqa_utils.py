@@ -1,15 +1,46 @@
 """Main module."""
-import json
+import sys
 import argparse
+import numpy as np
 
 from pathlib import Path
 from collections import defaultdict
 
+from mcqa_utils import json_codec, __version__
+from mcqa_utils.cache import (
+    ResultsCache,
+    make_key,
+    hash_paths,
+    package_hash,
+    dataset_split_paths,
+    default_cache_dir,
+    default_cache_max_bytes,
+)
 from mcqa_utils.dataset import Dataset
-from mcqa_utils.utils import get_mask_matching_text
-from mcqa_utils.threshold import Threshold
+from mcqa_utils.ensemble import (
+    StackedPredictions,
+    build_answers,
+    ensemble_fields,
+    ensemble_methods,
+    ensemble_scores,
+    greedy_selection,
+)
+from mcqa_utils.sinks import (
+    AsyncSink,
+    FileSink,
+    JsonLinesSink,
+    MlflowSink,
+    MultiSink,
+    SQLiteSink,
+    StdoutSink,
+)
+from mcqa_utils.threshold import Threshold, risk_coverage, write_curve
+from mcqa_utils.watch import watch_predictions
 from mcqa_utils.metric import metrics_map
+from mcqa_utils.confidence import derived_fields
 from mcqa_utils.evaluate import GenericEvaluator
+from mcqa_utils.expected import expected_metrics
+from mcqa_utils.outcomes import outcome_arrays, outcome_formats, write_outcomes
 from mcqa_utils.question_answering import QASystemForMCOffline
 from mcqa_utils.answer import (
     apply_threshold_to_answers,
@@ -64,6 +95,37 @@ def parse_flags():
         '-t', '--threshold', default=None, required=False, type=float,
         help='Apply threshold to all answers'
     )
+    parser.add_argument(
+        '--threshold_sketch', type=int, required=False, default=None,
+        metavar='BINS',
+        help='Approximate --find_threshold from histograms of BINS bins '
+        '(C_at_1, avg and utility functions), reporting the error bound'
+    )
+    parser.add_argument(
+        '--threshold_sketch_refine', action='store_true', required=False,
+        help='Refine --threshold_sketch to the exact best threshold, '
+        'looking only inside the bins that could hold it'
+    )
+    parser.add_argument(
+        '--threshold_cv', type=int, required=False, default=None,
+        metavar='K',
+        help='Cross validate the threshold search: pick the best threshold '
+        'on K - 1 folds (grouped by context), score it on the held out one '
+        'and report the mean and deviation (C_at_1, avg and utility '
+        'functions). K can not exceed the number of contexts'
+    )
+    parser.add_argument(
+        '--threshold_cv_seed', type=int, required=False, default=0,
+        help='Seed for the --threshold_cv folds'
+    )
+    parser.add_argument(
+        '--group_threshold', type=str, required=False, default=None,
+        metavar='KEY',
+        help='Find the best threshold of each group of questions in one '
+        'sweep and evaluate every group under its own threshold. KEY is '
+        'has_ans (needs --no_answer_text) or a JSON file mapping question '
+        '(<context>-<question>) or context ids to group names'
+    )
     parser.add_argument(
         '-m', '--metrics', nargs='*', required=False, default=[],
         help=f'Metrics to apply (available: {", ".join((metrics_map.keys()))})'
@@ -76,6 +138,10 @@ def parse_flags():
         "]. If multiple values are provided, several utility functions will be"
         " applied"
     )
+    parser.add_argument(
+        "--top_k", nargs='+', type=int, default=[],
+        help="Top k accuracies to report (implies -m top_k, default k = 2)"
+    )
     parser.add_argument(
         "-ufs", "--utility_function_str", type=str, default="",
         help="Weights for the utility function (passed as string) "
@@ -95,6 +161,16 @@ def parse_flags():
         '--merge', action='store_true', required=False,
         help='Whether to merge output file with previous output'
     )
+    parser.add_argument(
+        '--compact', action='store_true', required=False,
+        help='Write results as compact JSON (for machine consumers)'
+    )
+    parser.add_argument(
+        '--results_db', type=str, required=False, default=None,
+        help='Append results to this SQLite database instead of rewriting '
+        'the output file, --output names the results file inside it (see '
+        'mcqa_results export)'
+    )
     parser.add_argument(
         '--no_answer_text', type=str, required=False, default=None,
         help='Text of an unaswerable question answer'
@@ -102,7 +178,13 @@ def parse_flags():
     parser.add_argument(
         '-pf', '--probs_field', type=str, required=False, default=None,
         help='Field to use as `probs` field in prediction answers '
-        '(default probs, but can be anything parsed in the answer)'
+        '(default probs, but can be anything parsed in the answer). Derived '
+        f'confidence fields are also available: {", ".join(derived_fields)}'
+    )
+    parser.add_argument(
+        '--temperature', type=float, required=False, default=None,
+        help='Temperature to scale logits with before computing derived '
+        'confidence fields (softmax over logits/T)'
     )
     parser.add_argument(
         '-fm', '--fill_missing', default=None, required=False,
@@ -110,10 +192,122 @@ def parse_flags():
         'random choosing or giving a value for all probs '
         '(uniform/random/value)'
     )
+    parser.add_argument(
+        '--expected_fill', action='store_true', required=False,
+        help='Also report the exact expected value (and variance) of '
+        'C_at_1, avg and utility functions under the --fill_missing '
+        'distribution, instead of relying on a single random draw'
+    )
+    parser.add_argument(
+        '--fill_seed', type=int, required=False, default=None,
+        help='Seed for the random generator used by --fill_missing'
+    )
     parser.add_argument(
         "--save_mlflow", action="store_true",
         help="Stores the given metrics in mlflow (requires package installed)"
     )
+    parser.add_argument(
+        '--mlflow_tracking_uri', type=str, required=False, default=None,
+        help='Tracking uri for --save_mlflow, a local file store '
+        '(file:///path/to/mlruns) works without a tracking server'
+    )
+    parser.add_argument(
+        '--dump_outcomes', '--dump-outcomes', type=str, required=False,
+        default=None, metavar='PATH',
+        help='Write per question outcomes (gold, pred, abstained, max prob, '
+        'margin, masks...) under -t (if given) to PATH, as Parquet '
+        '(.parquet) or Arrow IPC (.arrow, .feather). Requires pyarrow'
+    )
+    parser.add_argument(
+        '--risk_coverage', action='store_true', required=False,
+        help='Report the risk-coverage curve (coverage, selective accuracy, '
+        'C_at_1 and count metrics at every threshold, down-sampled), its '
+        'area (AURC) and the thresholds reaching --target_coverage'
+    )
+    parser.add_argument(
+        '--target_coverage', nargs='+', type=float, required=False,
+        default=[0.9, 0.95],
+        help='Coverages to report thresholds for with --risk_coverage'
+    )
+    parser.add_argument(
+        '--risk_coverage_csv', type=str, required=False, default=None,
+        metavar='PATH',
+        help='Also write the full risk-coverage curve to PATH as CSV '
+        '(implies --risk_coverage)'
+    )
+    parser.add_argument(
+        '--ensemble', nargs='+', required=False, default=None,
+        metavar='NBEST',
+        help='Evaluate the ensembles of these nbest predictions '
+        f'({", ".join(ensemble_methods)}), instead of a single model'
+    )
+    parser.add_argument(
+        '--ensemble_select', type=str, required=False, default=None,
+        metavar='METRIC',
+        help='Also run greedy forward selection of --ensemble models under '
+        'this metric (after threshold search with -ft, or with -t), one of '
+        'the count metrics: '
+        + ', '.join(
+            name for name, metric in metrics_map.items()
+            if metric.has_counts and metric.higher_is_better
+        )
+    )
+    parser.add_argument(
+        '--ensemble_method', type=str, required=False,
+        default='mean_probs', choices=ensemble_methods,
+        help='Ensemble used by --ensemble_select (default = %(default)s)'
+    )
+    parser.add_argument(
+        '--ensemble_max_size', type=int, required=False, default=None,
+        help='Maximum number of models chosen by --ensemble_select'
+    )
+    parser.add_argument(
+        '--watch', type=str, required=False, default=None, metavar='DIR',
+        help='Evaluate every predictions file (see --watch_pattern) created '
+        'or updated under DIR, loading the dataset once. Results are '
+        'appended as JSON lines to --output (or stdout) and/or stored in '
+        '--results_db, files already in --output are skipped'
+    )
+    parser.add_argument(
+        '--watch_pattern', type=str, required=False,
+        default='nbest_predictions.json',
+        help='Filename pattern of the predictions to watch '
+        '(default = %(default)s)'
+    )
+    parser.add_argument(
+        '--watch_workers', type=int, required=False, default=1,
+        help='Processes evaluating watched predictions (default = 1)'
+    )
+    parser.add_argument(
+        '--watch_interval', type=float, required=False, default=2.0,
+        help='Seconds between checks for new predictions (default = 2.0)'
+    )
+    parser.add_argument(
+        '--watch_timeout', type=float, required=False, default=None,
+        help='Stop watching after this many seconds without new '
+        'predictions (default = run until interrupted)'
+    )
+    parser.add_argument(
+        '--no_cache', '--no-cache', action='store_true', required=False,
+        help='Do not look up nor store results in the results cache. '
+        'Cached results are keyed by the inputs, the flags and the package '
+        'sources, so code changes already invalidate them'
+    )
+    parser.add_argument(
+        '--cache_dir', type=str, required=False, default=default_cache_dir,
+        help='Directory of the results cache (default = %(default)s, '
+        'or $MCQA_UTILS_CACHE)'
+    )
+    parser.add_argument(
+        '--cache_max_bytes', type=int, required=False,
+        default=default_cache_max_bytes,
+        help='Size bound of the results cache, least recently used '
+        'results are evicted first (default = %(default)s)'
+    )
+    parser.add_argument(
+        '--cache_stats', action='store_true', required=False,
+        help='Print results cache statistics (to stderr)'
+    )
     args = parser.parse_args()
     args.utility_function.extend(
         parse_utility_fn_str(args.utility_function_str)
@@ -121,36 +315,155 @@ def parse_flags():
     # uniq
     args.metrics = list(set(args.metrics))
     if not args.info and (
-        len(args.metrics) == 0 and len(args.utility_function) == 0
+        len(args.metrics) == 0 and len(args.utility_function) == 0 and
+        len(args.top_k) == 0
     ):
         raise ValueError(
             "If not printing dataset info, you must request at "
             "least one metric!"
         )
     elif (
-        not args.info and
+        not args.info and args.watch is None and args.ensemble is None and
         (args.nbest_predictions is None and args.predictions is None)
     ):
         raise ValueError('You must provide some predictions to evalute!')
 
+    if args.dump_outcomes is not None and args.watch is not None:
+        raise ValueError('Outcomes can not be dumped in --watch mode!')
+    if args.risk_coverage_csv is not None:
+        if args.watch is not None:
+            raise ValueError('Risk-coverage curves can not be written in '
+                             '--watch mode!')
+        args.risk_coverage = True
+    if args.dump_outcomes is not None and (
+        Path(args.dump_outcomes).suffix.lower() not in outcome_formats
+    ):
+        raise ValueError(
+            'Outcomes are written as Parquet or Arrow IPC, use one of: '
+            f'{", ".join(outcome_formats)}'
+        )
+    if args.ensemble is not None and args.expected_fill:
+        raise ValueError('Expected fill metrics are not available for '
+                         'ensembles!')
+    if args.threshold_sketch is not None and (
+        not args.find_threshold or args.threshold_sketch < 1
+    ):
+        raise ValueError('Threshold sketches need --find_threshold and at '
+                         'least one bin!')
+    if args.threshold_cv is not None and args.threshold_cv < 2:
+        raise ValueError('Threshold cross validation needs at least two '
+                         'folds!')
+    if args.group_threshold == 'has_ans' and not args.no_answer_text:
+        raise ValueError('has_ans threshold groups need --no_answer_text!')
+    if args.group_threshold not in (None, 'has_ans') and (
+        not Path(args.group_threshold).is_file()
+    ):
+        raise ValueError(
+            'Threshold groups are has_ans or a JSON file with the group of '
+            f'each question, {args.group_threshold!r} is neither'
+        )
+    if args.ensemble_select is not None and (
+        args.ensemble is None or
+        args.ensemble_select not in metrics_map or
+        not metrics_map[args.ensemble_select].has_counts or
+        not metrics_map[args.ensemble_select].higher_is_better
+    ):
+        raise ValueError(
+            "Ensemble selection needs --ensemble and a metric from: "
+            + ', '.join(
+                name for name, metric in metrics_map.items()
+                if metric.has_counts and metric.higher_is_better
+            )
+        )
+    if args.ensemble is not None and (
+        args.temperature is not None or
+        args.probs_field not in (None,) + ensemble_fields
+    ):
+        raise ValueError(
+            'Ensembled answers only carry probs, --probs_field must be one '
+            'of: ' + ', '.join(ensemble_fields) + ' (without --temperature)'
+        )
+
+    if args.temperature is not None and (
+        args.probs_field not in derived_fields or args.temperature <= 0
+    ):
+        raise ValueError(
+            'Temperature only scales derived confidence fields ('
+            + ', '.join(derived_fields) + ') and must be positive'
+        )
+
+    if args.fill_missing is not None and (
+        args.fill_missing.lower() not in ('uniform', 'random')
+    ):
+        try:
+            fill_value = float(args.fill_missing)
+        except ValueError:
+            fill_value = float('nan')
+        # zero leaves the filled answers unanswered
+        if not 0 <= fill_value < float('inf'):
+            raise ValueError(
+                'Missing answers are filled with uniform, random or a value '
+                f'for all probs (not negative), got {args.fill_missing!r}'
+            )
+
+    if args.expected_fill and (
+        args.fill_missing is None or args.probs_field is not None
+    ):
+        raise ValueError(
+            "Expected fill metrics need --fill_missing and are computed "
+            "over the `probs` field (no --probs_field)"
+        )
+
     # delete metrics with non-default values, will be created separately
     if len(args.utility_function) > 0 and "utility_function" in args.metrics:
         del args.metrics[args.metrics.index("utility_function")]
+    if len(args.top_k) > 0 and "top_k" in args.metrics:
+        del args.metrics[args.metrics.index("top_k")]
 
     return args
 
 
-def get_masks_and_prefix(dataset, samples, no_answer_text):
-    answer_mask_fn = get_mask_matching_text(no_answer_text, match=False)
-    no_answer_mask_fn = get_mask_matching_text(no_answer_text, match=True)
-    answer_mask = dataset.find_mask(samples, answer_mask_fn)
-    no_answer_mask = dataset.find_mask(samples, no_answer_mask_fn)
+def get_masks_and_prefix(dataset, samples, no_answer_text, split=None):
+    answer_mask = dataset.find_text_mask(
+        samples, no_answer_text, match=False, splits=split
+    )
+    no_answer_mask = dataset.find_text_mask(
+        samples, no_answer_text, match=True, splits=split
+    )
     masks = (answer_mask, no_answer_mask)
     prefix = ('has_ans', 'no_has_ans')
 
     return masks, prefix
 
 
+def get_group_keys(args, dataset, gold_answers, masks=None):
+    # group of each question for --group_threshold
+    if args.group_threshold == 'has_ans':
+        return np.where(masks[1], 'no_has_ans', 'has_ans')
+    # keys are question ids (<context>-<question>) or whole contexts
+    context_groups = json_codec.load(args.group_threshold)
+    id_codec = dataset.id_codec
+    question_groups = {
+        id_codec.from_str(key): group
+        for key, group in context_groups.items()
+        if key.rpartition('-')[2].isdigit()
+    }
+    keys = []
+    for gold in gold_answers:
+        group = question_groups.get(gold.example_id, None)
+        if group is None:
+            group = context_groups.get(
+                id_codec.context_name(gold.example_id), None
+            )
+        keys.append(group)
+    missing = sum(group is None for group in keys)
+    if missing > 0:
+        raise ValueError(
+            f'{args.group_threshold} has no group for {missing} questions!'
+        )
+    return keys
+
+
 def get_results(
     dataset,
     evaluator,
@@ -203,12 +516,10 @@ def print_dataset_stats(args):
 
         results['# questions'].append(len(gold_answers))
         if args.no_answer_text:
-            no_answer_mask_fn = get_mask_matching_text(
-                args.no_answer_text, match=True
+            no_answer_mask = dataset.get_index(split).gold_text_mask(
+                args.no_answer_text
             )
-            no_answer_mask = dataset.find_mask(gold_answers, no_answer_mask_fn)
-            gold_reduced = dataset.reduce_by_mask(gold_answers, no_answer_mask)
-            results['# unanswerable'].append(len(gold_reduced))
+            results['# unanswerable'].append(int(no_answer_mask.sum()))
 
         splits.append(split)
 
@@ -231,28 +542,173 @@ def print_dataset_stats(args):
     print(results_str)
 
 
-def mcqa(args):
-    if args.output is not None:
-        output_file = Path(args.output)
-        output_file.parent.mkdir(parents=True, exist_ok=True)
-        if output_file.exists() and not args.overwrite and not args.merge:
-            raise RuntimeError(
-                'Output file already exists!\n'
-                'Pass --overwrite or --merge to overcome'
-            )
-        elif args.merge:
-            prev_output = json.load(open(args.output, 'r'))
+def get_cache_key(args):
+    # outcomes and curves are only written when evaluating
+    if args.dump_outcomes is not None or args.risk_coverage_csv is not None:
+        return None
+    # random fills without a seed give different results on every run
+    if args.fill_missing is not None and args.fill_seed is None and (
+        args.fill_missing.lower() in ('uniform', 'random')
+    ):
+        return None
+    if args.ensemble is not None:
+        # the order of ensembled models breaks selection ties
+        predictions = [hash_paths([path]) for path in args.ensemble]
     else:
-        prev_output = None
+        predictions = hash_paths([get_results_path(args)])
+    inputs = {
+        'predictions': predictions,
+        'dataset': hash_paths(dataset_split_paths(args.dataset, args.split)),
+    }
+    if args.group_threshold not in (None, 'has_ans'):
+        inputs['groups'] = hash_paths([args.group_threshold])
+    flags = dict(
+        version=__version__, code=package_hash(), **get_results_flags(args)
+    )
+    return make_key(inputs, flags)
+
 
-    dataset_path = args.dataset
-    results_path = (
+def get_results_path(args):
+    if args.ensemble is not None:
+        return ','.join(args.ensemble)
+    return (
         args.nbest_predictions
         if args.predictions is None
         else args.predictions
     )
 
-    split = args.split
+
+def get_results_flags(args):
+    # normalized flags that change the results
+    return {
+        'nbest': args.predictions is None,
+        'split': args.split,
+        'task': args.task,
+        'metrics': sorted(args.metrics),
+        'utility_function': sorted(args.utility_function),
+        'top_k': sorted(args.top_k),
+        'find_threshold': args.find_threshold,
+        'threshold': args.threshold,
+        'threshold_sketch': args.threshold_sketch,
+        'threshold_sketch_refine': args.threshold_sketch_refine,
+        'threshold_cv': args.threshold_cv,
+        'threshold_cv_seed': args.threshold_cv_seed,
+        'group_threshold': args.group_threshold,
+        'risk_coverage': args.risk_coverage,
+        'target_coverage': sorted(args.target_coverage),
+        'no_answer_text': args.no_answer_text,
+        'probs_field': args.probs_field,
+        'temperature': args.temperature,
+        'fill_missing': args.fill_missing,
+        'fill_seed': args.fill_seed,
+        'expected_fill': args.expected_fill,
+        'ensemble_select': args.ensemble_select,
+        'ensemble_method': args.ensemble_method,
+        'ensemble_max_size': args.ensemble_max_size,
+    }
+
+
+def get_result_sinks(args):
+    # slow sinks (sqlite, mlflow) write from a background thread
+    sinks = []
+    if args.results_db is not None:
+        sinks.append(AsyncSink(SQLiteSink(args.results_db, args.output)))
+    if args.output is None:
+        sinks.append(StdoutSink(args.compact))
+    elif args.results_db is None:
+        sinks.append(FileSink(
+            args.output,
+            overwrite=args.overwrite,
+            merge=args.merge,
+            compact=args.compact,
+        ))
+    if args.save_mlflow:
+        sinks.append(AsyncSink(MlflowSink(args.mlflow_tracking_uri)))
+    return MultiSink(sinks)
+
+
+def mcqa_watch(args):
+    output = JsonLinesSink(args.output, overwrite=args.overwrite)
+    sinks = []
+    if args.results_db is not None:
+        sinks.append(AsyncSink(SQLiteSink(args.results_db, args.output)))
+    sinks.append(output)
+    if args.save_mlflow:
+        sinks.append(AsyncSink(MlflowSink(args.mlflow_tracking_uri)))
+    sinks = MultiSink(sinks)
+    try:
+        watch_predictions(
+            args,
+            sinks,
+            seen_hashes=output.read_field('hash'),
+            nof_workers=args.watch_workers,
+            interval=args.watch_interval,
+            timeout=args.watch_timeout,
+            metadata=dict(
+                split=args.split,
+                dataset=args.dataset,
+                flags=get_results_flags(args),
+            ),
+        )
+    except BaseException:
+        sinks.close(failed=True)
+        raise
+    sinks.close()
+
+
+def mcqa(args):
+    sinks = get_result_sinks(args)
+    results_path = get_results_path(args)
+    results_dict = None
+    cache_key = None
+    cache = None
+    if not args.no_cache:
+        cache = ResultsCache(args.cache_dir, args.cache_max_bytes)
+        cache_key = get_cache_key(args)
+        if cache_key is not None:
+            results_dict = cache.get(cache_key)
+
+    try:
+        if results_dict is None:
+            if args.ensemble is not None:
+                results_dict = get_ensemble_results(args)
+            else:
+                results_dict = get_mcqa_results(args)
+            if cache_key is not None:
+                cache.put(cache_key, results_dict)
+
+        if cache is not None:
+            stats = cache.save_stats()
+            if args.cache_stats:
+                print(
+                    'Results cache: ' + json_codec.dumps(stats, compact=True),
+                    file=sys.stderr
+                )
+
+        sinks.write(
+            results_dict,
+            split=args.split,
+            predictions=results_path,
+            dataset=args.dataset,
+            flags=get_results_flags(args),
+        )
+    except BaseException:
+        sinks.close(failed=True)
+        raise
+    sinks.close()
+
+
+def get_gold_data(args):
+    dataset = Dataset(data_path=args.dataset, task=args.task)
+    # gold answers are read before predictions so packed ids follow the
+    # dataset order
+    gold_answers = dataset.get_gold_answers(
+        args.split, with_text_values=bool(args.no_answer_text)
+    )
+    return dataset, gold_answers
+
+
+def get_metrics(args):
     no_answer = -1
     metrics = [metrics_map[met]() for met in args.metrics]
     if len(args.utility_function) > 0:
@@ -260,41 +716,190 @@ def mcqa(args):
             met = metrics_map["utility_function"]()
             met.utility = uf
             metrics.append(met)
+    for k in args.top_k:
+        met = metrics_map["top_k"]()
+        met.k = k
+        metrics.append(met)
 
     for metric in metrics:
         if metric.needs_no_answer():
             metric.no_answer = no_answer
 
-    dataset = Dataset(data_path=dataset_path, task=args.task)
-    qa_system = QASystemForMCOffline(answers_path=results_path)
-    evaluator = GenericEvaluator(metrics=metrics)
-    threshold = Threshold(evaluator)
+    return metrics
+
+
+def get_mcqa_results(
+    args, dataset=None, gold_answers=None, results_path=None
+):
+    # dataset and gold answers can be given to evaluate several
+    # predictions against a single load (i.e.: --watch)
+    if results_path is None:
+        results_path = get_results_path(args)
+    if dataset is None:
+        dataset, gold_answers = get_gold_data(args)
+
+    metrics = get_metrics(args)
+    qa_system = QASystemForMCOffline(
+        answers_path=results_path, id_codec=dataset.id_codec
+    )
 
     if args.fill_missing is not None:
         qa_system.missing_strategy = args.fill_missing
+        qa_system.missing_seed = args.fill_seed
+    filled_mask = None
+    if args.expected_fill:
+        filled_mask = [
+            qa_system.find_answer(gold.example_id) is None
+            for gold in gold_answers
+        ]
     # when `no_answer_text` is provided, avg can be optimized with the
     # threshold to answer the option with the text corresponding to
     # not being able to solve the question
     if args.no_answer_text:
-        gold_answers = dataset.get_gold_answers(split, with_text_values=True)
         answers, missing = qa_system.get_answers(
             gold_answers,
             with_text_values=True,
             no_answer_text=args.no_answer_text,
         )
+    else:
+        answers, missing = qa_system.get_answers(gold_answers)
+
+    assert(len(missing) == 0)
+
+    return evaluate_answers(
+        args,
+        dataset,
+        gold_answers,
+        answers,
+        metrics,
+        filled_mask=filled_mask,
+        nof_choices=qa_system.get_nof_choices(),
+        outcomes_path=args.dump_outcomes,
+        curve_path=args.risk_coverage_csv,
+    )
+
+
+def get_named_path(path, name=None):
+    # one output file per evaluated system, named after it
+    if path is None or name is None:
+        return path
+    path = Path(path)
+    return str(path.with_name(f'{path.stem}.{name}{path.suffix}'))
+
+
+def get_outcomes_path(args, name=None):
+    return get_named_path(args.dump_outcomes, name)
+
+
+def get_ensemble_results(args, dataset=None, gold_answers=None):
+    if dataset is None:
+        dataset, gold_answers = get_gold_data(args)
+    stacked = StackedPredictions.load(
+        args.ensemble,
+        gold_answers,
+        id_codec=dataset.id_codec,
+        missing_strategy=args.fill_missing,
+        missing_seed=args.fill_seed,
+    )
+    results_dict = {}
+    for method in ensemble_methods:
+        if method == 'mean_logits' and stacked.logits is None:
+            continue
+        answers = build_answers(
+            gold_answers,
+            ensemble_scores(stacked, method),
+            stacked.widths,
+            args.no_answer_text,
+        )
+        results_dict[method] = evaluate_answers(
+            args,
+            dataset,
+            gold_answers,
+            answers,
+            get_metrics(args),
+            outcomes_path=get_outcomes_path(args, method),
+            curve_path=get_named_path(args.risk_coverage_csv, method),
+        )
+
+    if args.ensemble_select is not None:
+        metric = metrics_map[args.ensemble_select]()
+        if args.ensemble_select == 'utility_function' and (
+            len(args.utility_function) > 0
+        ):
+            metric.utility = args.utility_function[0]
+        if metric.needs_no_answer():
+            metric.no_answer = -1
+        threshold = Threshold(GenericEvaluator(metrics=[metric]))
+
+        def score_fn(answers):
+            if args.find_threshold:
+                best_threshold = threshold.find_best_threshold(
+                    metric, gold_answers, answers
+                )
+                apply_threshold_to_answers(answers, best_threshold)
+            elif args.threshold is not None:
+                apply_threshold_to_answers(answers, args.threshold)
+            return metric(gold_answers, answers).value
+
+        selection = greedy_selection(
+            stacked,
+            args.ensemble_method,
+            gold_answers,
+            score_fn,
+            max_size=args.ensemble_max_size,
+            no_answer_text=args.no_answer_text,
+        )
+        answers = build_answers(
+            gold_answers,
+            selection.pop('scores'),
+            stacked.widths,
+            args.no_answer_text,
+        )
+        selection['metric'] = metric.name
+        selection['results'] = evaluate_answers(
+            args,
+            dataset,
+            gold_answers,
+            answers,
+            get_metrics(args),
+            outcomes_path=get_outcomes_path(args, 'ensemble_selection'),
+            curve_path=get_named_path(
+                args.risk_coverage_csv, 'ensemble_selection'
+            ),
+        )
+        results_dict['ensemble_selection'] = selection
+
+    return results_dict
+
+
+def evaluate_answers(
+    args,
+    dataset,
+    gold_answers,
+    answers,
+    metrics,
+    filled_mask=None,
+    nof_choices=None,
+    outcomes_path=None,
+    curve_path=None,
+):
+    # base results plus the requested threshold variants, `filled_mask`
+    # enables expected fill metrics, `outcomes_path` dumps per question
+    # outcomes and `curve_path` the risk-coverage curve
+    evaluator = GenericEvaluator(metrics=metrics)
+    threshold = Threshold(evaluator)
+    if args.no_answer_text:
         masks, prefix = get_masks_and_prefix(
-            dataset, gold_answers, args.no_answer_text
+            dataset, gold_answers, args.no_answer_text, args.split
         )
     else:
-        gold_answers = dataset.get_gold_answers(split)
-        answers, missing = qa_system.get_answers(gold_answers)
         masks = None
         prefix = None
 
-    assert(len(missing) == 0)
-
     if args.probs_field is not None:
-        apply_prob_field_to_answers(answers, args.probs_field)
+        apply_prob_field_to_answers(
+            answers, args.probs_field, args.temperature
+        )
         # new probs field is not necessary contrained to between 0 and 1
         # search for the lowest and set it as threshold to ensure fair
         # comparison
@@ -310,6 +915,16 @@ def mcqa(args):
         masks,
         prefix,
     )
+    if filled_mask is not None:
+        results_dict['expected_fill'] = expected_metrics(
+            metrics,
+            gold_answers,
+            answers,
+            filled_mask,
+            args.fill_missing,
+            nof_choices,
+            threshold=answers[0].threshold,
+        )
 
     # get results with requested threshold (if any)
     min_prob_pre_threshold = min([ans.get_min_prob() for ans in answers])
@@ -323,17 +938,64 @@ def mcqa(args):
             masks,
             prefix,
         )
+        if filled_mask is not None:
+            threshold_dict = results_dict[f'threshold_{args.threshold}']
+            threshold_dict['expected_fill'] = expected_metrics(
+                metrics,
+                gold_answers,
+                answers,
+                filled_mask,
+                args.fill_missing,
+                nof_choices,
+                threshold=args.threshold,
+            )
+
+    # outcomes under the requested threshold (if any), else the base one
+    if outcomes_path is not None:
+        write_outcomes(
+            outcomes_path,
+            outcome_arrays(gold_answers, answers, masks, prefix),
+            id_codec=dataset.id_codec,
+            metadata=dict(
+                threshold=answers[0].threshold,
+                probs_field=answers[0].probs_field,
+            ),
+        )
 
     # find threshold for each requested metric
     if args.find_threshold:
+        # count metrics (utility functions at once) in a single sweep
+        swept = [
+            metric for metric in metrics
+            if metric.has_counts and args.threshold_sketch is None
+        ]
+        best_thresholds = dict(zip(
+            map(id, swept),
+            threshold.find_best_thresholds(swept, gold_answers, answers)
+        ))
         for metric in metrics:
+            if not metric.uses_threshold:
+                continue
             if args.threshold:
                 # reset threshold to ensure fair comparison
                 apply_threshold_to_answers(answers, min_prob_pre_threshold)
 
-            best_threshold = threshold.find_best_threshold(
-                metric, gold_answers, answers
-            )
+            sketch = None
+            if args.threshold_sketch is not None and metric.has_counts:
+                sketch = threshold.sketch_best_threshold(
+                    metric,
+                    gold_answers,
+                    answers,
+                    nof_bins=args.threshold_sketch,
+                    refine=args.threshold_sketch_refine,
+                )
+                best_threshold = sketch['threshold']
+            elif id(metric) in best_thresholds:
+                best_threshold = best_thresholds[id(metric)]
+            else:
+                best_threshold = threshold.find_best_threshold(
+                    metric, gold_answers, answers
+                )
             apply_threshold_to_answers(answers, best_threshold)
             threshold_results = get_results(
                 dataset,
@@ -344,29 +1006,81 @@ def mcqa(args):
                 prefix
             )
             threshold_results['threshold'] = best_threshold
+            if sketch is not None:
+                threshold_results['threshold_error_bound'] = (
+                    sketch['error_bound']
+                )
             threshold_name = f'{metric.name}_threshold'
             results_dict.update(**{threshold_name: threshold_results})
 
-    results_str = json.dumps(obj=results_dict, indent=2) + '\n'
-    if args.output is None:
-        print(results_str)
-    else:
-        if args.merge and prev_output is not None:
-            prev_output.update(**results_dict)
-            results_str = json.dumps(obj=prev_output, indent=2) + '\n'
+    # every group under its own threshold, evaluated jointly
+    if args.group_threshold is not None:
+        threshold_metrics = [
+            metric for metric in metrics if metric.uses_threshold
+        ]
+        group_names, codes, group_thresholds = threshold.find_group_thresholds(
+            threshold_metrics,
+            gold_answers,
+            answers,
+            get_group_keys(args, dataset, gold_answers, masks),
+        )
+        for metric, metric_thresholds in zip(
+            threshold_metrics, group_thresholds
+        ):
+            apply_threshold_to_answers(answers, metric_thresholds[codes])
+            group_results = get_results(
+                dataset,
+                evaluator,
+                gold_answers,
+                answers,
+                masks,
+                prefix
+            )
+            group_results['thresholds'] = dict(
+                zip(group_names, metric_thresholds.tolist())
+            )
+            results_dict[f'{metric.name}_group_threshold'] = group_results
 
-        with open(args.output, 'w') as fout:
-            fout.write(results_str)
+    if args.risk_coverage:
+        report, curve = risk_coverage(
+            gold_answers,
+            answers,
+            metrics,
+            target_coverages=args.target_coverage,
+        )
+        results_dict['risk_coverage'] = report
+        if curve_path is not None:
+            Path(curve_path).parent.mkdir(parents=True, exist_ok=True)
+            write_curve(curve_path, curve)
 
-    if args.save_mlflow:
-        import mlflow
-        mlflow.log_metrics(results_dict)
+    if args.threshold_cv is not None:
+        folds = np.zeros(len(gold_answers), dtype=np.int64)
+        for fold, (_, test_indices) in enumerate(dataset.iter_folds(
+            gold_answers,
+            args.threshold_cv,
+            seed=args.threshold_cv_seed,
+            stratify='label',
+            group_by_context=True,
+        )):
+            folds[test_indices] = fold
+        for metric in metrics:
+            if metric.has_counts:
+                results_dict[f'{metric.name}_threshold_cv'] = (
+                    threshold.cross_validate(
+                        metric, gold_answers, answers, folds,
+                        nof_folds=args.threshold_cv,
+                    )
+                )
+
+    return results_dict
 
 
 def main():
     args = parse_flags()
     if args.info:
         print_dataset_stats(args)
+    elif args.watch is not None:
+        mcqa_watch(args)
     else:
         mcqa(args)
 
@@ -4,6 +4,7 @@ from typing import List, Optional
 from dataclasses import dataclass
 from sklearn.metrics import confusion_matrix
 from mcqa_utils.answer import Answer
+from mcqa_utils.confidence import probability_matrix, scores_matrix
 
 
 @dataclass(frozen=True)
@@ -19,6 +20,10 @@ class MetricOutput:
     false_negative: Optional[List[int]] = None
     false_positive: Optional[List[int]] = None
     true_negative: Optional[List[int]] = None
+    max_error: Optional[float] = None
+    reliability_confidence: Optional[List[float]] = None
+    reliability_accuracy: Optional[List[float]] = None
+    reliability_count: Optional[List[int]] = None
 
 
 class Metric_with_extras(object):
@@ -35,10 +40,25 @@ class Metric_with_extras(object):
 class Metric(object):
     no_answer = None
     has_extras = False
+    # whether the value can be computed from outcome counts alone
+    has_counts = False
+    # whether thresholds (abstaining) change the value
+    uses_threshold = True
+    higher_is_better = True
 
     def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
         raise NotImplementedError()
 
+    def value_from_counts(
+        self, correct, unanswered, unanswered_correct, total
+    ):
+        """
+        Metric value from outcome counts (scalars or numpy arrays): correct
+        answers, unanswered questions and unanswered questions whose no
+        answer option is the gold one.
+        """
+        raise NotImplementedError()
+
     def needs_no_answer(self):
         return self.no_answer is not None
 
@@ -50,6 +70,7 @@ class Metric_with_no_answer(Metric):
 class C_at_1(Metric_with_no_answer, Metric_with_extras):
     name = "C_at_1"
     has_extras = True
+    has_counts = True
 
     def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
         correct = 0
@@ -74,6 +95,11 @@ class C_at_1(Metric_with_no_answer, Metric_with_extras):
             unanswered=unanswered,
         )
 
+    def value_from_counts(
+        self, correct, unanswered, unanswered_correct, total
+    ):
+        return (1 / total) * (correct + (correct / total) * unanswered)
+
     def add_extras(self, results):
         must_fields = [
             self.name + "_correct",
@@ -91,42 +117,86 @@ class C_at_1(Metric_with_no_answer, Metric_with_extras):
         return results
 
 
+def utility_values(utilities, correct, unanswered, total) -> np.ndarray:
+    """
+    Several utility functions at once: the (U x 3) weights times the
+    unanswered, incorrect and correct counts (scalars or arrays, i.e.: one
+    column per threshold), over the totals. Terms are added in weight
+    order, so values match UtilityFunction's own sums.
+    """
+    weights = np.asarray(utilities, dtype=np.float64)
+    counts = [
+        np.asarray(unanswered),
+        np.asarray(total - correct - unanswered),
+        np.asarray(correct),
+    ]
+    shape = (len(weights),) + (1,) * counts[0].ndim
+    values = weights[:, 0].reshape(shape) * counts[0]
+    for column in (1, 2):
+        values = values + weights[:, column].reshape(shape) * counts[column]
+    return values / total
+
+
 class UtilityFunction(Metric_with_no_answer):
 
     name = "utility_function"
+    has_counts = True
     # unanswered, wrong, right
     utility = [0, -0.25, 1]
 
-    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+    def update_name(self):
         # save name to avoid collisions
         utility_str = '_'.join([str(u) for u in self.utility])
         self.name = f"utility_function_{utility_str}"
-        correct = 0
-        unanswered = 0
-        total = len(gold_answers)
-        for gold_ans, ans in zip(gold_answers, answers):
-            gold_value = gold_ans.get_answer()
-            answer_value = ans.get_answer()
-            if gold_value == answer_value:
-                correct += 1
-            elif answer_value == self.no_answer:
-                unanswered += 1
-        incorrect = total - correct - unanswered
-        iter_val = zip(self.utility, [unanswered, incorrect, correct])
-        value = sum([ut * val for ut, val in iter_val]) / total
 
-        return MetricOutput(
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        return evaluate_utilities([self], gold_answers, answers)[0]
+
+    def value_from_counts(
+        self, correct, unanswered, unanswered_correct, total
+    ):
+        self.update_name()
+        return utility_values([self.utility], correct, unanswered, total)[0]
+
+
+def evaluate_utilities(
+    utilities: List[UtilityFunction],
+    gold_answers: List[Answer],
+    answers: List[Answer],
+) -> List[MetricOutput]:
+    # outcomes are counted once for all the utility functions
+    correct = 0
+    unanswered = 0
+    total = len(gold_answers)
+    no_answer = utilities[0].no_answer
+    for gold_ans, ans in zip(gold_answers, answers):
+        gold_value = gold_ans.get_answer()
+        answer_value = ans.get_answer()
+        if gold_value == answer_value:
+            correct += 1
+        elif answer_value == no_answer:
+            unanswered += 1
+    incorrect = total - correct - unanswered
+    values = utility_values(
+        [metric.utility for metric in utilities], correct, unanswered, total
+    )
+    outputs = []
+    for metric, value in zip(utilities, values.tolist()):
+        metric.update_name()
+        outputs.append(MetricOutput(
             value=value,
             total=total,
             correct=correct,
             incorrect=incorrect,
             unanswered=unanswered,
-        )
+        ))
+    return outputs
 
 
 class Average(Metric):
 
     name = "avg"
+    has_counts = True
 
     def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
         correct = 0
@@ -145,6 +215,15 @@ class Average(Metric):
             incorrect=incorrect,
         )
 
+    def value_from_counts(
+        self, correct, unanswered, unanswered_correct, total
+    ):
+        # unanswered questions count when their no answer option is right,
+        # unless answering no answer is accepted
+        if not self.needs_no_answer():
+            correct = correct + unanswered_correct
+        return correct / total
+
 
 class F1(Metric_with_no_answer):
 
@@ -163,6 +242,153 @@ class F1(Metric_with_no_answer):
         #     pass
 
 
+def _gold_ids(gold_answers: List[Answer]) -> np.ndarray:
+    return np.fromiter(
+        (gold.get_answer() for gold in gold_answers),
+        dtype=np.int64, count=len(gold_answers)
+    )
+
+
+def _check_scores(answers: List[Answer]):
+    if any(ans.probs is None and ans.logits is None for ans in answers):
+        raise ValueError(
+            'Calibration and ranking metrics need nbest predictions!'
+        )
+
+
+class Brier(Metric):
+    # multiclass brier score over the options, calibration metrics use
+    # the probabilities behind `probs_field` (see probability_matrix)
+
+    name = "brier"
+    uses_threshold = False
+    higher_is_better = False
+
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        _check_scores(answers)
+        probs = probability_matrix(answers)
+        gold = _gold_ids(gold_answers)
+        gold_probs = probs[np.arange(len(gold)), gold]
+        scores = (probs ** 2).sum(axis=1) - 2 * gold_probs + 1
+        return MetricOutput(value=float(scores.mean()), total=len(gold))
+
+
+class NegativeLogLikelihood(Metric):
+
+    name = "nll"
+    uses_threshold = False
+    higher_is_better = False
+    eps = 1e-15
+
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        _check_scores(answers)
+        probs = probability_matrix(answers)
+        gold = _gold_ids(gold_answers)
+        gold_probs = np.clip(probs[np.arange(len(gold)), gold], self.eps, 1)
+        return MetricOutput(
+            value=float(-np.log(gold_probs).mean()), total=len(gold)
+        )
+
+
+class CalibrationError(Metric):
+    # expected calibration error of the chosen option over equal width
+    # confidence bins, plus the maximum error and the reliability diagram
+
+    name = "ece"
+    uses_threshold = False
+    higher_is_better = False
+    nof_bins = 15
+
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        _check_scores(answers)
+        probs = probability_matrix(answers)
+        gold = _gold_ids(gold_answers)
+        confidence = probs.max(axis=1)
+        correct = probs.argmax(axis=1) == gold
+        # right closed bins, (k / nof_bins, (k + 1) / nof_bins]
+        bins = np.clip(
+            np.ceil(confidence * self.nof_bins).astype(np.int64) - 1,
+            0, self.nof_bins - 1
+        )
+        counts = np.bincount(bins, minlength=self.nof_bins)
+        seen = counts > 0
+        mean_confidence = np.zeros(self.nof_bins)
+        mean_accuracy = np.zeros(self.nof_bins)
+        np.divide(
+            np.bincount(bins, weights=confidence, minlength=self.nof_bins),
+            counts, out=mean_confidence, where=seen
+        )
+        np.divide(
+            np.bincount(bins, weights=correct, minlength=self.nof_bins),
+            counts, out=mean_accuracy, where=seen
+        )
+        gaps = np.abs(mean_accuracy - mean_confidence)
+        return MetricOutput(
+            value=float((counts * gaps).sum() / len(gold)),
+            total=len(gold),
+            max_error=float(gaps[seen].max()) if seen.any() else 0.0,
+            reliability_confidence=mean_confidence.tolist(),
+            reliability_accuracy=mean_accuracy.tolist(),
+            reliability_count=counts.tolist(),
+        )
+
+
+def gold_ranks(
+    gold_answers: List[Answer], answers: List[Answer]
+) -> np.ndarray:
+    # 1-based rank of the gold option by `probs_field` scores, ties go to
+    # the first option (as argmax): one comparison over the whole matrix
+    _check_scores(answers)
+    scores = scores_matrix(answers)
+    gold = _gold_ids(gold_answers)
+    gold_scores = scores[np.arange(len(gold)), gold][:, None]
+    before_gold = np.arange(scores.shape[1])[None, :] < gold[:, None]
+    ahead = (scores > gold_scores) | ((scores == gold_scores) & before_gold)
+    return ahead.sum(axis=1) + 1
+
+
+class TopK(Metric):
+
+    name = "top_k"
+    uses_threshold = False
+    k = 2
+
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        # save name to avoid collisions
+        self.name = f"top_{self.k}"
+        ranks = gold_ranks(gold_answers, answers)
+        correct = int((ranks <= self.k).sum())
+        return MetricOutput(
+            value=correct / len(ranks),
+            total=len(ranks),
+            correct=correct,
+            incorrect=len(ranks) - correct,
+        )
+
+
+class MeanReciprocalRank(Metric):
+
+    name = "mrr"
+    uses_threshold = False
+
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        ranks = gold_ranks(gold_answers, answers)
+        return MetricOutput(
+            value=float((1 / ranks).mean()), total=len(ranks)
+        )
+
+
+class MeanRank(Metric):
+
+    name = "mean_rank"
+    uses_threshold = False
+    higher_is_better = False
+
+    def __call__(self, gold_answers: List[Answer], answers: List[Answer]):
+        ranks = gold_ranks(gold_answers, answers)
+        return MetricOutput(value=float(ranks.mean()), total=len(ranks))
+
+
 class ConfusionMatrix(Metric):
 
     name = "confusion matrix"
@@ -176,12 +402,8 @@ class ConfusionMatrix(Metric):
             ans.get_answer(accept_no_answer=self.needs_no_answer())
             for ans in answers
         ]
+        # numpy values are serialized as is by the json codec
         tn, fp, fn, tp = confusion_matrix(true_labels, pred_labels)
-        if isinstance(tn, np.ndarray):
-            tn = tn.tolist()
-            fp = fp.tolist()
-            fn = fn.tolist()
-            tp = tp.tolist()
 
         return MetricOutput(
             value=0.0,
@@ -198,4 +420,10 @@ metrics_map = {
     "avg": Average,
     "utility_function": UtilityFunction,
     "confusion_matrix": ConfusionMatrix,
+    "brier": Brier,
+    "nll": NegativeLogLikelihood,
+    "ece": CalibrationError,
+    "top_k": TopK,
+    "mrr": MeanReciprocalRank,
+    "mean_rank": MeanRank,
 }
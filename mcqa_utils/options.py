@@ -0,0 +1,103 @@
+"""Option texts stored once, shared by examples and answers."""
+import numpy as np
+
+from typing import Dict, List, Sequence
+
+from mcqa_utils.utils import first_option
+
+
+def _compact(values: List[int]) -> np.ndarray:
+    # smallest unsigned type holding the values
+    return np.array(values, dtype=np.min_scalar_type(max(values, default=0)))
+
+
+class OptionTable(object):
+    """
+    Interned option texts: each distinct text is stored once and each row
+    (the endings of one example) is a slice of `codes` delimited by
+    `offsets`. Rows are only appended, so row indexes stay valid.
+    """
+
+    def __init__(self):
+        self.texts = []
+        self._text_codes = {}
+        self._codes = []
+        self._offsets = [0]
+        self._arrays = None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getstate__(self) -> Dict:
+        # texts go as a single string plus lengths and rows as arrays, a
+        # few pickle objects whatever the size; lookups are rebuilt later
+        return dict(
+            texts=''.join(self.texts),
+            text_lengths=_compact([len(text) for text in self.texts]),
+            codes=_compact(self._codes),
+            offsets=_compact(self._offsets),
+        )
+
+    def __setstate__(self, state: Dict):
+        ends = np.cumsum(state['text_lengths'], dtype=np.int64).tolist()
+        starts = [0] + ends[:-1]
+        texts = state['texts']
+        self.texts = [texts[start:end] for start, end in zip(starts, ends)]
+        self._text_codes = None
+        self._codes = state['codes'].tolist()
+        self._offsets = state['offsets'].tolist()
+        self._arrays = None
+
+    def _intern(self, text: str) -> int:
+        if self._text_codes is None:
+            self._text_codes = {
+                text: code for code, text in enumerate(self.texts)
+            }
+        code = self._text_codes.get(text, None)
+        if code is None:
+            code = len(self.texts)
+            self._text_codes[text] = code
+            self.texts.append(text)
+        return code
+
+    def add_rows(self, endings: Sequence[Sequence[str]]) -> np.ndarray:
+        first_row = len(self)
+        for row in endings:
+            self._codes.extend(self._intern(text) for text in row)
+            self._offsets.append(len(self._codes))
+        self._arrays = None
+        return np.arange(first_row, len(self), dtype=np.int64)
+
+    def arrays(self):
+        # codes, offsets and lowercased distinct texts as numpy arrays
+        if self._arrays is None:
+            self._arrays = (
+                np.array(self._codes, dtype=np.int64),
+                np.array(self._offsets, dtype=np.int64),
+                np.array([text.lower() for text in self.texts], dtype=str),
+            )
+        return self._arrays
+
+    def row(self, index: int) -> List[str]:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return [self.texts[code] for code in self._codes[start:end]]
+
+    def text_positions(self, rows: np.ndarray, text: str) -> np.ndarray:
+        # per row, first option equal to `text` (case insensitive), -1 if
+        # none; compared once per distinct text
+        codes, offsets, lower_texts = self.arrays()
+        matches = (lower_texts == text.lower())[codes]
+        return first_option(matches, offsets)[rows]
+
+    def gold_contains(
+        self, rows: np.ndarray, labels: np.ndarray, text: str
+    ) -> np.ndarray:
+        # whether the option at `labels` (-1 for none) contains `text`
+        codes, offsets, lower_texts = self.arrays()
+        contains = np.char.find(lower_texts, text.lower()) != -1
+        labeled = labels >= 0
+        mask = np.zeros(len(rows), dtype=bool)
+        mask[labeled] = contains[
+            codes[offsets[rows[labeled]] + labels[labeled]]
+        ]
+        return mask
@@ -0,0 +1,144 @@
+"""Per question outcomes, exported as Arrow IPC or Parquet."""
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from mcqa_utils.answer import Answer
+from mcqa_utils.ids import IdCodec
+from mcqa_utils.utils import label_to_id
+from mcqa_utils.confidence import margin, stack_field
+
+outcome_formats = {
+    '.parquet': 'parquet',
+    '.arrow': 'ipc',
+    '.ipc': 'ipc',
+    '.feather': 'ipc',
+}
+
+
+def _scores_matrix(answers: List[Answer], field: str) -> np.ndarray:
+    fill_value = -np.inf if field == 'logits' else 0.0
+    return stack_field(answers, field, fill_value=fill_value)
+
+
+def outcome_arrays(
+    gold_answers: List[Answer],
+    answers: List[Answer],
+    masks: Optional[List[List[bool]]] = None,
+    prefixes: Optional[List[str]] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Column arrays of the outcome of each question, as `Answer.get_answer`
+    decides it: the chosen option (`pred`), whether the threshold made it
+    abstain, the answer finally given (no answer when abstaining) and the
+    confidence behind it. Masks become boolean columns named by prefix.
+    """
+    nof_answers = len(answers)
+    field = answers[0].probs_field
+    no_answer = answers[0].no_answer
+    columns = dict(
+        example_id=np.fromiter(
+            (ans.example_id for ans in answers), np.int64, nof_answers
+        ),
+        gold=np.fromiter(
+            (gold.get_answer() for gold in gold_answers),
+            np.int64, nof_answers
+        ),
+    )
+    is_no_answer = np.fromiter(
+        (ans.is_no_answer for ans in answers), bool, nof_answers
+    )
+    if answers[0].probs is None and answers[0].logits is None:
+        # flat predictions, only labels
+        pred = np.fromiter(
+            (label_to_id(ans.pred_label) for ans in answers),
+            np.int64, nof_answers
+        )
+        max_prob = np.full(nof_answers, np.nan)
+        answer_margin = np.full(nof_answers, np.nan)
+        abstained = is_no_answer
+    else:
+        base_field = 'probs' if answers[0].probs is not None else 'logits'
+        base = _scores_matrix(answers, base_field)
+        if np.ndim(answers[0].get_scores()) == 0:
+            # scalar confidence, the choice comes from the base field
+            max_prob = np.fromiter(
+                (getattr(ans, field) for ans in answers),
+                np.float64, nof_answers
+            )
+            pred = base.argmax(axis=1)
+        else:
+            scores = base if field == base_field else (
+                _scores_matrix(answers, field)
+            )
+            max_prob = scores.max(axis=1)
+            pred = scores.argmax(axis=1)
+        answer_margin = (
+            margin(base) if base_field == 'probs'
+            else np.full(nof_answers, np.nan)
+        )
+        thresholds = np.fromiter(
+            (ans.threshold for ans in answers), np.float64, nof_answers
+        )
+        abstained = is_no_answer | (max_prob <= thresholds)
+
+    columns.update(
+        pred=pred,
+        answer=np.where(abstained, no_answer, pred).astype(np.int64),
+        abstained=abstained,
+        max_prob=max_prob,
+        margin=answer_margin,
+    )
+    columns['correct'] = columns['answer'] == columns['gold']
+    if masks is not None and prefixes is not None:
+        for mask, prefix in zip(masks, prefixes):
+            columns[prefix] = np.asarray(mask, dtype=bool)
+    return columns
+
+
+def write_outcomes(
+    path: str,
+    columns: Dict[str, np.ndarray],
+    id_codec: Optional[IdCodec] = None,
+    metadata: Optional[Dict[str, str]] = None,
+):
+    """
+    Writes outcome columns as Parquet or Arrow IPC (by extension). Numpy
+    arrays are handed to Arrow without copies where the types allow it,
+    contexts become a dictionary encoded column.
+    """
+    import pyarrow as pa
+
+    suffix = Path(path).suffix.lower()
+    if suffix not in outcome_formats:
+        raise ValueError(
+            f'Unknown outcomes format {suffix!r}, use one of: '
+            f'{", ".join(outcome_formats)}'
+        )
+    arrays = {}
+    example_ids = columns['example_id']
+    if id_codec is not None:
+        arrays['context'] = pa.DictionaryArray.from_arrays(
+            pa.array(id_codec.context_index(example_ids).astype(np.int32)),
+            pa.array(id_codec.context_names, type=pa.string()),
+        )
+        arrays['question'] = pa.array(
+            id_codec.question_index(example_ids).astype(np.int32)
+        )
+    for name, values in columns.items():
+        arrays[name] = pa.array(values)
+    table = pa.table(arrays)
+    if metadata is not None:
+        table = table.replace_schema_metadata(
+            {key: str(value) for key, value in metadata.items()}
+        )
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    if outcome_formats[suffix] == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    else:
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
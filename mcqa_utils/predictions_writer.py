@@ -0,0 +1,121 @@
+from typing import IO, Optional
+
+from mcqa_utils.json_codec import dumps
+from mcqa_utils.answer import Answer, unparse_answer
+from mcqa_utils.ids import IdCodec
+
+
+class PredictionsWriter(object):
+    """
+    Incrementally writes predictions to an open text stream.
+
+    Answers must arrive grouped by context (gold order is), otherwise a
+    context would be written twice. `None` answers are written as nulls to
+    keep nbest lists aligned with the dataset. With `lines=True` one record
+    per answer is written (JSONL), carrying its own id, so missing answers
+    are simply skipped.
+    """
+
+    def __init__(
+        self,
+        fstream: IO,
+        id_codec: IdCodec = None,
+        nbest: Optional[bool] = None,
+        lines: bool = False,
+    ):
+        self.fstream = fstream
+        self.id_codec = IdCodec() if id_codec is None else id_codec
+        self.nbest = nbest
+        self.lines = lines
+        self._started = False
+        self._closed = False
+        self._current_context = None
+        self._context_items = 0
+        self._flat_items = 0
+        # nulls received before the output format is known
+        self._pending_ids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _detect_format(self, answer: Optional[Answer]):
+        if self.nbest is None and answer is not None:
+            self.nbest = answer.probs is not None
+
+    def _start(self):
+        if not self._started and not self.lines:
+            self.fstream.write('{')
+        self._started = True
+
+    def write(self, example_id: int, answer: Optional[Answer]):
+        self._detect_format(answer)
+        if self.nbest is None:
+            self._pending_ids.append(example_id)
+            return
+        self._flush_pending()
+        self._write(example_id, answer)
+
+    def _flush_pending(self):
+        pending, self._pending_ids = self._pending_ids, []
+        for pending_id in pending:
+            self._write(pending_id, None)
+
+    def _write(self, example_id: int, answer: Optional[Answer]):
+        self._start()
+        if self.lines:
+            self._write_line(example_id, answer)
+        elif self.nbest:
+            self._write_nbest(example_id, answer)
+        else:
+            self._write_flat(example_id, answer)
+
+    def _write_line(self, example_id: int, answer: Optional[Answer]):
+        if answer is None:
+            return
+        record = dict(id=self.id_codec.to_str(example_id))
+        value = unparse_answer(answer)
+        if isinstance(value, dict):
+            record.update(value)
+        else:
+            record.update(pred_label=value)
+        self.fstream.write(dumps(record, compact=True) + '\n')
+
+    def _write_flat(self, example_id: int, answer: Optional[Answer]):
+        value = None if answer is None else unparse_answer(answer)
+        sep = ', ' if self._flat_items else ''
+        key = dumps(self.id_codec.to_str(example_id), compact=True)
+        self.fstream.write(f'{sep}{key}: {dumps(value, compact=True)}')
+        self._flat_items += 1
+
+    def _write_nbest(self, example_id: int, answer: Optional[Answer]):
+        context_id = self.id_codec.context_name(example_id)
+        if context_id != self._current_context:
+            sep = ''
+            if self._current_context is not None:
+                self.fstream.write(']')
+                sep = ', '
+            self._current_context = context_id
+            self._context_items = 0
+            self.fstream.write(f'{sep}{dumps(context_id, compact=True)}: [')
+        value = None if answer is None else unparse_answer(answer)
+        sep = ', ' if self._context_items else ''
+        self.fstream.write(sep + dumps(value, compact=True))
+        self._context_items += 1
+
+    def close(self):
+        if self._closed:
+            return
+        if self.nbest is None:
+            # only nulls were written, fall back to flat predictions
+            self.nbest = False
+        self._flush_pending()
+        self._start()
+        if not self.lines:
+            if self.nbest and self._current_context is not None:
+                self.fstream.write(']')
+            self.fstream.write('}\n')
+        self.fstream.flush()
+        self._closed = True
@@ -1,10 +1,18 @@
 import os
-import json
 import numpy as np
 
 from collections import defaultdict
-from typing import Union, Tuple, List
-from mcqa_utils.utils import label_to_id, id_to_label
+from typing import IO, Iterable, Iterator, List, Optional, Tuple, Union
+from mcqa_utils.ids import IdCodec
+from mcqa_utils.predictions_writer import PredictionsWriter
+from mcqa_utils.readers import predictions_format, read_predictions
+from mcqa_utils import json_codec
+from mcqa_utils.utils import (
+    flatten_options,
+    id_to_label,
+    label_to_id,
+    option_positions,
+)
 from mcqa_utils.answer import (
     parse_answer,
     unparse_answer,
@@ -12,12 +20,34 @@ from mcqa_utils.answer import (
 )
 
 
+def no_answer_positions(data: List[Answer], no_answer_text: str) -> np.ndarray:
+    # position of the `no_answer_text` option in each datapoint, -1 if none
+    table = data[0].option_table if len(data) > 0 else None
+    if table is not None and all(
+        datapoint.option_table is table for datapoint in data
+    ):
+        rows = np.fromiter(
+            (datapoint.option_row for datapoint in data),
+            dtype=np.int64, count=len(data)
+        )
+        return table.text_positions(rows, no_answer_text)
+    flat, offsets = flatten_options([datapoint.endings for datapoint in data])
+    return option_positions(flat, offsets, no_answer_text)
+
+
 class QASystem(object):
-    def __init__(self, offline: bool = True, answers_path: str = None):
+    def __init__(
+        self,
+        offline: bool = True,
+        answers_path: str = None,
+        id_codec: IdCodec = None,
+    ):
         self.answers = {}
         self.offline = offline
         self.answers_path = answers_path
         self.missing_strategy = None
+        self.missing_seed = None
+        self.id_codec = IdCodec() if id_codec is None else id_codec
         if offline and answers_path is None:
             raise ValueError(
                 'You must provide a path to the answers '
@@ -28,10 +58,22 @@ class QASystem(object):
         raise NotImplementedError(
             'You must implement `get_answer` method!')
 
+    def find_answer(self, example_id: Union[str, int]) -> Optional[Answer]:
+        # plain lookup, without filling missing answers
+        try:
+            return self.get_answer(example_id)
+        except ValueError:
+            return None
+
     def fill_missing(self, example_id: Union[str, int]):
         raise NotImplementedError(
             'You must implement `fill_missing` method!')
 
+    def fill_missing_answers(
+        self, example_ids: List[Union[str, int]]
+    ) -> List[Answer]:
+        return [self.fill_missing(example_id) for example_id in example_ids]
+
     def get_answers(
         self,
         data: List[Answer],
@@ -51,17 +93,34 @@ class QASystem(object):
                 ' pass `dataset.get_gold_answers(with_text_values=True) to '
                 'parse text endings in dataset!'
             )
+        missing_positions = []
         for datapoint in data:
-            try:
-                answer = self.get_answer(datapoint.example_id)
-                if with_text_values:
-                    answer.endings = datapoint.endings
+            answer = self.find_answer(datapoint.example_id)
+            if answer is None:
+                missing_positions.append(len(answers))
+            answers.append(answer)
+
+        # missing answers are filled at once, after alignment
+        if len(missing_positions) > 0:
+            missing_ids = [data[pos].example_id for pos in missing_positions]
+            if self.missing_strategy is not None:
+                filled = self.fill_missing_answers(missing_ids)
+                for pos, answer in zip(missing_positions, filled):
+                    answers[pos] = answer
+            else:
+                not_found = missing_ids
+
+        if with_text_values:
+            # resolved once for all the answers, endings stay in the data
+            positions = no_answer_positions(data, no_answer_text)
+            for answer, position in zip(answers, positions.tolist()):
+                if answer is not None:
+                    answer.no_answer_option = position
                     answer.no_answer_text = no_answer_text
-                answers.append(answer)
-            except ValueError:
-                not_found.append(datapoint.example_id)
-            except NotImplementedError as ex:
-                raise ex
+
+        if len(not_found) > 0:
+            answers = [answer for answer in answers if answer is not None]
+
         return answers, not_found
 
     def get_all_answers(self) -> List[Answer]:
@@ -70,64 +129,95 @@ class QASystem(object):
 
 class QASystemForMCOffline(QASystem):
 
-    def __init__(self, answers_path: str):
+    def __init__(self, answers_path: str, id_codec: IdCodec = None):
         offline = True
-        super(QASystemForMCOffline, self).__init__(offline, answers_path)
-        raw_answers = self.load_predictions(self.answers_path)
-        self.answers = self.parse_predictions(raw_answers)
+        super(QASystemForMCOffline, self).__init__(
+            offline, answers_path, id_codec
+        )
+        if predictions_format(self.answers_path) == 'json':
+            raw_answers = self.load_predictions(self.answers_path)
+            self.answers = self.parse_predictions(raw_answers)
+        else:
+            # line delimited and columnar predictions, by extension
+            self.answers = read_predictions(self.answers_path, self.id_codec)
+        self._nof_choices = None
+        self._missing_rng = None
+
+    def find_answer(self, example_id: Union[str, int]) -> Optional[Answer]:
+        return self.answers.get(self.id_codec.as_id(example_id), None)
 
     def get_answer(self, example_id: Union[str, int]) -> Answer:
-        # answers are in a dict, ensure string index access
-        example_id = str(example_id)
+        # answers are in a dict, ensure packed integer index access
+        example_id = self.id_codec.as_id(example_id)
         if example_id not in self.answers:
-            answer = None
-            if self.missing_strategy is not None:
-                answer = self.fill_missing(example_id, self.get_nof_choices())
-            if answer is not None:
-                self.answers[example_id] = answer
-            else:
+            if self.missing_strategy is None:
                 raise ValueError('Example not found %r' % example_id)
+            self.fill_missing_answers([example_id])
 
         return self.answers[example_id]
 
     def get_nof_choices(self) -> int:
-        first_answer = self.answers[list(self.answers.keys())[0]]
-        if first_answer.probs is not None:
-            max_value = len(first_answer.probs)
+        # cached, without probs every answer has to be scanned
+        if self._nof_choices is None:
+            first_answer = next(iter(self.answers.values()))
+            if first_answer.probs is not None:
+                self._nof_choices = len(first_answer.probs)
+            else:
+                self._nof_choices = 1 + max(
+                    label_to_id(ans.pred_label)
+                    for ans in self.answers.values()
+                )
+        return self._nof_choices
+
+    def get_missing_rng(self) -> np.random.Generator:
+        if self._missing_rng is None:
+            self._missing_rng = np.random.default_rng(self.missing_seed)
+        return self._missing_rng
+
+    def missing_probs(self, nof_missing: int, nof_choices: int) -> np.ndarray:
+        # one (missing x choices) array for the whole batch
+        strategy = self.missing_strategy.lower()
+        rng = self.get_missing_rng()
+        if strategy == 'uniform':
+            size = (nof_missing, nof_choices)
+            probs = rng.uniform(low=0, high=1.0, size=size)
+            probs /= probs.sum(axis=1, keepdims=True)
+        elif strategy == 'random':
+            probs = np.zeros((nof_missing, nof_choices))
+            values = rng.integers(nof_choices, size=nof_missing)
+            probs[np.arange(nof_missing), values] = 1.0
         else:
-            max_value = -1
-            for ans in self.answers.values():
-                ans_value = label_to_id(ans.pred_label)
-                if ans_value > max_value:
-                    max_value = ans_value
-        return max_value
+            value = float(self.missing_strategy)
+            probs = np.full((nof_missing, nof_choices), value)
+            if value > 0:
+                probs /= nof_choices * value
+        return probs
 
     def fill_missing(
-        self, example_id: Union[str, int], nof_choices: int
+        self, example_id: Union[str, int], nof_choices: int = None
     ) -> Answer:
-        answer_dict = dict(
-            example_id=example_id,
-        )
-        if self.missing_strategy.lower() == 'uniform':
-            probs = np.random.uniform(low=0, high=1.0, size=(nof_choices))
-            probs /= sum(probs)
-        else:
-            if self.missing_strategy.lower() == 'random':
-                value = np.random.randint(nof_choices)
-                probs = np.zeros(nof_choices)
-                probs[value] = 1.0
-            else:
-                value = int(self.missing_strategy)
-                probs = np.array([value] * nof_choices)
-                if sum(probs) > 0:
-                    probs /= sum(probs)
-
-        answer_dict.update(
-            probs=probs.tolist(),
-            pred_label=id_to_label(np.argmax(probs))
-        )
+        return self.fill_missing_answers([example_id], nof_choices)[0]
 
-        return Answer(**answer_dict)
+    def fill_missing_answers(
+        self, example_ids: List[Union[str, int]], nof_choices: int = None
+    ) -> List[Answer]:
+        if nof_choices is None:
+            nof_choices = self.get_nof_choices()
+        probs = self.missing_probs(len(example_ids), nof_choices)
+        pred_labels = probs.argmax(axis=1)
+        filled = []
+        for example_id, answer_probs, pred_label in zip(
+            example_ids, probs.tolist(), pred_labels
+        ):
+            example_id = self.id_codec.as_id(example_id)
+            answer = Answer(
+                example_id=example_id,
+                probs=answer_probs,
+                pred_label=id_to_label(pred_label),
+            )
+            self.answers[example_id] = answer
+            filled.append(answer)
+        return filled
 
     def parse_predictions(self, raw_answers: dict) -> dict:
         answers = {}
@@ -144,35 +234,47 @@ class QASystemForMCOffline(QASystem):
                 for answer_id, answer_value in enumerate(context_answers):
                     if answer_value is None:
                         continue
-                    if answer_id < 10:
-                        answer_id = f'0{answer_id}'
-                    qas_id = f'{context_id}-{answer_id}'
+                    qas_id = self.id_codec.encode(context_id, answer_id)
                     answers[qas_id] = parse_answer(qas_id, answer_value)
         else:
             for ans_id, ans_value in raw_answers.items():
                 if ans_value is None:
                     continue
-                answers[ans_id] = parse_answer(ans_id, ans_value)
+                qas_id = self.id_codec.from_str(ans_id)
+                answers[qas_id] = parse_answer(qas_id, ans_value)
 
         return answers
 
+    def iter_aligned_answers(
+        self, gold_answers: Iterable[Answer], answers: Iterable[Answer]
+    ) -> Iterator[Tuple[int, Optional[Answer]]]:
+        # walk gold answers pairing them with answers in the same order,
+        # yielding None where an answer is missing
+        answers = iter(answers)
+        answer = next(answers, None)
+        for gold in gold_answers:
+            if answer is None or answer.example_id != gold.example_id:
+                yield gold.example_id, None
+            else:
+                yield gold.example_id, answer
+                answer = next(answers, None)
+
     def unparse_predictions(self, answers: list = None) -> dict:
         if answers is None:
             answers = self.get_all_answers()
-        first_answer = answers[0]
-        if isinstance(unparse_answer(first_answer), (int, str)):
+        if answers[0].probs is None:
             output_dict = {}
             is_nbest_predictions = False
         else:
             output_dict = defaultdict(list)
             is_nbest_predictions = True
-        # ids come as <ans_id>-<ex_id> because a context has multiple answers
-        for answer_id, ans in enumerate(answers):
-            ans_id = str(ans.example_id)
+        # ids are packed (context, question), only stringified for output
+        for ans in answers:
             if is_nbest_predictions:
-                ans_id = str(ans_id).split('-')[0]
+                ans_id = self.id_codec.context_name(ans.example_id)
                 output_dict[ans_id].append(unparse_answer(ans))
             else:
+                ans_id = self.id_codec.to_str(ans.example_id)
                 output_dict[ans_id] = unparse_answer(ans)
 
         return output_dict
@@ -182,37 +284,45 @@ class QASystemForMCOffline(QASystem):
     ) -> dict:
         if answers is None:
             answers = self.get_all_answers()
-        first_answer = answers[0]
-        if isinstance(unparse_answer(first_answer), (int, str)):
+        if answers[0].probs is None:
             output_dict = {}
             is_nbest_predictions = False
         else:
             output_dict = defaultdict(list)
             is_nbest_predictions = True
-        # ids come as <ans_id>-<ex_id> because a context has multiple answers
+        # ids are packed (context, question), only stringified for output
         # traverse gold answers searching for valid answers and filling nulls
-        answer_index = 0
-        for gold in gold_answers:
-            gold_id = str(gold.example_id)
-            if (
-                answer_index >= len(answers) or
-                str(answers[answer_index].example_id) != gold_id
-            ):
-                to_append = None
-            else:
-                to_append = unparse_answer(answers[answer_index])
-                answer_index += 1
-
+        aligned = self.iter_aligned_answers(gold_answers, answers)
+        for gold_id, answer in aligned:
+            to_append = None if answer is None else unparse_answer(answer)
             if is_nbest_predictions:
-                gold_id = str(gold_id).split('-')[0]
-                output_dict[gold_id].append(to_append)
+                output_id = self.id_codec.context_name(gold_id)
+                output_dict[output_id].append(to_append)
             else:
-                output_dict[gold_id] = to_append
+                output_id = self.id_codec.to_str(gold_id)
+                output_dict[output_id] = to_append
 
         return output_dict
 
+    def write_predictions(
+        self,
+        fstream: IO,
+        answers: Iterable[Answer] = None,
+        gold_answers: Iterable[Answer] = None,
+        lines: bool = False,
+    ):
+        # streaming counterpart of unparse_predictions(_with_alignment),
+        # answers can be any iterable and are never held in memory
+        if answers is None:
+            answers = self.answers.values()
+        if gold_answers is None:
+            aligned = ((ans.example_id, ans) for ans in answers)
+        else:
+            aligned = self.iter_aligned_answers(gold_answers, answers)
+        with PredictionsWriter(fstream, self.id_codec, lines=lines) as writer:
+            for example_id, answer in aligned:
+                writer.write(example_id, answer)
+
     def load_predictions(self, path: str) -> dict:
         full_path = os.path.abspath(path)
-        with open(full_path, 'r') as fstream:
-            answers = json.load(fstream)
-        return answers
+        return json_codec.load(full_path)
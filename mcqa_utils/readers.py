@@ -0,0 +1,165 @@
+"""Readers for predictions stored as JSON lines, Parquet or Arrow IPC."""
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from mcqa_utils import json_codec
+from mcqa_utils.ids import IdCodec
+from mcqa_utils.utils import argmax, id_to_label
+from mcqa_utils.answer import Answer, parse_answer
+
+prediction_formats = {
+    '.json': 'json',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.parquet': 'parquet',
+    '.arrow': 'ipc',
+    '.ipc': 'ipc',
+    '.feather': 'ipc',
+}
+
+
+def predictions_format(path: str) -> str:
+    # unknown extensions are read as (nbest) JSON, as always
+    return prediction_formats.get(Path(path).suffix.lower(), 'json')
+
+
+def read_jsonl_records(path: str) -> Iterator[Dict]:
+    with open(path, 'rb') as fin:
+        for line in fin:
+            if len(line.strip()) > 0:
+                yield json_codec.loads(line)
+
+
+def parse_prediction_records(
+    records: Iterable[Dict], id_codec: IdCodec
+) -> Dict[int, Answer]:
+    """
+    Records as written by `PredictionsWriter(lines=True)`: an `id`
+    (`<context>-<question>`) plus either the answer fields (`pred_label`,
+    `probs`, `logits`, `label`) or just a `pred_label`.
+    """
+    answers = {}
+    for record in records:
+        example_id = id_codec.as_id(record['id'])
+        if record.get('probs', None) is not None:
+            value = record
+        else:
+            value = record.get('pred_label', None)
+        if value is None:
+            continue
+        answers[example_id] = parse_answer(example_id, value)
+    return answers
+
+
+def read_arrow_table(path: str, format: Optional[str] = None):
+    import pyarrow as pa
+
+    format = predictions_format(path) if format is None else format
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(path, memory_map=True)
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _list_column(table, name: str) -> Optional[List[Optional[np.ndarray]]]:
+    # list<float> column to per row numpy views of the values buffer (no
+    # copy for columns without null values), split by the list offsets
+    if name not in table.column_names:
+        return None
+    column = table.column(name).combine_chunks()
+    if column.null_count == len(column):
+        return None
+    values = column.flatten().to_numpy(zero_copy_only=False)
+    offsets = column.offsets.to_numpy()
+    offsets = offsets - offsets[0]
+    lengths = np.diff(offsets)
+    if len(lengths) > 0 and np.all(lengths == lengths[0]) and lengths[0] > 0:
+        rows = list(values.reshape(len(lengths), lengths[0]))
+    else:
+        rows = np.split(values, offsets[1:-1])
+    if column.null_count > 0:
+        is_null = column.is_null().to_numpy(zero_copy_only=False)
+        rows = [None if null else row for row, null in zip(rows, is_null)]
+    return rows
+
+
+def _table_example_ids(table, id_codec: IdCodec) -> np.ndarray:
+    names = table.column_names
+    if 'id' in names:
+        return np.fromiter(
+            (id_codec.as_id(str(value)) for value in
+             table.column('id').to_pylist()),
+            np.int64, table.num_rows
+        )
+    if 'context' in names and 'question' in names:
+        # contexts are interned once per distinct value, as dumped by
+        # --dump_outcomes
+        context = table.column('context').combine_chunks()
+        if not hasattr(context, 'dictionary'):
+            context = context.dictionary_encode()
+        context_index = np.array([
+            id_codec.intern_context(name)
+            for name in context.dictionary.to_pylist()
+        ], dtype=np.int64)
+        questions = table.column('question').to_numpy().astype(np.int64)
+        if np.any(questions < 0) or np.any(questions > id_codec.question_mask):
+            raise ValueError('Question id out of range in predictions!')
+        contexts = context_index[
+            context.indices.to_numpy(zero_copy_only=False)
+        ]
+        return (contexts << id_codec.question_bits) | questions
+    raise ValueError(
+        'Predictions need an `id` column or `context` and `question` '
+        'columns!'
+    )
+
+
+def parse_prediction_table(table, id_codec: IdCodec) -> Dict[int, Answer]:
+    """
+    Columnar predictions: ids (see `_table_example_ids`), `pred_label`,
+    `probs` and `logits` list columns and `label`. Rows without a label
+    nor probs are skipped, as nulls in nbest JSON.
+    """
+    nof_rows = table.num_rows
+    example_ids = _table_example_ids(table, id_codec).tolist()
+    probs = _list_column(table, 'probs')
+    logits = _list_column(table, 'logits')
+    names = table.column_names
+    pred_labels = (
+        table.column('pred_label').to_pylist() if 'pred_label' in names
+        else [None] * nof_rows
+    )
+    labels = (
+        table.column('label').to_pylist() if 'label' in names
+        else [None] * nof_rows
+    )
+    answers = {}
+    for row, example_id in enumerate(example_ids):
+        row_probs = probs[row] if probs is not None else None
+        row_logits = logits[row] if logits is not None else None
+        pred_label = pred_labels[row]
+        if pred_label is None and row_probs is not None:
+            pred_label = id_to_label(argmax(row_probs))
+        if pred_label is None:
+            continue
+        answers[example_id] = Answer(
+            example_id=example_id,
+            pred_label=pred_label,
+            label=labels[row],
+            probs=row_probs,
+            logits=row_logits,
+        )
+    return answers
+
+
+def read_predictions(path: str, id_codec: IdCodec) -> Dict[int, Answer]:
+    # JSON predictions keep going through QASystemForMCOffline
+    format = predictions_format(path)
+    if format == 'jsonl':
+        return parse_prediction_records(read_jsonl_records(path), id_codec)
+    if format in ('parquet', 'ipc'):
+        return parse_prediction_table(read_arrow_table(path, format), id_codec)
+    raise ValueError('Not a line or columnar predictions file %r' % path)
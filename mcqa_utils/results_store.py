@@ -0,0 +1,291 @@
+"""Indexed SQLite store for evaluation results."""
+import sys
+import time
+import sqlite3
+import argparse
+
+from numbers import Number
+from typing import Dict, Iterator, List, Optional
+
+from mcqa_utils import json_codec
+from mcqa_utils.ensemble import ensemble_methods
+from mcqa_utils.utils import iter_results
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created REAL NOT NULL,
+        file TEXT NOT NULL,
+        split TEXT,
+        predictions TEXT,
+        dataset TEXT,
+        flags TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS metrics (
+        run_id INTEGER NOT NULL REFERENCES runs(run_id),
+        position INTEGER NOT NULL,
+        file TEXT NOT NULL,
+        split TEXT,
+        grp TEXT NOT NULL,
+        mask TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        threshold REAL,
+        value,
+        value_json TEXT,
+        path TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS metrics_run ON metrics(run_id)',
+    'CREATE INDEX IF NOT EXISTS metrics_file ON metrics(file)',
+    'CREATE INDEX IF NOT EXISTS metrics_split ON metrics(split)',
+    'CREATE INDEX IF NOT EXISTS metrics_metric ON metrics(metric)',
+    'CREATE INDEX IF NOT EXISTS metrics_threshold ON metrics(threshold)',
+    'CREATE INDEX IF NOT EXISTS runs_file ON runs(file)',
+]
+
+
+def _group_threshold(results: Dict, group: str) -> Optional[float]:
+    # threshold_<value> groups (-t) and <metric>_threshold groups (-ft)
+    if group.startswith('threshold_'):
+        try:
+            return float(group[len('threshold_'):])
+        except ValueError:
+            return None
+    if group.endswith('_threshold') and isinstance(results[group], dict):
+        threshold = results[group].get('threshold', None)
+        if isinstance(threshold, Number):
+            return float(threshold)
+    return None
+
+
+def _is_group(key: str) -> bool:
+    # top level sub-results that are not masks (has_ans, no_has_ans...)
+    return (
+        key.startswith('threshold_') or
+        key.endswith('_threshold') or
+        key.endswith('_threshold_cv') or
+        key in ('expected_fill', 'ensemble_selection', 'risk_coverage') or
+        key in ensemble_methods
+    )
+
+
+def results_to_rows(results: Dict) -> Iterator[Dict]:
+    thresholds = {}
+    for position, (path, value) in enumerate(iter_results(results)):
+        group = path[0] if len(path) > 1 and _is_group(path[0]) else ''
+        if group not in thresholds:
+            thresholds[group] = (
+                _group_threshold(results, group) if group else None
+            )
+        inner = path[1:-1] if group else path[:-1]
+        row = dict(
+            position=position,
+            grp=group,
+            mask='.'.join(inner),
+            metric=path[-1],
+            threshold=thresholds[group],
+            value=None,
+            value_json=None,
+            path=json_codec.dumps(list(path), compact=True),
+        )
+        # value has no column affinity, ints are kept as ints (booleans
+        # go as JSON, sqlite would turn them into ints)
+        if isinstance(value, Number) and not isinstance(
+            value, (bool, complex)
+        ):
+            row['value'] = value
+        else:
+            row['value_json'] = json_codec.dumps(value, compact=True)
+        yield row
+
+
+class ResultsStore(object):
+    """
+    Appends each run's flattened results to a SQLite database (WAL mode,
+    so several writers can append concurrently). `export` rebuilds the
+    JSON document `--merge` would have produced for a results file.
+    """
+
+    def __init__(self, path: str, timeout: float = 60.0):
+        self.path = path
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in schema:
+            self.conn.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def add_run(
+        self,
+        results: Dict,
+        file: str = '',
+        split: Optional[str] = None,
+        predictions: Optional[str] = None,
+        dataset: Optional[str] = None,
+        flags: Optional[Dict] = None,
+    ) -> int:
+        file = '' if file is None else str(file)
+        flags_json = None
+        if flags is not None:
+            flags_json = json_codec.dumps(flags, compact=True)
+        rows = list(results_to_rows(results))
+        # BEGIN IMMEDIATE takes the write lock up front, avoiding
+        # deadlocked upgrades between concurrent writers
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = self.conn.execute(
+                'INSERT INTO runs (created, file, split, predictions, '
+                'dataset, flags) VALUES (?, ?, ?, ?, ?, ?)',
+                (time.time(), file, split, predictions, dataset, flags_json)
+            )
+            run_id = cursor.lastrowid
+            self.conn.executemany(
+                'INSERT INTO metrics (run_id, position, file, split, grp, '
+                'mask, metric, threshold, value, value_json, path) VALUES '
+                '(:run_id, :position, :file, :split, :grp, :mask, :metric, '
+                ':threshold, :value, :value_json, :path)',
+                (
+                    dict(row, run_id=run_id, file=file, split=split)
+                    for row in rows
+                )
+            )
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return run_id
+
+    def query(
+        self,
+        run_id: Optional[int] = None,
+        file: Optional[str] = None,
+        split: Optional[str] = None,
+        metric: Optional[str] = None,
+        threshold: Optional[float] = None,
+        group: Optional[str] = None,
+        mask: Optional[str] = None,
+    ) -> List[Dict]:
+        filters = dict(
+            run_id=run_id,
+            file=file,
+            split=split,
+            metric=metric,
+            threshold=threshold,
+            grp=group,
+            mask=mask,
+        )
+        clauses = [f'{key} = :{key}' for key, value in filters.items()
+                   if value is not None]
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        cursor = self.conn.execute(
+            'SELECT run_id, file, split, grp, mask, metric, threshold, '
+            f'value, value_json FROM metrics{where} '
+            'ORDER BY run_id, position',
+            filters
+        )
+        rows = []
+        for row in cursor:
+            row = dict(row)
+            value_json = row.pop('value_json')
+            if value_json is not None:
+                row['value'] = json_codec.loads(value_json)
+            rows.append(row)
+        return rows
+
+    def export(self, file: str = '') -> Dict:
+        # later runs update earlier ones, as --merge does
+        output = {}
+        cursor = self.conn.execute(
+            'SELECT run_id, path, value, value_json FROM metrics '
+            'WHERE file = ? ORDER BY run_id, position', (file,)
+        )
+        current_run, run_results = None, {}
+        for row in cursor:
+            if row['run_id'] != current_run:
+                output.update(**run_results)
+                current_run, run_results = row['run_id'], {}
+            path = json_codec.loads(row['path'])
+            value = row['value']
+            if row['value_json'] is not None:
+                value = json_codec.loads(row['value_json'])
+            node = run_results
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+            node[path[-1]] = value
+        output.update(**run_results)
+        return output
+
+    def files(self) -> List[str]:
+        cursor = self.conn.execute('SELECT DISTINCT file FROM runs')
+        return [row['file'] for row in cursor]
+
+
+def parse_flags():
+    parser = argparse.ArgumentParser(
+        description='Query or export results stored with --results_db'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    query = subparsers.add_parser('query', help='Print matching results')
+    query.add_argument('--run_id', type=int, default=None)
+    query.add_argument('--split', default=None)
+    query.add_argument('--metric', default=None)
+    query.add_argument('--threshold', type=float, default=None)
+    query.add_argument('--group', default=None)
+    query.add_argument('--mask', default=None)
+    export = subparsers.add_parser(
+        'export', help='Rebuild the JSON results document of a file'
+    )
+    export.add_argument(
+        '-o', '--output', default=None,
+        help='Where to write the document (default = stdout)'
+    )
+    export.add_argument('--compact', action='store_true')
+    for subparser in (query, export):
+        subparser.add_argument(
+            'database', help='SQLite database given to --results_db'
+        )
+        subparser.add_argument(
+            '-f', '--file', default=None,
+            help='Results file (the --output given when storing)'
+        )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_flags()
+    with ResultsStore(args.database) as store:
+        if args.command == 'query':
+            rows = store.query(
+                run_id=args.run_id,
+                file=args.file,
+                split=args.split,
+                metric=args.metric,
+                threshold=args.threshold,
+                group=args.group,
+                mask=args.mask,
+            )
+            for row in rows:
+                sys.stdout.write(json_codec.dumps(row, compact=True) + '\n')
+        else:
+            file = '' if args.file is None else args.file
+            output = store.export(file)
+            results_str = json_codec.dumps(output, compact=args.compact)
+            if args.output is None:
+                print(results_str)
+            else:
+                with open(args.output, 'w') as fout:
+                    fout.write(results_str + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+import sys
+import queue
+import atexit
+import threading
+
+from numbers import Number
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from mcqa_utils import json_codec
+from mcqa_utils.utils import flatten_results
+from mcqa_utils.results_store import ResultsStore
+
+
+def _raise_first(errors: List[Exception]):
+    if len(errors) > 0:
+        for ex in errors[1:]:
+            print(f'Result sink error: {ex!r}', file=sys.stderr)
+        raise errors[0]
+
+
+class ResultSink(object):
+
+    def write(self, results: Dict, **metadata):
+        raise NotImplementedError('You must implement `write` method!')
+
+    def flush(self):
+        pass
+
+    def close(self, failed: bool = False):
+        # failed: closed after an error, sinks may record the outcome
+        self.flush()
+
+
+class StdoutSink(ResultSink):
+
+    def __init__(self, compact: bool = False):
+        self.compact = compact
+
+    def write(self, results: Dict, **metadata):
+        print(json_codec.dumps(results, compact=self.compact) + '\n')
+
+
+class FileSink(ResultSink):
+
+    def __init__(
+        self,
+        path: str,
+        overwrite: bool = False,
+        merge: bool = False,
+        compact: bool = False,
+    ):
+        self.path = path
+        self.merge = merge
+        self.compact = compact
+        output_file = Path(path)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        if output_file.exists() and not overwrite and not merge:
+            raise RuntimeError(
+                'Output file already exists!\n'
+                'Pass --overwrite or --merge to overcome'
+            )
+
+    def write(self, results: Dict, **metadata):
+        if self.merge and Path(self.path).exists():
+            prev_output = json_codec.load(self.path)
+            prev_output.update(**results)
+            results = prev_output
+        with open(self.path, 'w') as fout:
+            fout.write(json_codec.dumps(results, compact=self.compact) + '\n')
+
+
+class JsonLinesSink(ResultSink):
+    """
+    Appends one compact record per results document (to stdout when no
+    path is given), holding the requested metadata `fields` and the
+    results themselves.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        fields: Tuple[str, ...] = ('predictions', 'hash'),
+        overwrite: bool = False,
+    ):
+        self.path = path
+        self.fields = fields
+        if path is not None:
+            output_file = Path(path)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            if overwrite and output_file.exists():
+                output_file.unlink()
+
+    def write(self, results: Dict, **metadata):
+        record = {
+            field: metadata[field] for field in self.fields
+            if field in metadata
+        }
+        record['results'] = results
+        line = json_codec.dumps(record, compact=True)
+        if self.path is None:
+            print(line, flush=True)
+        else:
+            # reopened on each write, records already written survive
+            # an interrupted run
+            with open(self.path, 'a') as fout:
+                fout.write(line + '\n')
+
+    def read_field(self, field: str) -> Iterator:
+        if self.path is None or not Path(self.path).exists():
+            return
+        with open(self.path, 'r') as fin:
+            for line in fin:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    record = json_codec.loads(line)
+                except ValueError:
+                    # partial record from an interrupted write
+                    continue
+                if field in record:
+                    yield record[field]
+
+
+class SQLiteSink(ResultSink):
+
+    def __init__(self, path: str, file: Optional[str] = None):
+        self.path = path
+        self.file = file
+        # sqlite connections are bound to the thread that uses them
+        self._store = None
+
+    def write(self, results: Dict, **metadata):
+        if self._store is None:
+            self._store = ResultsStore(self.path)
+        self._store.add_run(
+            results,
+            file=metadata.get('file', self.file),
+            split=metadata.get('split', None),
+            predictions=metadata.get('predictions', None),
+            dataset=metadata.get('dataset', None),
+            flags=metadata.get('flags', None),
+        )
+
+    def close(self, failed: bool = False):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+class MlflowSink(ResultSink):
+    """
+    Logs flattened (dotted keys) numeric results to mlflow in batches. A
+    file backed store (`tracking_uri='file:///path/to/mlruns'`) can be
+    used to test without a tracking server.
+
+    The run is resolved on the creating thread: the caller's active run if
+    any (mlflow keeps active runs per thread, and writes may come from an
+    AsyncSink thread), otherwise a new run that is terminated on close.
+    Runs are created and ended through the client, from any thread, and
+    end as FAILED when the sink is closed after an error.
+    """
+
+    # mlflow rejects batches with more metrics than this
+    max_batch_size = 1000
+
+    def __init__(
+        self,
+        tracking_uri: Optional[str] = None,
+        run_id: Optional[str] = None,
+        batch_size: int = max_batch_size,
+    ):
+        import mlflow
+        from mlflow.tracking import MlflowClient
+
+        if tracking_uri is not None:
+            mlflow.set_tracking_uri(tracking_uri)
+        self.mlflow = mlflow
+        self.client = MlflowClient()
+        self.batch_size = min(batch_size, self.max_batch_size)
+        self._created_run = False
+        if run_id is None:
+            run = mlflow.active_run()
+            if run is None:
+                run = self.client.create_run(self._experiment_id())
+                self._created_run = True
+            run_id = run.info.run_id
+        self.run_id = run_id
+
+    def _experiment_id(self) -> str:
+        # the experiment start_run would use (set_experiment, environment)
+        try:
+            from mlflow.tracking.fluent import _get_experiment_id
+        except ImportError:
+            return '0'
+        experiment_id = _get_experiment_id()
+        return '0' if experiment_id is None else experiment_id
+
+    def write(self, results: Dict, step: int = 0, **metadata):
+        from mlflow.entities import Metric
+
+        timestamp = int(self.mlflow.utils.time.get_current_time_millis())
+        metrics = [
+            Metric(key, float(value), timestamp, step)
+            for key, value in flatten_results(results).items()
+            if isinstance(value, Number) and not isinstance(value, bool)
+        ]
+        for start in range(0, len(metrics), self.batch_size):
+            self.client.log_batch(
+                self.run_id, metrics=metrics[start:start + self.batch_size]
+            )
+
+    def close(self, failed: bool = False):
+        if self._created_run:
+            self.client.set_terminated(
+                self.run_id, status='FAILED' if failed else 'FINISHED'
+            )
+            self._created_run = False
+
+
+class AsyncSink(ResultSink):
+    """
+    Hands results to a background thread that writes them to `sink`. The
+    queue is bounded, so a slow sink applies back pressure instead of
+    growing memory. Pending results are flushed on close (and at exit).
+    """
+
+    _stop = object()
+
+    def __init__(self, sink: ResultSink, max_queue: int = 64):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.errors = []
+        self._closed = False
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is self._stop:
+                    self.sink.close(
+                        failed=self._failed or len(self.errors) > 0
+                    )
+                    return
+                results, metadata = item
+                self.sink.write(results, **metadata)
+            except Exception as ex:
+                self.errors.append(ex)
+            finally:
+                self.queue.task_done()
+
+    def write(self, results: Dict, **metadata):
+        if self._closed:
+            raise RuntimeError('Writing to a closed sink!')
+        self.queue.put((results, metadata))
+
+    def flush(self):
+        self.queue.join()
+        self._raise_errors()
+
+    def close(self, failed: bool = False):
+        if self._closed:
+            return
+        self._closed = True
+        self._failed = failed
+        self.queue.put(self._stop)
+        self._thread.join()
+        atexit.unregister(self.close)
+        self._raise_errors()
+
+    def _raise_errors(self):
+        errors, self.errors = self.errors, []
+        _raise_first(errors)
+
+
+class MultiSink(ResultSink):
+
+    def __init__(self, sinks: List[ResultSink]):
+        self.sinks = sinks
+
+    def write(self, results: Dict, **metadata):
+        for sink in self.sinks:
+            sink.write(results, **metadata)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self, failed: bool = False):
+        # every sink is closed (so flushed), even after one of them fails
+        errors = []
+        for sink in self.sinks:
+            try:
+                sink.close(failed=failed)
+            except Exception as ex:
+                errors.append(ex)
+        _raise_first(errors)
@@ -1,22 +1,405 @@
+import csv
+import numpy as np
 import concurrent.futures as cf
 
 from functools import partial
 
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
-from mcqa_utils.metric import Metric
+from mcqa_utils.metric import Metric, C_at_1, UtilityFunction, utility_values
 from mcqa_utils.evaluate import Evaluator
-from mcqa_utils.utils import argmax, unique, flatten
+from mcqa_utils.utils import argmax, unique, flatten, label_to_id
 from mcqa_utils.answer import Answer, apply_threshold_to_answers
 
 
+def answer_outcomes(
+    gold_answers: List[Answer], answers: List[Answer]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # per answer: the confidence compared against the threshold (+inf when
+    # it never abstains, -inf when it always does), whether answering is
+    # correct and whether abstaining (no answer option) is
+    nof_answers = len(answers)
+    confidences = np.empty(nof_answers, dtype=np.float64)
+    correct = np.zeros(nof_answers, dtype=bool)
+    unanswered_correct = np.zeros(nof_answers, dtype=bool)
+    for index, (gold, ans) in enumerate(zip(gold_answers, answers)):
+        gold_value = gold.get_answer()
+        if ans.is_no_answer:
+            confidences[index] = -np.inf
+        elif ans.get_scores() is None:
+            confidences[index] = np.inf
+            correct[index] = label_to_id(ans.pred_label) == gold_value
+        else:
+            confidences[index] = ans.get_max_prob()
+            correct[index] = ans.get_choice() == gold_value
+        unanswered_correct[index] = (
+            ans.search_unanswerable_option() == gold_value
+        )
+    return confidences, correct, unanswered_correct
+
+
+def count_sweep(
+    confidences: np.ndarray,
+    correct: np.ndarray,
+    unanswered_correct: np.ndarray,
+    thresholds: np.ndarray,
+    masks: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Outcome counts at every threshold from a single sort, answers are given
+    when their confidence is over the threshold. `masks` (sets x answers)
+    restrict the counts to subsets (i.e.: folds) sharing the sort. Returns
+    correct, unanswered and unanswered correct counts (sets x thresholds)
+    and the size of each set (sets x 1).
+    """
+    order = np.argsort(-confidences, kind='stable')
+    descending = confidences[order]
+    # answers over a threshold are a prefix of the descending order
+    nof_answered = np.searchsorted(
+        -descending, -np.asarray(thresholds, dtype=np.float64), side='left'
+    )
+    if masks is None:
+        masks = np.ones((1, len(confidences)), dtype=bool)
+    masks = np.atleast_2d(masks)[:, order]
+
+    def prefix_sums(values):
+        sums = np.zeros((masks.shape[0], masks.shape[1] + 1), dtype=np.int64)
+        np.cumsum(masks & values, axis=1, out=sums[:, 1:])
+        return sums
+
+    total = masks.sum(axis=1, keepdims=True)
+    answered = prefix_sums(True)[:, nof_answered]
+    correct_counts = prefix_sums(correct[order])[:, nof_answered]
+    unanswered_correct_sums = prefix_sums(unanswered_correct[order])
+    unanswered_correct_counts = (
+        unanswered_correct_sums[:, -1:] -
+        unanswered_correct_sums[:, nof_answered]
+    )
+    return (
+        correct_counts, total - answered, unanswered_correct_counts, total
+    )
+
+
+def group_codes(groups: Sequence) -> Tuple[List[str], np.ndarray]:
+    # categorical keys to group names and the group of each answer
+    names, codes = np.unique(
+        np.asarray(groups).astype(str), return_inverse=True
+    )
+    return names.tolist(), codes.reshape(-1)
+
+
+def lowest_threshold(confidences) -> float:
+    # derived confidences may be negative, start below all of them
+    lowest = min(confidences)
+    return lowest - 1.0 if lowest <= 0 else 0
+
+
+def risk_coverage(
+    gold_answers: List[Answer],
+    answers: List[Answer],
+    metrics: List[Metric] = (),
+    target_coverages: Tuple[float, ...] = (0.9, 0.95),
+    nof_points: int = 101,
+) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """
+    Selective prediction from one sort of the confidences: at every
+    threshold (descending, so coverage grows), the share of answered
+    questions, the accuracy over them (1 when none is answered), C_at_1
+    and any other count metric. Returns the report (AURC, the highest
+    threshold reaching each target coverage and the curve down-sampled to
+    about `nof_points` coverages) and the full curve.
+    """
+    confidences, correct, unanswered_correct = answer_outcomes(
+        gold_answers, answers
+    )
+    finite = confidences[np.isfinite(confidences)]
+    lowest = lowest_threshold(finite) if len(finite) > 0 else 0.0
+    thresholds = np.unique(np.append(finite, lowest))[::-1]
+    counts = [
+        values[0] for values in
+        count_sweep(confidences, correct, unanswered_correct, thresholds)
+    ]
+    nof_correct, unanswered, _, total = counts
+    answered = total - unanswered
+    coverage = answered / total
+    accuracy = np.ones(len(thresholds))
+    np.divide(nof_correct, answered, out=accuracy, where=answered > 0)
+    curve = dict(
+        threshold=thresholds,
+        coverage=coverage,
+        selective_accuracy=accuracy,
+    )
+    count_metrics = [C_at_1()] + [
+        metric for metric in metrics
+        if metric.has_counts and metric.name != C_at_1.name
+    ]
+    for metric in count_metrics:
+        values = metric.value_from_counts(*counts)
+        curve[metric.name] = values
+
+    # each threshold adds the answers it lets through at its risk
+    risk = 1 - accuracy
+    aurc = (np.diff(answered, prepend=0) * risk).sum() / total[0]
+    targets = {}
+    for target in target_coverages:
+        reached = np.flatnonzero(coverage >= target)
+        if len(reached) == 0:
+            targets[str(target)] = None
+            continue
+        index = reached[0]
+        targets[str(target)] = dict(
+            threshold=float(thresholds[index]),
+            coverage=float(coverage[index]),
+            selective_accuracy=float(accuracy[index]),
+            risk=float(risk[index]),
+        )
+    points = np.unique(np.clip(
+        np.searchsorted(coverage, np.linspace(0, 1, nof_points)),
+        0, len(thresholds) - 1
+    ))
+    report = dict(
+        aurc=float(aurc),
+        coverage_targets=targets,
+        curve={
+            name: values[points].tolist() for name, values in curve.items()
+        },
+    )
+    return report, curve
+
+
+def write_curve(path: str, curve: Dict[str, np.ndarray]):
+    with open(path, 'w', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(list(curve.keys()))
+        writer.writerows(zip(*(values.tolist() for values in curve.values())))
+
+
+class ThresholdSketch(object):
+    """
+    Constant size, mergeable summary of answer confidences for threshold
+    search over huge or streamed inputs. Answers, correct answers and no
+    answer correct answers (incorrect = answers - correct) are counted in
+    `nof_bins` uniform bins over [low, high], right closed, plus one bin
+    for values under `low` and one for values over `high`. Answers that
+    never abstain (+inf) or always do (-inf) are kept apart.
+
+    Metrics evaluated at bin edges are exact, the best threshold inside a
+    bin is bounded from the counts at its edges (count metrics are
+    multilinear, their maximum over a box of counts is at a corner).
+    """
+
+    def __init__(self, low: float = 0.0, high: float = 1.0, nof_bins=1024):
+        if not high > low or nof_bins < 1:
+            raise ValueError(
+                f'Sketch needs low < high and some bins ({low}, {high}, '
+                f'{nof_bins})'
+            )
+        self.edges = np.linspace(low, high, nof_bins + 1)
+        # rows: answers, correct, unanswered correct
+        self.bins = np.zeros((3, nof_bins + 2), dtype=np.int64)
+        self.always = np.zeros(3, dtype=np.int64)
+        self.never = np.zeros(3, dtype=np.int64)
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def __len__(self):
+        return int(self.bins[0].sum() + self.always[0] + self.never[0])
+
+    def bin_index(self, confidences: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.edges, confidences, side='left')
+
+    def update(
+        self,
+        confidences: np.ndarray,
+        correct: np.ndarray,
+        unanswered_correct: np.ndarray,
+    ) -> 'ThresholdSketch':
+        confidences = np.asarray(confidences, dtype=np.float64)
+        rows = np.stack([
+            np.ones(len(confidences), dtype=np.int64),
+            np.asarray(correct, dtype=np.int64),
+            np.asarray(unanswered_correct, dtype=np.int64),
+        ])
+        finite = np.isfinite(confidences)
+        for bucket, mask in (
+            (self.always, confidences == np.inf),
+            (self.never, confidences == -np.inf),
+        ):
+            bucket += rows[:, mask].sum(axis=1)
+        if finite.any():
+            values = confidences[finite]
+            self.minimum = min(self.minimum, values.min())
+            self.maximum = max(self.maximum, values.max())
+            bin_index = self.bin_index(values)
+            for row in range(3):
+                self.bins[row] += np.bincount(
+                    bin_index,
+                    weights=rows[row, finite],
+                    minlength=self.bins.shape[1],
+                ).astype(np.int64)
+        return self
+
+    def add_answers(
+        self, gold_answers: List[Answer], answers: List[Answer]
+    ) -> 'ThresholdSketch':
+        return self.update(*answer_outcomes(gold_answers, answers))
+
+    def merge(self, other: 'ThresholdSketch') -> 'ThresholdSketch':
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Only sketches with the same bins can be merged')
+        self.bins += other.bins
+        self.always += other.always
+        self.never += other.never
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        return self
+
+    def thresholds(self) -> np.ndarray:
+        # below every value, the bin edges and over every value
+        lowest = 0.0
+        if np.isfinite(self.minimum):
+            lowest = lowest_threshold([self.minimum])
+        return np.concatenate([
+            [min(lowest, self.edges[0])],
+            self.edges,
+            [max(self.maximum, self.edges[-1])],
+        ])
+
+    def _above(self) -> np.ndarray:
+        # (rows x thresholds) counts of answers over each threshold
+        above = np.zeros((3, self.bins.shape[1] + 1), dtype=np.int64)
+        above[:, :-1] = np.cumsum(self.bins[:, ::-1], axis=1)[:, ::-1]
+        return above + self.always[:, None]
+
+    def _metric_counts(self, answered, correct, answered_unanswered_correct):
+        total = len(self)
+        total_unanswered_correct = (
+            self.bins[2].sum() + self.always[2] + self.never[2]
+        )
+        return (
+            correct,
+            total - answered,
+            total_unanswered_correct - answered_unanswered_correct,
+            total,
+        )
+
+    def edge_values(self, metric: Metric) -> np.ndarray:
+        return metric.value_from_counts(*self._metric_counts(*self._above()))
+
+    def bin_bounds(self, metric: Metric) -> np.ndarray:
+        # best value any threshold inside each bin could reach
+        above = self._above()
+        corners = []
+        for answered in (above[0, :-1], above[0, 1:]):
+            for correct in (above[1, :-1], above[1, 1:]):
+                for unanswered_correct in (above[2, :-1], above[2, 1:]):
+                    corners.append(metric.value_from_counts(
+                        *self._metric_counts(
+                            answered, correct, unanswered_correct
+                        )
+                    ))
+        bounds = np.max(corners, axis=0)
+        return np.where(self.bins[0] > 0, bounds, -np.inf)
+
+    def best_threshold(self, metric: Metric) -> Dict:
+        """
+        Best threshold among the bin edges, the exact best value is at
+        most `error_bound` over `value`. `bins` lists the bins that could
+        hold a better threshold (see `refine`).
+        """
+        if not metric.has_counts:
+            raise ValueError(
+                f'Sketched thresholds need a count based metric, '
+                f'{metric.name} is not'
+            )
+        thresholds = self.thresholds()
+        values = self.edge_values(metric)
+        best = argmax(values.tolist())
+        bounds = self.bin_bounds(metric)
+        return dict(
+            threshold=float(thresholds[best]),
+            value=float(values[best]),
+            error_bound=float(max(0.0, bounds.max() - values[best])),
+            bins=np.flatnonzero(bounds > values[best]),
+        )
+
+    def refine(
+        self,
+        metric: Metric,
+        chunks: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    ) -> Dict:
+        """
+        Exact best threshold from a second pass over the outcomes (chunks
+        of `update` arguments), only keeping those falling inside the bins
+        that could beat the best edge.
+        """
+        best = self.best_threshold(metric)
+        candidate_bins = best.pop('bins')
+        kept = []
+        for confidences, correct, unanswered_correct in chunks:
+            confidences = np.asarray(confidences, dtype=np.float64)
+            bin_index = self.bin_index(confidences)
+            keep = np.isfinite(confidences) & np.isin(
+                bin_index, candidate_bins
+            )
+            kept.append((
+                confidences[keep],
+                np.asarray(correct, dtype=np.int64)[keep],
+                np.asarray(unanswered_correct, dtype=np.int64)[keep],
+                bin_index[keep],
+            ))
+        if len(kept) == 0 or sum(len(chunk[0]) for chunk in kept) == 0:
+            best['error_bound'] = 0.0
+            return best
+        confidences, correct, unanswered_correct, bin_index = (
+            np.concatenate(column) for column in zip(*kept)
+        )
+        # by bin and descending confidence, answers over a kept value are
+        # those in higher bins plus the ones before it in its bin
+        order = np.lexsort((-confidences, bin_index))
+        confidences = confidences[order]
+        bin_index = bin_index[order]
+        positions = np.arange(len(confidences))
+        bin_starts = np.searchsorted(bin_index, bin_index, side='left')
+        new_value = np.ones(len(confidences), dtype=bool)
+        new_value[1:] = (
+            (bin_index[1:] != bin_index[:-1]) |
+            (confidences[1:] != confidences[:-1])
+        )
+        value_starts = np.maximum.accumulate(
+            np.where(new_value, positions, 0)
+        )
+
+        def over_value(values):
+            sums = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(values, out=sums[1:])
+            return sums[value_starts] - sums[bin_starts]
+
+        above = self._above()[:, bin_index + 1]
+        values = metric.value_from_counts(*self._metric_counts(
+            above[0] + value_starts - bin_starts,
+            above[1] + over_value(correct[order]),
+            above[2] + over_value(unanswered_correct[order]),
+        ))
+        # ties go to the lowest threshold, as in find_best_threshold
+        thresholds = np.append(confidences, best['threshold'])
+        values = np.append(values, best['value'])
+        best_values = np.flatnonzero(values == values.max())
+        best_index = best_values[np.argmin(thresholds[best_values])]
+        return dict(
+            threshold=float(thresholds[best_index]),
+            value=float(values[best_index]),
+            error_bound=0.0,
+        )
+
+
 def sweeper(metric, gold_answers, answers, increments):
     scores = []
     clones = [Answer.clone(ans) for ans in answers]
     for threshold in increments:
         for ans in clones:
             ans.threshold = threshold
-        scores.append(metric(gold_answers, clones))
+        scores.append(metric(gold_answers, clones).value)
     return scores
 
 
@@ -55,7 +438,7 @@ class Threshold(object):
         scores = []
         for threshold in increments:
             apply_threshold_to_answers(answers, threshold)
-            scores.append(metric(gold_answers, answers))
+            scores.append(metric(gold_answers, answers).value)
         best_thresh_idx = argmax(scores)
         return best_thresh_idx, scores
 
@@ -65,8 +448,16 @@ class Threshold(object):
         gold_answers: List[Answer],
         answers: List[Answer],
     ) -> float:
-        max_probs = [ans.get_max_prob() for ans in answers]
-        increments = unique([0] + sorted(max_probs))
+        increments = self._increments(answers)
+        if metric.has_counts:
+            # one sort and cumulative counts instead of a full evaluation
+            # per threshold
+            values = metric.value_from_counts(*count_sweep(
+                *answer_outcomes(gold_answers, answers), increments
+            ))
+            return increments[argmax(values[0].tolist())]
+
+        prev_thresholds = [ans.threshold for ans in answers]
         sweep_function = self._sweep
         if len(answers) > 5000:
             sweep_function = self._concurrent_sweep
@@ -75,6 +466,181 @@ class Threshold(object):
             metric, gold_answers, answers, increments
         )
         # reset to previous thresholds,
-        # unnecessary since all answers are cloned
-        apply_threshold_to_answers(answers, 0.0)
+        # unnecessary when all answers are cloned
+        for ans, prev_threshold in zip(answers, prev_thresholds):
+            ans.threshold = prev_threshold
         return increments[best_thresh_idx]
+
+    def _increments(self, answers: List[Answer]) -> List[float]:
+        max_probs = [ans.get_max_prob() for ans in answers]
+        return unique([lowest_threshold(max_probs)] + sorted(max_probs))
+
+    def find_best_thresholds(
+        self,
+        metrics: List[Metric],
+        gold_answers: List[Answer],
+        answers: List[Answer],
+    ) -> List[float]:
+        """
+        find_best_threshold for several metrics: count metrics share one
+        sweep, utility functions are evaluated at every threshold with a
+        single (utilities x 3) by (3 x thresholds) product.
+        """
+        count_metrics = [metric for metric in metrics if metric.has_counts]
+        best = {}
+        if len(count_metrics) > 0:
+            increments = self._increments(answers)
+            counts = count_sweep(
+                *answer_outcomes(gold_answers, answers), increments
+            )
+            utilities = [
+                metric for metric in count_metrics
+                if isinstance(metric, UtilityFunction)
+            ]
+            values = {}
+            if len(utilities) > 0:
+                correct, unanswered, _, total = counts
+                utility_rows = utility_values(
+                    [metric.utility for metric in utilities],
+                    correct[0], unanswered[0], total[0]
+                )
+                for metric, row in zip(utilities, utility_rows):
+                    metric.update_name()
+                    values[id(metric)] = row
+            for metric in count_metrics:
+                if id(metric) not in values:
+                    values[id(metric)] = metric.value_from_counts(*counts)[0]
+                best[id(metric)] = increments[
+                    argmax(values[id(metric)].tolist())
+                ]
+        return [
+            best[id(metric)] if id(metric) in best
+            else self.find_best_threshold(metric, gold_answers, answers)
+            for metric in metrics
+        ]
+
+    def find_group_thresholds(
+        self,
+        metrics: List[Metric],
+        gold_answers: List[Answer],
+        answers: List[Answer],
+        groups: Sequence,
+    ) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """
+        find_best_thresholds within each group of answers, `groups` holds
+        any categorical key per answer (i.e.: has_ans / no_has_ans). Count
+        metrics get every group from one sweep, masked per group. Returns
+        the group names, the group of each answer and the (metrics x
+        groups) thresholds; `thresholds[codes]` applies them jointly.
+        """
+        names, codes = group_codes(groups)
+        masks = codes == np.arange(len(names))[:, None]
+        thresholds = np.zeros((len(metrics), len(names)))
+        increments = np.asarray(self._increments(answers), dtype=np.float64)
+        counts = None
+        for row, metric in enumerate(metrics):
+            if metric.has_counts:
+                if counts is None:
+                    counts = count_sweep(
+                        *answer_outcomes(gold_answers, answers),
+                        increments,
+                        masks,
+                    )
+                values = metric.value_from_counts(*counts)
+                thresholds[row] = increments[np.argmax(values, axis=1)]
+                continue
+            for group, mask in enumerate(masks):
+                indices = np.flatnonzero(mask).tolist()
+                thresholds[row, group] = self.find_best_threshold(
+                    metric,
+                    [gold_answers[index] for index in indices],
+                    [answers[index] for index in indices],
+                )
+        return names, codes, thresholds
+
+    def sketch_best_threshold(
+        self,
+        metric: Metric,
+        gold_answers: List[Answer],
+        answers: List[Answer],
+        nof_bins: int = 1024,
+        refine: bool = False,
+    ) -> Dict:
+        # approximate find_best_threshold, bins span the confidences range
+        outcomes = answer_outcomes(gold_answers, answers)
+        finite = outcomes[0][np.isfinite(outcomes[0])]
+        low, high = (finite.min(), finite.max()) if len(finite) else (0, 1)
+        sketch = ThresholdSketch(
+            low, high if high > low else low + 1.0, nof_bins
+        ).update(*outcomes)
+        if refine:
+            return sketch.refine(metric, [outcomes])
+        best = sketch.best_threshold(metric)
+        best.pop('bins')
+        return best
+
+    def cross_validate(
+        self,
+        metric: Metric,
+        gold_answers: List[Answer],
+        answers: List[Answer],
+        folds: np.ndarray,
+        nof_folds: Optional[int] = None,
+    ) -> Dict:
+        """
+        Picks the best threshold on each K - 1 folds (`folds` holds the
+        fold of each answer) and scores it on the held out fold. All folds
+        share one sort, their counts come from masking it.
+        """
+        if not metric.has_counts:
+            raise ValueError(
+                f'Cross validated thresholds need a count based metric, '
+                f'{metric.name} is not'
+            )
+        folds = np.asarray(folds)
+        if nof_folds is None:
+            nof_folds = int(folds.max()) + 1
+        fold_sizes = np.bincount(folds, minlength=nof_folds)
+        if nof_folds < 2 or len(fold_sizes) > nof_folds or np.any(
+            fold_sizes == 0
+        ):
+            raise ValueError(
+                f'Every one of the {nof_folds} folds needs answers to test '
+                f'on and to train on, fold sizes: {fold_sizes.tolist()}'
+            )
+        confidences, correct, unanswered_correct = answer_outcomes(
+            gold_answers, answers
+        )
+        finite = np.isfinite(confidences)
+        lowest = lowest_threshold(confidences[finite])
+        thresholds = np.unique(np.append(confidences[finite], lowest))
+        test_masks = folds[None, :] == np.arange(nof_folds)[:, None]
+        train_masks = ~test_masks
+        values = metric.value_from_counts(*count_sweep(
+            confidences,
+            correct,
+            unanswered_correct,
+            thresholds,
+            np.concatenate([train_masks, test_masks]),
+        ))
+        train_values = values[:nof_folds]
+        test_values = values[nof_folds:]
+        # as in find_best_threshold, only thresholds found in the training
+        # folds compete, ties go to the lowest one
+        candidates = np.zeros(train_values.shape, dtype=bool)
+        candidates[:, np.searchsorted(thresholds, lowest)] = True
+        threshold_index = np.searchsorted(thresholds, confidences)
+        fold_rows, columns = np.nonzero(train_masks & finite)
+        candidates[fold_rows, threshold_index[columns]] = True
+        best = np.where(candidates, train_values, -np.inf).argmax(axis=1)
+        fold_range = np.arange(nof_folds)
+        fold_values = test_values[fold_range, best]
+        fold_thresholds = thresholds[best]
+        return {
+            metric.name: float(fold_values.mean()),
+            f'{metric.name}_std': float(fold_values.std()),
+            f'{metric.name}_folds': fold_values.tolist(),
+            f'{metric.name}_train': train_values[fold_range, best].tolist(),
+            'threshold': float(fold_thresholds.mean()),
+            'thresholds': fold_thresholds.tolist(),
+        }
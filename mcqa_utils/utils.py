@@ -1,6 +1,6 @@
 import numpy as np
 
-from typing import List, Union
+from typing import List, Sequence, Tuple, Union
 from functools import partial
 from mc_transformers.utils_mc import InputExample
 
@@ -73,6 +73,39 @@ def sort_dict(_dict):
     return ret
 
 
+def flatten_options(
+    endings: Sequence[Sequence[str]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    # ragged option texts as one lowercased array plus row offsets
+    widths = np.fromiter(
+        (len(row) for row in endings), dtype=np.int64, count=len(endings)
+    )
+    offsets = np.zeros(len(endings) + 1, dtype=np.int64)
+    np.cumsum(widths, out=offsets[1:])
+    flat = np.array(
+        [end.lower() for row in endings for end in row], dtype=str
+    )
+    return flat, offsets
+
+
+def option_positions(
+    flat: np.ndarray, offsets: np.ndarray, text: str
+) -> np.ndarray:
+    # per row, first option equal to `text` (case insensitive), -1 if none
+    return first_option(flat == text.lower(), offsets)
+
+
+def first_option(flat_mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # per row, position of the first option set in `flat_mask`, -1 if none
+    positions = np.full(len(offsets) - 1, -1, dtype=np.int64)
+    matches = np.flatnonzero(flat_mask)
+    if len(matches) > 0:
+        rows = np.searchsorted(offsets, matches, side='right') - 1
+        rows, first = np.unique(rows, return_index=True)
+        positions[rows] = matches[first] - offsets[rows]
+    return positions
+
+
 def answer_mask_fn(mask_cfg, sample):
     mask_text = mask_cfg['text'].lower()
     keep_if_found = mask_cfg['match']
@@ -99,3 +132,27 @@ def update_example(example, **kwargs):
         endings=dict_example['endings'],
         label=dict_example['label'],
     )
+
+
+def plain_value(value):
+    # numpy arrays and scalars to lists and python numbers
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def iter_results(results: dict, path: tuple = ()):
+    # yields (key path, value) for every leaf of nested results, numpy
+    # leaves as plain values (table rows and sinks can not take them)
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from iter_results(value, path + (str(key),))
+        else:
+            yield path + (str(key),), plain_value(value)
+
+
+def flatten_results(results: dict, sep: str = '.') -> dict:
+    # nested results (per mask / per threshold) to dotted keys
+    return {sep.join(path): value for path, value in iter_results(results)}
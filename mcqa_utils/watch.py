@@ -0,0 +1,258 @@
+"""Evaluate prediction files as they appear in a directory."""
+import os
+import sys
+import time
+import queue
+import fnmatch
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from mcqa_utils.cache import hash_file
+from mcqa_utils.sinks import ResultSink
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+Stat = Tuple[int, int]
+
+
+class _EventHandler(FileSystemEventHandler):
+
+    def __init__(self, events: queue.Queue, matches: Callable):
+        super(_EventHandler, self).__init__()
+        self.events = events
+        self.matches = matches
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        # moves (i.e.: atomic renames) are reported on the destination
+        path = getattr(event, 'dest_path', None) or event.src_path
+        if self.matches(path):
+            self.events.put(path)
+
+
+class PredictionsWatcher(object):
+    """
+    Reports prediction files under `directory` (recursively) matching
+    `pattern` once created or updated. Files are only reported after their
+    size and mtime stay unchanged between two checks, so half written
+    predictions are not read. Filesystem events (watchdog, inotify on
+    linux) are used when available, otherwise the directory is polled.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        pattern: str = 'nbest_predictions.json',
+        use_events: bool = True,
+    ):
+        self.directory = directory
+        self.pattern = pattern
+        self._reported: Dict[str, Stat] = {}
+        self._pending: Dict[str, Stat] = {}
+        self._events = queue.Queue()
+        self._observer = None
+        self._scanned = False
+        if use_events and Observer is not None:
+            observer = Observer()
+            observer.schedule(
+                _EventHandler(self._events, self.matches),
+                directory,
+                recursive=True
+            )
+            try:
+                observer.start()
+                self._observer = observer
+            except OSError as ex:
+                # i.e.: inotify watch limit reached
+                print(
+                    f'Unable to watch {directory} ({ex}), polling instead',
+                    file=sys.stderr
+                )
+
+    @property
+    def uses_events(self) -> bool:
+        return self._observer is not None
+
+    def matches(self, path: str) -> bool:
+        return fnmatch.fnmatch(os.path.basename(path), self.pattern)
+
+    def scan(self) -> List[str]:
+        paths = []
+        for root, _, files in os.walk(self.directory):
+            paths.extend(
+                os.path.join(root, name) for name in files
+                if fnmatch.fnmatch(name, self.pattern)
+            )
+        return sorted(paths)
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Stat]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _candidates(self) -> Iterable[str]:
+        # files present before the watch started are reported as well
+        if self._observer is None or not self._scanned:
+            self._scanned = True
+            return self.scan()
+        candidates = set()
+        while True:
+            try:
+                candidates.add(self._events.get_nowait())
+            except queue.Empty:
+                return sorted(candidates)
+
+    def changes(self) -> List[str]:
+        ready = []
+        # pending files are checked again in the next call
+        pending = list(self._pending.items())
+        for path in self._candidates():
+            stat = self._stat(path)
+            if (
+                stat is not None and
+                stat != self._reported.get(path, None) and
+                path not in self._pending
+            ):
+                self._pending[path] = stat
+        for path, prev_stat in pending:
+            stat = self._stat(path)
+            if stat is None:
+                del self._pending[path]
+            elif stat == prev_stat:
+                del self._pending[path]
+                self._reported[path] = stat
+                ready.append(path)
+            else:
+                self._pending[path] = stat
+        return ready
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+
+# state of each worker process: (args, dataset, gold answers), inherited
+# from the parent when processes are forked
+_worker_state = None
+
+
+def init_worker(args):
+    global _worker_state
+    if _worker_state is None:
+        from mcqa_utils.mcqa_utils import get_gold_data
+        _worker_state = (args, *get_gold_data(args))
+
+
+def evaluate_file(path: str) -> Dict:
+    from mcqa_utils.mcqa_utils import get_mcqa_results
+    args, dataset, gold_answers = _worker_state
+    return get_mcqa_results(
+        args, dataset, gold_answers, results_path=path
+    )
+
+
+def watch_predictions(
+    args,
+    sinks: ResultSink,
+    seen_hashes: Iterable[str] = (),
+    nof_workers: int = 1,
+    interval: float = 2.0,
+    timeout: Optional[float] = None,
+    metadata: Optional[Dict] = None,
+):
+    """
+    Evaluates every prediction file reported by a `PredictionsWatcher` over
+    `args.watch`, writing each file's results to `sinks` as soon as they
+    are ready. Files whose content hash is in `seen_hashes` (or was already
+    evaluated) are skipped. Stops on interrupt or after `timeout` seconds
+    without new files.
+    """
+    global _worker_state
+    metadata = {} if metadata is None else metadata
+    from mcqa_utils.mcqa_utils import get_gold_data
+    # loaded once, forked workers share it
+    _worker_state = (args, *get_gold_data(args))
+    watcher = PredictionsWatcher(args.watch, args.watch_pattern)
+    executor = None
+    if nof_workers > 1:
+        executor = ProcessPoolExecutor(
+            nof_workers, initializer=init_worker, initargs=(args,)
+        )
+    seen = set(seen_hashes)
+    step = len(seen)
+    futures = {}
+    last_activity = time.monotonic()
+
+    def write_results(path, digest, results):
+        nonlocal step
+        sinks.write(
+            results, predictions=path, hash=digest, step=step, **metadata
+        )
+        step += 1
+
+    try:
+        while True:
+            for path in watcher.changes():
+                try:
+                    digest = hash_file(path)
+                except OSError:
+                    continue
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                last_activity = time.monotonic()
+                if executor is None:
+                    try:
+                        results = evaluate_file(path)
+                    except Exception as ex:
+                        print(f'Unable to evaluate {path}: {ex!r}',
+                              file=sys.stderr)
+                        continue
+                    write_results(path, digest, results)
+                else:
+                    future = executor.submit(evaluate_file, path)
+                    futures[future] = (path, digest)
+
+            if len(futures) > 0:
+                done, _ = wait(
+                    futures, timeout=interval, return_when=FIRST_COMPLETED
+                )
+            else:
+                done = []
+                time.sleep(interval)
+            for future in done:
+                path, digest = futures.pop(future)
+                try:
+                    results = future.result()
+                except Exception as ex:
+                    print(f'Unable to evaluate {path}: {ex!r}',
+                          file=sys.stderr)
+                    continue
+                write_results(path, digest, results)
+                last_activity = time.monotonic()
+
+            idle = time.monotonic() - last_activity
+            if timeout is not None and len(futures) == 0 and idle > timeout:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -32,6 +32,7 @@ setup(
     entry_points={
         'console_scripts': [
             'mcqa_utils=mcqa_utils.mcqa_utils:main',
+            'mcqa_results=mcqa_utils.results_store:main',
         ],
     },
     install_requires=requirements,
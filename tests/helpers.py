@@ -0,0 +1,90 @@
+"""Small generic datasets and predictions written to temporary folders."""
+import os
+import json
+
+import numpy as np
+
+labels = 'ABCD'
+
+
+def make_dataset(
+    data_dir,
+    nof_contexts=6,
+    nof_questions=5,
+    no_answer_text=None,
+    split='dev',
+    seed=0,
+):
+    """
+    Writes a `generic` task split. With `no_answer_text`, the option at
+    position 3 of every third question holds it (and is its answer for
+    every other one of those).
+    """
+    rng = np.random.default_rng(seed)
+    data = []
+    for context in range(nof_contexts):
+        answers, options = [], []
+        for question in range(nof_questions):
+            texts = [
+                f'option {context} {question} {option}' for option in range(4)
+            ]
+            answer = labels[rng.integers(4)]
+            if no_answer_text is not None and question % 3 == 0:
+                texts[3] = no_answer_text
+                if context % 2 == 0:
+                    answer = 'D'
+            answers.append(answer)
+            options.append(texts)
+        data.append(dict(
+            id=f'ctx{context}',
+            article=f'article {context}',
+            answers=answers,
+            options=options,
+            questions=[f'question {q}' for q in range(nof_questions)],
+        ))
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, f'{split}.json'), 'w') as fout:
+        json.dump(dict(version=1.0, data=data), fout)
+    return data
+
+
+def make_nbest(data, seed=0, missing=(), accuracy=0.6):
+    """
+    nbest predictions for `make_dataset` data, right about `accuracy` of
+    the time. `missing` holds (context, question) pairs written as nulls.
+    """
+    rng = np.random.default_rng(seed)
+    nbest = {}
+    for context, raw in enumerate(data):
+        answers = []
+        for question, gold in enumerate(raw['answers']):
+            if (context, question) in missing:
+                answers.append(None)
+                continue
+            logits = rng.normal(size=4)
+            if rng.random() < accuracy:
+                logits[labels.index(gold)] += 2.0
+            probs = np.exp(logits) / np.exp(logits).sum()
+            answers.append(dict(
+                probs=probs.tolist(),
+                logits=logits.tolist(),
+                pred_label=labels[int(probs.argmax())],
+                label=gold,
+            ))
+        nbest[raw['id']] = answers
+    return nbest
+
+
+def make_predictions(data, seed=0):
+    # flat predictions, one label per `<context>-<question>` id
+    rng = np.random.default_rng(seed)
+    return {
+        f'{raw["id"]}-{question:02d}': labels[rng.integers(4)]
+        for raw in data for question in range(len(raw['answers']))
+    }
+
+
+def write_json(value, path):
+    with open(path, 'w') as fout:
+        json.dump(value, fout)
+    return path
@@ -0,0 +1,144 @@
+"""Tests for `mcqa_utils.cache`."""
+import os
+import sys
+import tempfile
+import unittest
+
+from pathlib import Path
+from unittest import mock
+
+from mcqa_utils import mcqa_utils
+from mcqa_utils.cache import (
+    ResultsCache,
+    hash_paths,
+    make_key,
+    package_hash,
+)
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+class TestResultsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_hit_and_miss(self):
+        cache = ResultsCache(self.cache_dir)
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', dict(avg=0.5))
+        self.assertEqual(cache.get('key'), dict(avg=0.5))
+        stats = cache.save_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_content_invalidation(self):
+        path = os.path.join(self.tmp_dir.name, 'nbest.json')
+        write_json({'ctx0': [None]}, path)
+        first = make_key({'predictions': hash_paths([path])}, dict(a=1))
+        self.assertEqual(
+            first, make_key({'predictions': hash_paths([path])}, dict(a=1))
+        )
+        write_json({'ctx0': ['A']}, path)
+        second = make_key({'predictions': hash_paths([path])}, dict(a=1))
+        self.assertNotEqual(first, second)
+        self.assertNotEqual(
+            second, make_key({'predictions': hash_paths([path])}, dict(a=2))
+        )
+
+    def test_lru_eviction(self):
+        cache = ResultsCache(self.cache_dir, max_bytes=10 ** 6)
+        for index, key in enumerate(('first', 'second', 'third')):
+            cache.put(key, dict(value='x' * 100))
+            os.utime(cache._entry_path(key), (index, index))
+        # a hit refreshes the entry
+        cache.get('first')
+        entry_size = cache._entry_path('first').stat().st_size
+        cache.max_bytes = 2 * entry_size
+        cache.evict()
+        self.assertIsNone(cache.get('second'))
+        self.assertIsNotNone(cache.get('first'))
+        self.assertIsNotNone(cache.get('third'))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_concurrent_stats(self):
+        first = ResultsCache(self.cache_dir)
+        second = ResultsCache(self.cache_dir)
+        first.get('missing')
+        second.get('missing')
+        second.get('missing')
+        # interleaved saves from different runs keep every update
+        first.save_stats()
+        second.save_stats()
+        first.get('missing')
+        stats = first.save_stats()
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(ResultsCache(self.cache_dir).stats()['misses'], 4)
+        self.assertEqual(stats['entries'], 0)
+
+    def test_stats_bounded(self):
+        cache = ResultsCache(self.cache_dir)
+        cache.get('missing')
+        cache.save_stats()
+        size = os.path.getsize(cache.stats_path)
+        for _ in range(50):
+            cache.get('missing')
+            stats = cache.save_stats()
+        self.assertEqual(stats['misses'], 51)
+        self.assertEqual(os.path.getsize(cache.stats_path), size)
+        # the stats file takes its share of max_bytes
+        self.assertEqual(stats['bytes'], size)
+
+    def test_stats_skips_evicted(self):
+        cache = ResultsCache(self.cache_dir)
+        cache.put('first', {'avg': 0.5})
+        cache.put('second', {'avg': 0.5})
+        stat = Path.stat
+
+        def evicted_stat(path, *args, **kwargs):
+            # removed by another process after listing the entries
+            if path.name == 'first.json':
+                raise FileNotFoundError(path)
+            return stat(path, *args, **kwargs)
+
+        with mock.patch.object(Path, 'stat', evicted_stat):
+            stats = cache.stats()
+        self.assertEqual(stats['entries'], 1)
+
+
+class TestCacheKey(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data = make_dataset(self.tmp_dir.name)
+        self.nbest = write_json(
+            make_nbest(data), os.path.join(self.tmp_dir.name, 'nbest.json')
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def key(self, *flags):
+        argv = [
+            'mcqa_utils', '-d', self.tmp_dir.name, '-T', 'generic',
+            '-n', self.nbest, '-m', 'avg'
+        ] + list(flags)
+        with mock.patch.object(sys, 'argv', argv):
+            return mcqa_utils.get_cache_key(mcqa_utils.parse_flags())
+
+    def test_key(self):
+        key = self.key()
+        self.assertEqual(key, self.key())
+        self.assertNotEqual(key, self.key('-ft'))
+        self.assertIsNone(self.key('--dump_outcomes', 'outcomes.parquet'))
+        self.assertEqual(len(package_hash()), 40)
+        with mock.patch.object(mcqa_utils, 'package_hash', lambda: 'edited'):
+            self.assertNotEqual(key, self.key())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""Tests for `mcqa_utils.confidence` and derived confidence fields."""
+import sys
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from mcqa_utils import mcqa_utils
+from mcqa_utils.answer import Answer, apply_prob_field_to_answers
+from mcqa_utils.confidence import compute_derived_field
+
+
+def make_answers(rows, with_logits=True):
+    answers = []
+    for index, logits in enumerate(rows):
+        logits = np.asarray(logits, dtype=np.float64)
+        probs = np.exp(logits) / np.exp(logits).sum()
+        answers.append(Answer(
+            example_id=index,
+            pred_label='ABCD'[int(probs.argmax())],
+            probs=probs.tolist(),
+            logits=logits.tolist() if with_logits else None,
+        ))
+    return answers
+
+
+class TestDerivedFields(unittest.TestCase):
+
+    def setUp(self):
+        # the last answer has three options, padded in the matrices
+        self.rows = [[0.5, 1.5, -1.0, 0.0], [2.0, 0.1, 0.2, 0.3], [1, 2, 3]]
+        self.answers = make_answers(self.rows)
+
+    def expected(self, field, temperature=1.0):
+        values = []
+        for row in self.rows:
+            scaled = np.asarray(row, dtype=np.float64) / temperature
+            probs = np.exp(scaled) / np.exp(scaled).sum()
+            top = np.sort(probs)[::-1]
+            values.append(dict(
+                softmax=probs,
+                margin=top[0] - top[1],
+                neg_entropy=np.sum(probs * np.log(probs)),
+            )[field])
+        return values
+
+    def test_fields(self):
+        for field in ('softmax', 'margin', 'neg_entropy'):
+            for temperature in (None, 2.0):
+                answers = make_answers(self.rows)
+                apply_prob_field_to_answers(answers, field, temperature)
+                expected = self.expected(field, temperature or 1.0)
+                for ans, value in zip(answers, expected):
+                    np.testing.assert_allclose(getattr(ans, field), value)
+                    self.assertEqual(ans.probs_field, field)
+
+    def test_probs_without_logits(self):
+        answers = make_answers(self.rows, with_logits=False)
+        # log(probs) stands for the logits
+        np.testing.assert_allclose(
+            compute_derived_field(answers, 'softmax', 0.5)[0],
+            self.expected('softmax', 0.5)[0],
+        )
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            compute_derived_field(self.answers, 'probs')
+
+
+class TestTemperatureFlag(unittest.TestCase):
+
+    def parse(self, *flags):
+        argv = ['mcqa_utils', '-d', 'data', '-m', 'avg', '-n', 'nbest.json']
+        with mock.patch.object(sys, 'argv', argv + list(flags)):
+            return mcqa_utils.parse_flags()
+
+    def test_temperature_needs_derived_field(self):
+        for flags in (
+            ['-T', 'generic', '--temperature', '2.0'],
+            ['-pf', 'probs', '--temperature', '2.0'],
+            ['-pf', 'softmax', '--temperature', '0'],
+        ):
+            with self.assertRaises(ValueError):
+                self.parse(*flags)
+        args = self.parse('-pf', 'softmax', '--temperature', '2.0')
+        self.assertEqual(args.temperature, 2.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
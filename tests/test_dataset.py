@@ -0,0 +1,297 @@
+"""Tests for `mcqa_utils.dataset`."""
+import os
+import gzip
+import json
+import lzma
+import tempfile
+import unittest
+
+import numpy as np
+
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.utils import label_to_id
+
+from tests.helpers import make_dataset
+
+
+class TestDatasetExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data = make_dataset(self.tmp_dir.name, nof_contexts=7)
+        self.dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.examples = self.dataset.get_split('dev')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, 'out', name)
+
+    def read_contexts(self, paths, open_fn=open):
+        contexts = []
+        for path in paths:
+            with open_fn(path, 'rt', encoding='utf-8') as fin:
+                document = json.load(fin)
+            self.assertEqual(document['version'], 1.0)
+            contexts.extend(document['data'])
+        return contexts
+
+    def test_to_json_round_trip(self):
+        document = self.dataset.to_json(self.examples)
+        self.assertEqual(document['data'], self.data)
+        # interleaved contexts are regrouped by first appearance
+        shuffled = [
+            self.examples[context * 5 + question]
+            for question in range(5) for context in range(7)
+        ]
+        self.assertEqual(
+            self.dataset.to_json(shuffled)['data'], self.data
+        )
+
+    def test_write_json(self):
+        paths = self.dataset.write_json(self.examples, self.path('dev.json'))
+        self.assertEqual(paths, [self.path('dev.json')])
+        self.assertEqual(self.read_contexts(paths), self.data)
+
+    def test_shards(self):
+        paths = self.dataset.write_json(
+            self.examples, self.path('dev.json'), nof_shards=3,
+            compression='gzip',
+        )
+        self.assertEqual(len(paths), 3)
+        self.assertTrue(all(path.endswith('.json.gz') for path in paths))
+        contexts = self.read_contexts(paths, gzip.open)
+        self.assertEqual(
+            sorted(contexts, key=lambda context: context['id']),
+            sorted(self.data, key=lambda context: context['id']),
+        )
+
+    def test_shards_by_size(self):
+        paths = self.dataset.write_json(
+            self.examples, self.path('dev.json'), max_shard_bytes=1,
+            compression='xz',
+        )
+        # every shard holds at least one context
+        self.assertEqual(len(paths), len(self.data))
+        self.assertEqual(self.read_contexts(paths, lzma.open), self.data)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            self.dataset.write_json(
+                self.examples, self.path('dev.json'), compression='zip'
+            )
+        with self.assertRaises(ValueError):
+            self.dataset.write_json(
+                self.examples, self.path('dev.json'), nof_shards=2,
+                max_shard_bytes=10,
+            )
+
+    def test_streams_need_grouped_contexts(self):
+        shuffled = iter(self.examples[1::2] + self.examples[::2])
+        with self.assertRaises(ValueError):
+            list(self.dataset.iter_json_contexts(shuffled))
+
+
+class TestDatasetSplits(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        make_dataset(self.tmp_dir.name, nof_contexts=20, nof_questions=5)
+        self.dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.examples = self.dataset.get_split('dev')
+        self.contexts = np.array([
+            self.dataset.id_codec.context_index(
+                self.dataset.get_example_id(example)
+            )
+            for example in self.examples
+        ])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_partition(self, splits):
+        indices = np.concatenate(splits)
+        self.assertEqual(sorted(indices.tolist()), list(range(100)))
+
+    def test_split_indices(self):
+        splits = self.dataset.split_indices(
+            self.examples, [0.6, 0.2, 0.2], seed=1
+        )
+        self.assert_partition(splits)
+        self.assertEqual([len(split) for split in splits], [60, 20, 20])
+        again = self.dataset.split_indices(
+            self.examples, [0.6, 0.2, 0.2], seed=1
+        )
+        for split, other in zip(splits, again):
+            np.testing.assert_array_equal(split, other)
+
+    def test_split_by_context(self):
+        splits = self.dataset.split_indices(
+            self.examples, [0.5, 0.5], seed=3, group_by_context=True
+        )
+        self.assert_partition(splits)
+        first, second = (set(self.contexts[split]) for split in splits)
+        self.assertEqual(first & second, set())
+        self.assertEqual([len(split) for split in splits], [50, 50])
+
+    def test_stratified_split(self):
+        labels = np.array(list(self.dataset.get_labels('dev').values()))
+        splits = self.dataset.split_indices(
+            self.examples, [0.5, 0.5], seed=0, stratify='label'
+        )
+        for label in np.unique(labels):
+            counts = [np.sum(labels[split] == label) for split in splits]
+            self.assertLessEqual(abs(counts[0] - counts[1]), 1)
+
+    def test_split_examples(self):
+        train, test = self.dataset.split_examples(
+            self.examples, [0.8, 0.2], seed=0
+        )
+        self.assertEqual((len(train), len(test)), (80, 20))
+        self.assertEqual(
+            set(ex.example_id for ex in train + test),
+            set(ex.example_id for ex in self.examples),
+        )
+
+    def test_invalid_splits(self):
+        with self.assertRaises(ValueError):
+            self.dataset.split_indices(self.examples, [0.3, 0.1])
+        with self.assertRaises(ValueError):
+            self.dataset.split_indices(
+                self.examples, [0.5, 0.5], stratify='unknown'
+            )
+        with self.assertRaises(ValueError):
+            list(self.dataset.iter_folds(self.examples, 1))
+
+    def test_folds(self):
+        for group_by_context in (False, True):
+            folds = list(self.dataset.iter_folds(
+                self.examples, 4, seed=2, stratify='label',
+                group_by_context=group_by_context,
+            ))
+            self.assertEqual(len(folds), 4)
+            self.assert_partition([test for _, test in folds])
+            for train, test in folds:
+                self.assertEqual(
+                    sorted(np.concatenate([train, test]).tolist()),
+                    list(range(100)),
+                )
+                self.assertTrue(15 <= len(test) <= 35)
+                if group_by_context:
+                    self.assertEqual(
+                        set(self.contexts[train]) &
+                        set(self.contexts[test]),
+                        set()
+                    )
+
+
+class TestSplitCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data = make_dataset(
+            self.tmp_dir.name, nof_contexts=4, no_answer_text='None'
+        )
+        make_dataset(self.tmp_dir.name, nof_contexts=3, split='train')
+        self.loads = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make(self, **kwargs):
+        # counts the parses of each split
+        dataset = Dataset(
+            data_path=self.tmp_dir.name, task='generic', **kwargs
+        )
+        for split, load_fn in list(dataset.split_to_get_map.items()):
+            dataset.split_to_get_map[split] = (
+                lambda split=split, load_fn=load_fn:
+                self.loads.append(split) or load_fn()
+            )
+        return dataset
+
+    def test_memoized(self):
+        dataset = self.make()
+        examples = dataset.get_split('dev')
+        examples.pop()
+        self.assertEqual(len(dataset.get_split('dev')), 20)
+        self.assertIs(dataset.get_index('dev'), dataset.get_index(['dev']))
+        dataset.get_labels('dev')
+        self.assertEqual(self.loads, ['dev'])
+
+    def test_least_recently_used(self):
+        dataset = self.make(max_cached_splits=1)
+        for split in ('dev', 'dev', 'train', 'dev'):
+            dataset.get_split(split)
+        self.assertEqual(self.loads, ['dev', 'train', 'dev'])
+        self.loads.clear()
+        dataset = self.make(max_cached_splits=0)
+        dataset.get_split('dev')
+        dataset.get_split('dev')
+        self.assertEqual(self.loads, ['dev', 'dev'])
+
+    def test_invalidate(self):
+        dataset = self.make()
+        both = dataset.get_index(['dev', 'train'])
+        train = dataset.get_index('train')
+        self.assertEqual(len(both), 35)
+        make_dataset(self.tmp_dir.name, nof_contexts=2)
+        self.assertEqual(len(dataset.get_index('dev')), 20)
+        dataset.invalidate('dev')
+        self.assertEqual(len(dataset.get_index('dev')), 10)
+        self.assertEqual(len(dataset.get_index(['dev', 'train'])), 25)
+        self.assertIs(dataset.get_index('train'), train)
+        dataset.invalidate()
+        self.assertIsNot(dataset.get_index('train'), train)
+        self.assertEqual(self.loads, ['dev', 'train', 'dev', 'train'])
+
+    def test_invalidate_options(self):
+        dataset = self.make()
+        train = dataset.get_index('train')
+        dataset.get_index(['dev', 'train'])
+        self.assertEqual(len(dataset.options), 35)
+        for _ in range(3):
+            dataset.invalidate('dev')
+            dev = dataset.get_index('dev')
+        # rows of the invalidated dev reads are not kept
+        self.assertEqual(len(dataset.options), 35)
+        self.assertIs(dataset.get_index('train'), train)
+        self.assertIs(train.options, dataset.options)
+        for index in (train, dev):
+            self.assertEqual(
+                [index.options.row(row) for row in index.option_rows],
+                [ex.endings for ex in index.examples]
+            )
+
+    def test_index(self):
+        dataset = self.make()
+        examples = dataset.get_split('dev')
+        index = dataset.get_index('dev')
+        example_ids = [dataset.get_example_id(ex) for ex in examples]
+        np.testing.assert_array_equal(index.example_ids, example_ids)
+        np.testing.assert_array_equal(
+            index.get_rows(example_ids[::-1]), np.arange(20)[::-1]
+        )
+        labels = [label_to_id(ex.label) for ex in examples]
+        np.testing.assert_array_equal(index.labels, labels)
+        positions = index.no_answer_positions('NONE')
+        self.assertIs(index.no_answer_positions('none'), positions)
+        np.testing.assert_array_equal(
+            positions,
+            [
+                ex.endings.index('None') if 'None' in ex.endings else -1
+                for ex in examples
+            ]
+        )
+        np.testing.assert_array_equal(
+            index.gold_text_mask('none'),
+            [
+                ex.endings[label] == 'None'
+                for ex, label in zip(examples, labels)
+            ]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
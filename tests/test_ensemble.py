@@ -0,0 +1,172 @@
+"""Tests for `mcqa_utils.ensemble` and the --ensemble flags."""
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from mcqa_utils import mcqa_utils
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.utils import label_to_id
+from mcqa_utils.ensemble import (
+    StackedPredictions,
+    build_answers,
+    ensemble_scores,
+    greedy_selection,
+)
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+def parse(*flags):
+    with mock.patch.object(sys, 'argv', ['mcqa_utils'] + list(flags)):
+        return mcqa_utils.parse_flags()
+
+
+class TestEnsemble(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmp_dir.name, 'data')
+        data = make_dataset(self.data_dir, nof_contexts=8)
+        self.paths = [
+            write_json(
+                make_nbest(data, seed=seed, accuracy=0.3 + 0.15 * seed),
+                os.path.join(self.tmp_dir.name, f'nbest_{seed}.json')
+            )
+            for seed in range(4)
+        ]
+        dataset = Dataset(data_path=self.data_dir, task='generic')
+        self.gold_answers = dataset.get_gold_answers('dev')
+        self.stacked = StackedPredictions.load(
+            self.paths, self.gold_answers, id_codec=dataset.id_codec
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def accuracy(self, answers):
+        return float(np.mean([
+            label_to_id(ans.pred_label) == gold.get_answer()
+            for gold, ans in zip(self.gold_answers, answers)
+        ]))
+
+    def subset_accuracy(self, subset):
+        probs = self.stacked.probs[list(subset)].mean(axis=0)
+        gold = [gold.get_answer() for gold in self.gold_answers]
+        return float(np.mean(probs.argmax(axis=1) == gold))
+
+    def test_scores(self):
+        probs, logits = self.stacked.probs, self.stacked.logits
+        np.testing.assert_allclose(
+            ensemble_scores(self.stacked, 'mean_probs'), probs.mean(axis=0)
+        )
+        mean_logits = logits.mean(axis=0)
+        expected = np.exp(mean_logits)
+        expected /= expected.sum(axis=1, keepdims=True)
+        np.testing.assert_allclose(
+            ensemble_scores(self.stacked, 'mean_logits'), expected
+        )
+        votes = ensemble_scores(self.stacked, 'vote')
+        np.testing.assert_allclose(votes.sum(axis=1), 1.0)
+        for question in range(probs.shape[1]):
+            choices = probs[:, question].argmax(axis=1)
+            np.testing.assert_allclose(
+                votes[question], np.bincount(choices, minlength=4) / 4
+            )
+        with self.assertRaises(ValueError):
+            ensemble_scores(self.stacked, 'median')
+
+    def test_build_answers(self):
+        scores = ensemble_scores(self.stacked, 'mean_probs')
+        answers = build_answers(
+            self.gold_answers, scores, self.stacked.widths
+        )
+        for gold, ans, row in zip(self.gold_answers, answers, scores):
+            self.assertEqual(ans.example_id, gold.example_id)
+            self.assertEqual(ans.pred_label, 'ABCD'[int(np.argmax(row))])
+            np.testing.assert_allclose(ans.probs, row)
+            self.assertIsNone(ans.logits)
+
+    def test_greedy_selection(self):
+        # forward selection over mean probs, by hand
+        selected, remaining, best_score = [], list(range(4)), -np.inf
+        while len(remaining) > 0:
+            scores = [
+                self.subset_accuracy(selected + [index])
+                for index in remaining
+            ]
+            best = int(np.argmax(scores))
+            if scores[best] <= best_score:
+                break
+            best_score = scores[best]
+            selected.append(remaining.pop(best))
+
+        selection = greedy_selection(
+            self.stacked, 'mean_probs', self.gold_answers, self.accuracy
+        )
+        self.assertEqual(
+            selection['models'], [self.paths[index] for index in selected]
+        )
+        self.assertAlmostEqual(selection['score'], best_score)
+        np.testing.assert_allclose(
+            selection['scores'],
+            self.stacked.probs[selected].mean(axis=0)
+        )
+        history = [step['score'] for step in selection['history']]
+        self.assertEqual(history, sorted(set(history)))
+
+        selection = greedy_selection(
+            self.stacked, 'mean_probs', self.gold_answers, self.accuracy,
+            max_size=1
+        )
+        self.assertEqual(len(selection['models']), 1)
+
+    def test_selection_cli(self):
+        output = os.path.join(self.tmp_dir.name, 'results.json')
+        args = parse(
+            '-d', self.data_dir, '-T', 'generic', '--no_cache', '-m', 'avg',
+            '--ensemble', *self.paths, '--ensemble_select', 'avg', '-o', output
+        )
+        mcqa_utils.mcqa(args)
+        with open(output) as fin:
+            results = json.load(fin)
+        self.assertEqual(
+            set(results),
+            {'mean_probs', 'mean_logits', 'vote', 'ensemble_selection'}
+        )
+        selection = results['ensemble_selection']
+        self.assertEqual(selection['metric'], 'avg')
+        self.assertTrue(set(selection['models']) <= set(self.paths))
+
+    def test_flags(self):
+        common = [
+            '-d', self.data_dir, '-T', 'generic', '-m', 'avg',
+            '--ensemble', *self.paths,
+        ]
+        # no single scalar to select on
+        for metric in ('f1', 'confusion_matrix', 'brier', 'unknown'):
+            with self.assertRaises(ValueError):
+                parse(*common, '--ensemble_select', metric)
+        with self.assertRaises(ValueError):
+            parse('-d', self.data_dir, '-n', self.paths[0],
+                  '--ensemble_select', 'avg')
+        # ensembled answers have no logits
+        for flags in (
+            ['-pf', 'logits'],
+            ['-pf', 'softmax'],
+            ['-pf', 'margin', '--temperature', '2'],
+        ):
+            with self.assertRaises(ValueError):
+                parse(*common, *flags)
+        for field in ('probs', 'margin', 'neg_entropy'):
+            args = parse(*common, '-pf', field, '--ensemble_select', 'avg')
+            self.assertEqual(args.probs_field, field)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Tests for `mcqa_utils.expected`."""
+import sys
+import itertools
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from mcqa_utils import mcqa_utils
+from mcqa_utils.answer import Answer, apply_threshold_to_answers
+from mcqa_utils.metric import C_at_1, Average, UtilityFunction
+from mcqa_utils.expected import (
+    count_moments,
+    expected_c_at_1,
+    expected_metrics,
+    fill_unanswered_prob,
+)
+
+
+class TestExpectedMetrics(unittest.TestCase):
+
+    def test_count_moments(self):
+        rng = np.random.default_rng(0)
+        probs = rng.dirichlet(np.ones(3), size=4)
+        p_x, p_y = probs[:, 0], probs[:, 1]
+        moments = count_moments(p_x, p_y, x_offset=2, y_offset=1)
+        expected = np.zeros((3, 3))
+        c_at_1 = [0.0, 0.0]
+        for outcomes in itertools.product(range(3), repeat=4):
+            weight = np.prod([probs[i, o] for i, o in enumerate(outcomes)])
+            x = 2 + outcomes.count(0)
+            y = 1 + outcomes.count(1)
+            for a in range(3):
+                for b in range(3):
+                    expected[a, b] += weight * x ** a * y ** b
+            value = x / 7 + x * y / 49
+            c_at_1[0] += weight * value
+            c_at_1[1] += weight * value ** 2
+        np.testing.assert_allclose(moments, expected)
+        mean, variance = expected_c_at_1(moments, 7)
+        self.assertAlmostEqual(mean, c_at_1[0])
+        self.assertAlmostEqual(variance, c_at_1[1] - c_at_1[0] ** 2)
+
+    def test_uniform_unanswered_prob(self):
+        rng = np.random.default_rng(1)
+        probs = rng.uniform(size=(200000, 4))
+        max_probs = (probs / probs.sum(axis=1, keepdims=True)).max(axis=1)
+        for threshold in (0.3, 0.45, 0.6):
+            self.assertAlmostEqual(
+                fill_unanswered_prob('uniform', 4, threshold),
+                np.mean(max_probs <= threshold),
+                places=2,
+            )
+        self.assertEqual(fill_unanswered_prob('random', 4, 0.5), 0.0)
+        self.assertEqual(fill_unanswered_prob('0.1', 4, 0.5), 1.0)
+
+    def test_random_fill_against_enumeration(self):
+        gold_labels = 'ABCDAB'
+        observed = {0: 'A', 1: 'C', 3: 'D'}
+        filled_mask = [index not in observed for index in range(6)]
+        gold = [
+            Answer(example_id=index, pred_label=label)
+            for index, label in enumerate(gold_labels)
+        ]
+        utility = UtilityFunction()
+        utility.utility = [0.25, -0.5, 1]
+        metrics = [C_at_1(), Average(), utility]
+
+        def answers_for(fills):
+            fills = iter(fills)
+            answers = []
+            for index in range(6):
+                if filled_mask[index]:
+                    probs = np.eye(4)[next(fills)].tolist()
+                else:
+                    # observed answers abstain under the higher threshold
+                    probs = [0.1] * 4
+                    probs['ABCD'.index(observed[index])] = 0.7
+                answers.append(Answer(
+                    example_id=index,
+                    pred_label='ABCD'[int(np.argmax(probs))],
+                    probs=probs,
+                ))
+            return answers
+
+        for threshold in (0.0, 0.8):
+            values = {metric: [] for metric in ('C_at_1', 'avg', 'utility')}
+            for fills in itertools.product(range(4), repeat=3):
+                answers = answers_for(fills)
+                apply_threshold_to_answers(answers, threshold)
+                for key, metric in zip(values, metrics):
+                    values[key].append(metric(gold, answers).value)
+            answers = answers_for((0, 0, 0))
+            apply_threshold_to_answers(answers, threshold)
+            results = expected_metrics(
+                metrics, gold, answers, filled_mask, 'random', 4,
+                threshold=threshold,
+            )
+            for key, metric in zip(values, metrics):
+                self.assertAlmostEqual(
+                    results[metric.name], np.mean(values[key])
+                )
+                self.assertAlmostEqual(
+                    results[f'{metric.name}_variance'], np.var(values[key])
+                )
+
+
+class TestFillFlag(unittest.TestCase):
+
+    def parse(self, *flags):
+        argv = ['mcqa_utils', '-d', 'data', '-m', 'avg', '-n', 'nbest.json']
+        with mock.patch.object(sys, 'argv', argv + list(flags)):
+            return mcqa_utils.parse_flags()
+
+    def test_fill_values(self):
+        for value in ('-0.5', '-1', 'inf', 'nan', 'half'):
+            with self.assertRaises(ValueError):
+                self.parse('-fm', value)
+        for value in ('Uniform', 'random', '0', '0.25', '1'):
+            self.assertEqual(self.parse('-fm', value).fill_missing, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""Tests for `mcqa_utils.ids`."""
+import unittest
+
+import numpy as np
+
+from mcqa_utils.ids import IdCodec
+
+
+class TestIdCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        codec = IdCodec()
+        example_id = codec.from_str('race-high-12')
+        self.assertEqual(codec.decode(example_id), ('race-high', 12))
+        self.assertEqual(codec.to_str(example_id), 'race-high-12')
+        self.assertEqual(codec.as_id('race-high-12'), example_id)
+        self.assertEqual(codec.as_id(np.int64(example_id)), example_id)
+
+    def test_order_and_grouping(self):
+        codec = IdCodec()
+        ids = np.array([
+            codec.encode('b', 1), codec.encode('a', 0), codec.encode('b', 0),
+        ], dtype=np.int64)
+        # contexts sort in order of first appearance
+        self.assertEqual(
+            [codec.to_str(value) for value in np.sort(ids)],
+            ['b-00', 'b-01', 'a-00']
+        )
+        self.assertEqual(codec.context_index(ids).tolist(), [0, 1, 0])
+        self.assertEqual(codec.question_index(ids).tolist(), [1, 0, 0])
+
+    def test_invalid_ids(self):
+        codec = IdCodec()
+        for bad_id in ('no_question', 'context-q1', '-3'):
+            with self.assertRaisesRegex(ValueError, repr(bad_id)):
+                codec.from_str(bad_id)
+        with self.assertRaises(ValueError):
+            codec.encode('context', codec.question_mask + 1)
+
+    def test_codecs_are_independent(self):
+        first, second = IdCodec(), IdCodec()
+        first.from_str('x-0')
+        self.assertEqual(second.from_str('y-0'), 0)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(first.context_names, ['x'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""Tests for `mcqa_utils.json_codec`."""
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from mcqa_utils import json_codec
+from mcqa_utils.answer import Answer
+from mcqa_utils.metric import ConfusionMatrix
+
+
+class TestJsonCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.value = dict(
+            probs=np.array([0.25, 0.75]),
+            count=np.int64(3),
+            nested=[dict(value=np.float32(0.5)), 'text', None],
+        )
+        self.expected = dict(
+            probs=[0.25, 0.75], count=3, nested=[dict(value=0.5), 'text', None]
+        )
+
+    def check_round_trip(self):
+        for compact in (True, False):
+            data = json_codec.dumps(self.value, compact=compact)
+            self.assertEqual(json.loads(data), self.expected)
+            self.assertEqual(json_codec.loads(data), self.expected)
+        self.assertNotIn(' ', json_codec.dumps(self.value, compact=True))
+
+    def test_round_trip(self):
+        self.check_round_trip()
+
+    def test_stdlib_fallback(self):
+        with mock.patch.object(json_codec, 'orjson', None):
+            self.check_round_trip()
+
+    def test_unserializable(self):
+        with mock.patch.object(json_codec, 'orjson', None):
+            with self.assertRaises(TypeError):
+                json_codec.dumps(dict(value=object()))
+
+    def test_load_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'data.json')
+            json_codec.dump(self.value, path)
+            for use_mmap in (True, False):
+                self.assertEqual(
+                    json_codec.load(path, use_mmap=use_mmap), self.expected
+                )
+            empty = os.path.join(tmp_dir, 'empty.json')
+            open(empty, 'w').close()
+            with self.assertRaises(ValueError):
+                json_codec.load(empty)
+
+    def test_confusion_matrix_is_serializable(self):
+        labels = ['A', 'B', 'C', 'D', 'A', 'B']
+        preds = ['A', 'B', 'D', 'D', 'B', 'B']
+        gold = [
+            Answer(example_id=index, pred_label=label)
+            for index, label in enumerate(labels)
+        ]
+        answers = [
+            Answer(example_id=index, pred_label=label)
+            for index, label in enumerate(preds)
+        ]
+        output = ConfusionMatrix()(gold, answers)
+        # counts stay numpy, the codec serializes them without tolist()
+        self.assertIsInstance(output.true_positive, np.ndarray)
+        expected = json.loads(json.dumps({
+            key: value.tolist() if isinstance(value, np.ndarray) else value
+            for key, value in output.__dict__.items()
+        }))
+        self.assertEqual(
+            json_codec.loads(json_codec.dumps(output.__dict__)), expected
+        )
+        with mock.patch.object(json_codec, 'orjson', None):
+            self.assertEqual(
+                json.loads(json_codec.dumps(output.__dict__)), expected
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
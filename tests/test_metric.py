@@ -0,0 +1,230 @@
+"""Tests for the calibration and ranking metrics in `mcqa_utils.metric`."""
+import unittest
+
+import numpy as np
+
+from sklearn.metrics import brier_score_loss, log_loss
+
+from mcqa_utils.answer import Answer, apply_prob_field_to_answers
+from mcqa_utils.metric import (
+    Brier,
+    CalibrationError,
+    MeanRank,
+    MeanReciprocalRank,
+    NegativeLogLikelihood,
+    TopK,
+    UtilityFunction,
+    evaluate_utilities,
+    gold_ranks,
+    utility_values,
+)
+
+
+def make_answers(logits, gold):
+    probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    answers = [
+        Answer(
+            example_id=index,
+            pred_label='ABCD'[int(row.argmax())],
+            probs=row.tolist(),
+            logits=row_logits.tolist(),
+        )
+        for index, (row, row_logits) in enumerate(zip(probs, logits))
+    ]
+    gold_answers = [
+        Answer(example_id=index, pred_label=label, label=label)
+        for index, label in enumerate(gold.tolist())
+    ]
+    return probs, gold_answers, answers
+
+
+class TestCalibrationMetrics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.logits = rng.normal(scale=2.0, size=(300, 4))
+        self.gold = rng.integers(4, size=300)
+        self.probs, self.gold_answers, self.answers = make_answers(
+            self.logits, self.gold
+        )
+
+    def test_brier(self):
+        expected = brier_score_loss(
+            self.gold, self.probs, labels=[0, 1, 2, 3]
+        )
+        self.assertAlmostEqual(
+            Brier()(self.gold_answers, self.answers).value, expected
+        )
+
+    def test_nll(self):
+        expected = log_loss(self.gold, self.probs, labels=[0, 1, 2, 3])
+        self.assertAlmostEqual(
+            NegativeLogLikelihood()(self.gold_answers, self.answers).value,
+            expected
+        )
+        # logits are normalized into the same probabilities
+        apply_prob_field_to_answers(self.answers, 'logits')
+        self.assertAlmostEqual(
+            NegativeLogLikelihood()(self.gold_answers, self.answers).value,
+            expected
+        )
+
+    def test_ece(self):
+        metric = CalibrationError()
+        output = metric(self.gold_answers, self.answers)
+        confidence = self.probs.max(axis=1)
+        correct = self.probs.argmax(axis=1) == self.gold
+        # right closed bins, by hand
+        ece, gaps = 0.0, []
+        edges = np.linspace(0, 1, metric.nof_bins + 1)
+        for low, high in zip(edges[:-1], edges[1:]):
+            in_bin = (confidence > low) & (confidence <= high)
+            if not in_bin.any():
+                continue
+            gap = abs(correct[in_bin].mean() - confidence[in_bin].mean())
+            ece += in_bin.sum() / len(confidence) * gap
+            gaps.append(gap)
+        self.assertAlmostEqual(output.value, ece)
+        self.assertAlmostEqual(output.max_error, max(gaps))
+        self.assertEqual(sum(output.reliability_count), 300)
+
+    def test_needs_nbest(self):
+        flat = [
+            Answer(example_id=ans.example_id, pred_label=ans.pred_label)
+            for ans in self.answers
+        ]
+        for metric in (Brier(), NegativeLogLikelihood(), CalibrationError()):
+            with self.assertRaises(ValueError):
+                metric(self.gold_answers, flat)
+
+
+class TestRankingMetrics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        # rounded scores, so that options tie
+        self.scores = np.round(rng.random((200, 4)), 1)
+        self.gold = rng.integers(4, size=200)
+        self.answers = [
+            Answer(
+                example_id=index,
+                pred_label='ABCD'[int(row.argmax())],
+                probs=row.tolist(),
+            )
+            for index, row in enumerate(self.scores)
+        ]
+        self.gold_answers = [
+            Answer(example_id=index, pred_label=label, label=label)
+            for index, label in enumerate(self.gold.tolist())
+        ]
+        # ties go to the first option, as argmax
+        order = np.argsort(-self.scores, axis=1, kind='stable')
+        self.ranks = np.array([
+            row.tolist().index(gold) + 1
+            for row, gold in zip(order, self.gold)
+        ])
+
+    def test_gold_ranks(self):
+        np.testing.assert_array_equal(
+            gold_ranks(self.gold_answers, self.answers), self.ranks
+        )
+        first = self.ranks == 1
+        np.testing.assert_array_equal(
+            first, self.scores.argmax(axis=1) == self.gold
+        )
+
+    def test_metrics(self):
+        for k in (1, 2, 3):
+            metric = TopK()
+            metric.k = k
+            output = metric(self.gold_answers, self.answers)
+            self.assertEqual(metric.name, f'top_{k}')
+            self.assertEqual(output.correct, int((self.ranks <= k).sum()))
+            self.assertAlmostEqual(output.value, np.mean(self.ranks <= k))
+        self.assertAlmostEqual(
+            MeanReciprocalRank()(self.gold_answers, self.answers).value,
+            np.mean(1 / self.ranks)
+        )
+        self.assertAlmostEqual(
+            MeanRank()(self.gold_answers, self.answers).value,
+            np.mean(self.ranks)
+        )
+
+    def test_padded_options(self):
+        # three options, the padded fourth never ranks ahead of the gold
+        answers = [
+            Answer(example_id=0, pred_label='A', probs=[0.0, 0.0, 0.0]),
+            Answer(example_id=1, pred_label='A', probs=[0.5, 0.2, 0.3, 0.0]),
+        ]
+        gold_answers = [
+            Answer(example_id=0, pred_label='C', label='C'),
+            Answer(example_id=1, pred_label='D', label='D'),
+        ]
+        np.testing.assert_array_equal(
+            gold_ranks(gold_answers, answers), [3, 4]
+        )
+
+
+class TestUtilityFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.utilities = [[0, -0.25, 1], [0.5, -1, 2], [-0.1, 0, 1]]
+
+    def test_utility_values(self):
+        correct = np.array([0, 3, 5, 10])
+        unanswered = np.array([10, 4, 5, 0])
+        values = utility_values(self.utilities, correct, unanswered, 10)
+        self.assertEqual(values.shape, (3, 4))
+        for row, (u_unanswered, u_wrong, u_right) in enumerate(
+            self.utilities
+        ):
+            np.testing.assert_allclose(
+                values[row],
+                (
+                    u_unanswered * unanswered +
+                    u_wrong * (10 - correct - unanswered) +
+                    u_right * correct
+                ) / 10
+            )
+        np.testing.assert_allclose(
+            utility_values(self.utilities, 5, 5, 10), values[:, 2]
+        )
+
+    def test_evaluate_utilities(self):
+        rng = np.random.default_rng(2)
+        gold = rng.integers(4, size=50).tolist()
+        # -1 abstains
+        given = rng.integers(-1, 4, size=50).tolist()
+        gold_answers = [
+            Answer(example_id=index, pred_label=label, label=label)
+            for index, label in enumerate(gold)
+        ]
+        answers = [
+            Answer(example_id=index, pred_label=label)
+            for index, label in enumerate(given)
+        ]
+        metrics = []
+        for utility in self.utilities:
+            metric = UtilityFunction()
+            metric.utility = utility
+            metrics.append(metric)
+        outputs = evaluate_utilities(metrics, gold_answers, answers)
+        for metric, output in zip(metrics, outputs):
+            u_unanswered, u_wrong, u_right = metric.utility
+            expected = np.mean([
+                u_unanswered if ans == -1 else
+                u_right if ans == label else u_wrong
+                for ans, label in zip(given, gold)
+            ])
+            self.assertAlmostEqual(output.value, expected)
+            self.assertEqual(
+                metric.name,
+                'utility_function_' + '_'.join(map(str, metric.utility))
+            )
+            self.assertAlmostEqual(
+                metric(gold_answers, answers).value, output.value
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
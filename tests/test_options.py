@@ -0,0 +1,89 @@
+"""Tests for `mcqa_utils.options`."""
+import pickle
+import unittest
+
+import numpy as np
+
+from mcqa_utils.answer import Answer
+from mcqa_utils.options import OptionTable
+
+
+class TestOptionTable(unittest.TestCase):
+
+    def setUp(self):
+        self.endings = [
+            ['red', 'green', 'None of the above', 'blue'],
+            ['none of the above', 'red', 'NONE OF THE ABOVE'],
+            ['one', 'two'],
+            ['', 'red', 'green', 'blue', 'Ünïcode'],
+        ]
+        self.table = OptionTable()
+        self.rows = self.table.add_rows(self.endings)
+
+    def test_rows(self):
+        np.testing.assert_array_equal(self.rows, np.arange(4))
+        for row, endings in zip(self.rows, self.endings):
+            self.assertEqual(self.table.row(row), endings)
+        # every distinct text once
+        self.assertEqual(
+            sorted(self.table.texts),
+            sorted(set(text for row in self.endings for text in row))
+        )
+        more = self.table.add_rows([['red', 'new']])
+        np.testing.assert_array_equal(more, [4])
+        self.assertEqual(self.table.row(4), ['red', 'new'])
+        self.assertEqual(self.table.row(0), self.endings[0])
+
+    def test_text_positions(self):
+        expected = [
+            next((
+                position for position, text in enumerate(row)
+                if text.lower() == 'none of the above'
+            ), -1)
+            for row in self.endings
+        ]
+        np.testing.assert_array_equal(
+            self.table.text_positions(self.rows, 'NONE of the above'),
+            expected
+        )
+        np.testing.assert_array_equal(
+            self.table.text_positions(self.rows[::-1], 'red'), [1, -1, 1, 0]
+        )
+
+    def test_gold_contains(self):
+        labels = np.array([2, 1, -1, 4])
+        np.testing.assert_array_equal(
+            self.table.gold_contains(self.rows, labels, 'NONE'),
+            [True, False, False, False]
+        )
+        np.testing.assert_array_equal(
+            self.table.gold_contains(self.rows, labels, 'ünï'),
+            [False, False, False, True]
+        )
+
+    def test_pickle(self):
+        copy = pickle.loads(pickle.dumps(self.table))
+        self.assertEqual(copy.texts, self.table.texts)
+        for row, endings in zip(self.rows, self.endings):
+            self.assertEqual(copy.row(row), endings)
+        np.testing.assert_array_equal(
+            copy.text_positions(self.rows, 'red'),
+            self.table.text_positions(self.rows, 'red')
+        )
+        # lookups are rebuilt on the first new row
+        copy.add_rows([['blue', 'black']])
+        self.assertEqual(len(copy.texts), len(self.table.texts) + 1)
+        self.assertEqual(copy.row(4), ['blue', 'black'])
+
+    def test_answer_endings(self):
+        answer = Answer(
+            example_id=0, pred_label='A', option_table=self.table,
+            option_row=1,
+        )
+        self.assertEqual(answer.endings, self.endings[1])
+        answer.no_answer_text = 'none of the above'
+        self.assertEqual(answer.search_unanswerable_option(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests for `mcqa_utils.outcomes`."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.question_answering import QASystemForMCOffline
+from mcqa_utils.outcomes import outcome_arrays, write_outcomes
+from mcqa_utils.answer import (
+    apply_prob_field_to_answers,
+    apply_threshold_to_answers,
+)
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+class TestOutcomes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data = make_dataset(self.tmp_dir.name)
+        self.path = write_json(
+            make_nbest(data), os.path.join(self.tmp_dir.name, 'nbest.json')
+        )
+        self.dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.gold_answers = self.dataset.get_gold_answers('dev')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def get_answers(self, field=None, threshold=0.5):
+        qa_system = QASystemForMCOffline(
+            self.path, id_codec=self.dataset.id_codec
+        )
+        answers, _ = qa_system.get_answers(self.gold_answers)
+        if field is not None:
+            apply_prob_field_to_answers(answers, field)
+        return apply_threshold_to_answers(answers, threshold)
+
+    def test_columns_follow_get_answer(self):
+        for field, threshold in (
+            (None, 0.5), ('logits', 1.0), ('margin', 0.3)
+        ):
+            answers = self.get_answers(field, threshold)
+            columns = outcome_arrays(self.gold_answers, answers)
+            expected = [ans.get_answer() for ans in answers]
+            np.testing.assert_array_equal(columns['answer'], expected)
+            np.testing.assert_array_equal(
+                columns['abstained'],
+                [ans.get_max_prob() <= threshold for ans in answers]
+            )
+            np.testing.assert_allclose(
+                columns['max_prob'], [ans.get_max_prob() for ans in answers]
+            )
+            np.testing.assert_array_equal(
+                columns['correct'],
+                np.asarray(expected) == columns['gold']
+            )
+            self.assertTrue(columns['abstained'].any())
+            self.assertFalse(columns['abstained'].all())
+
+    def test_masks(self):
+        answers = self.get_answers()
+        mask = [index % 2 == 0 for index in range(len(answers))]
+        columns = outcome_arrays(
+            self.gold_answers, answers, masks=[mask], prefixes=['even']
+        )
+        np.testing.assert_array_equal(columns['even'], mask)
+
+    def test_round_trip(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = outcome_arrays(self.gold_answers, self.get_answers())
+        for name in ('outcomes.parquet', 'outcomes.arrow'):
+            path = os.path.join(self.tmp_dir.name, 'out', name)
+            write_outcomes(
+                path, columns, id_codec=self.dataset.id_codec,
+                metadata=dict(threshold=0.5)
+            )
+            if name.endswith('.parquet'):
+                table = pq.read_table(path)
+            else:
+                table = pa.ipc.open_file(path).read_all()
+            self.assertEqual(table.schema.metadata[b'threshold'], b'0.5')
+            for column, values in columns.items():
+                np.testing.assert_array_equal(
+                    table.column(column).to_numpy(), values
+                )
+            contexts = table.column('context').to_pylist()
+            questions = table.column('question').to_pylist()
+            self.assertEqual(
+                [
+                    self.dataset.id_codec.encode(context, question)
+                    for context, question in zip(contexts, questions)
+                ],
+                columns['example_id'].tolist()
+            )
+
+        with self.assertRaises(ValueError):
+            write_outcomes(os.path.join(self.tmp_dir.name, 'x.csv'), columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
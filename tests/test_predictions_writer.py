@@ -0,0 +1,96 @@
+"""Tests for `mcqa_utils.predictions_writer`."""
+import io
+import os
+import json
+import tempfile
+import unittest
+
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.question_answering import QASystemForMCOffline
+from mcqa_utils.predictions_writer import PredictionsWriter
+
+from tests.helpers import (
+    make_dataset,
+    make_nbest,
+    make_predictions,
+    write_json,
+)
+
+
+class TestPredictionsWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data = make_dataset(self.tmp_dir.name)
+        dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.gold_answers = dataset.get_gold_answers('dev')
+        self.id_codec = dataset.id_codec
+        self.paths = dict(
+            nbest=write_json(
+                make_nbest(data, missing={(1, 2), (4, 0)}),
+                os.path.join(self.tmp_dir.name, 'nbest.json'),
+            ),
+            flat=write_json(
+                make_predictions(data),
+                os.path.join(self.tmp_dir.name, 'predictions.json'),
+            ),
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def qa_system(self, kind):
+        return QASystemForMCOffline(self.paths[kind], id_codec=self.id_codec)
+
+    def write(self, qa_system, **kwargs):
+        fstream = io.StringIO()
+        qa_system.write_predictions(fstream, **kwargs)
+        return fstream.getvalue()
+
+    def test_matches_unparse(self):
+        for kind in ('nbest', 'flat'):
+            qa_system = self.qa_system(kind)
+            self.assertEqual(
+                json.loads(self.write(qa_system)),
+                json.loads(json.dumps(qa_system.unparse_predictions())),
+            )
+
+    def test_matches_unparse_with_alignment(self):
+        written = {}
+        for kind in ('nbest', 'flat'):
+            qa_system = self.qa_system(kind)
+            expected = qa_system.unparse_predictions_with_alignment(
+                self.gold_answers
+            )
+            written[kind] = json.loads(self.write(
+                qa_system,
+                answers=qa_system.get_all_answers(),
+                gold_answers=self.gold_answers,
+            ))
+            self.assertEqual(written[kind], json.loads(json.dumps(expected)))
+        # nulls keep nbest lists aligned with the dataset
+        self.assertEqual(len(written['nbest']['ctx1']), 5)
+        self.assertIsNone(written['nbest']['ctx1'][2])
+
+    def test_lines(self):
+        qa_system = self.qa_system('nbest')
+        records = [
+            json.loads(line)
+            for line in self.write(qa_system, lines=True).splitlines()
+        ]
+        self.assertEqual(len(records), len(qa_system.answers))
+        self.assertNotIn('ctx1-02', [record['id'] for record in records])
+        self.assertEqual(
+            records[0]['pred_label'],
+            qa_system.get_answer('ctx0-00').pred_label
+        )
+
+    def test_only_nulls(self):
+        fstream = io.StringIO()
+        with PredictionsWriter(fstream, self.id_codec) as writer:
+            writer.write(self.gold_answers[0].example_id, None)
+        self.assertEqual(json.loads(fstream.getvalue()), {'ctx0-00': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
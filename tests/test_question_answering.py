@@ -0,0 +1,155 @@
+"""Tests for `mcqa_utils.question_answering`."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.answer import Answer
+from mcqa_utils.question_answering import (
+    QASystemForMCOffline,
+    no_answer_positions,
+)
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+class TestFillMissing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data = make_dataset(self.tmp_dir.name)
+        self.missing = {(0, 1), (2, 3), (5, 4)}
+        self.path = write_json(
+            make_nbest(data, missing=self.missing),
+            os.path.join(self.tmp_dir.name, 'nbest.json'),
+        )
+        self.dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.gold_answers = self.dataset.get_gold_answers('dev')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def get_answers(self, strategy, seed=None):
+        qa_system = QASystemForMCOffline(
+            self.path, id_codec=self.dataset.id_codec
+        )
+        qa_system.missing_strategy = strategy
+        qa_system.missing_seed = seed
+        return qa_system.get_answers(self.gold_answers)
+
+    def missing_answers(self, answers):
+        ids = set(
+            self.dataset.id_codec.encode(f'ctx{context}', question)
+            for context, question in self.missing
+        )
+        return [ans for ans in answers if ans.example_id in ids]
+
+    def test_not_found(self):
+        answers, not_found = self.get_answers(None)
+        self.assertEqual(len(not_found), 3)
+        self.assertEqual(len(answers), len(self.gold_answers) - 3)
+
+    def test_aligned(self):
+        answers, not_found = self.get_answers('uniform', seed=0)
+        self.assertEqual(not_found, [])
+        self.assertEqual(
+            [ans.example_id for ans in answers],
+            [gold.example_id for gold in self.gold_answers],
+        )
+
+    def test_seeded(self):
+        first = self.missing_answers(self.get_answers('uniform', seed=4)[0])
+        second = self.missing_answers(self.get_answers('uniform', seed=4)[0])
+        other = self.missing_answers(self.get_answers('uniform', seed=5)[0])
+        self.assertEqual(len(first), 3)
+        self.assertEqual(
+            [ans.probs for ans in first], [ans.probs for ans in second]
+        )
+        self.assertNotEqual(
+            [ans.probs for ans in first], [ans.probs for ans in other]
+        )
+        for ans in first:
+            self.assertAlmostEqual(sum(ans.probs), 1.0)
+            self.assertEqual(
+                ans.pred_label, 'ABCD'[int(np.argmax(ans.probs))]
+            )
+
+    def test_strategies(self):
+        for ans in self.missing_answers(self.get_answers('random', 1)[0]):
+            self.assertEqual(sorted(ans.probs), [0.0, 0.0, 0.0, 1.0])
+        for ans in self.missing_answers(self.get_answers('0.3')[0]):
+            self.assertEqual(ans.probs, [0.25] * 4)
+        for ans in self.missing_answers(self.get_answers('0')[0]):
+            self.assertEqual(ans.probs, [0.0] * 4)
+
+
+class TestNoAnswerOption(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data = make_dataset(self.tmp_dir.name, no_answer_text='None')
+        self.path = write_json(
+            make_nbest(data, missing={(3, 3)}),
+            os.path.join(self.tmp_dir.name, 'nbest.json'),
+        )
+        self.dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.gold_answers = self.dataset.get_gold_answers(
+            'dev', with_text_values=True
+        )
+        # first option reading `none`, by hand
+        self.expected = [
+            [end.lower() for end in gold.endings].index('none')
+            if 'none' in [end.lower() for end in gold.endings] else -1
+            for gold in self.gold_answers
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_positions(self):
+        self.assertIn(3, self.expected)
+        self.assertIn(-1, self.expected)
+        np.testing.assert_array_equal(
+            no_answer_positions(self.gold_answers, 'NONE'), self.expected
+        )
+        # answers with their own endings, no shared option table
+        copies = [
+            Answer(example_id=gold.example_id, pred_label=gold.pred_label,
+                   endings=list(gold.endings))
+            for gold in self.gold_answers
+        ]
+        np.testing.assert_array_equal(
+            no_answer_positions(copies, 'none'), self.expected
+        )
+
+    def test_aligned_answers(self):
+        qa_system = QASystemForMCOffline(
+            self.path, id_codec=self.dataset.id_codec
+        )
+        answers, not_found = qa_system.get_answers(
+            self.gold_answers, with_text_values=True, no_answer_text='None'
+        )
+        self.assertEqual(len(not_found), 1)
+        expected = dict(zip(
+            [gold.example_id for gold in self.gold_answers], self.expected
+        ))
+        gold_by_id = {gold.example_id: gold for gold in self.gold_answers}
+        for ans in answers:
+            self.assertIsNone(ans.endings)
+            self.assertEqual(ans.no_answer_option, expected[ans.example_id])
+            # as searching the endings did
+            searched = Answer(
+                example_id=ans.example_id, pred_label=ans.pred_label,
+                endings=gold_by_id[ans.example_id].endings,
+                no_answer_text='None',
+            ).search_unanswerable_option()
+            self.assertEqual(ans.search_unanswerable_option(), searched)
+
+        with self.assertRaises(ValueError):
+            qa_system.get_answers(self.gold_answers, with_text_values=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Tests for `mcqa_utils.readers`, line and columnar predictions."""
+import os
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.question_answering import QASystemForMCOffline
+from mcqa_utils.readers import predictions_format, read_predictions
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+class TestReaders(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data = make_dataset(self.tmp_dir.name)
+        dataset = Dataset(data_path=self.tmp_dir.name, task='generic')
+        self.gold_answers = dataset.get_gold_answers('dev')
+        self.id_codec = dataset.id_codec
+        self.json_system = QASystemForMCOffline(
+            write_json(
+                make_nbest(data, missing={(1, 2), (4, 0)}),
+                self.path('nbest.json'),
+            ),
+            id_codec=self.id_codec,
+        )
+        with open(self.path('nbest.jsonl'), 'w') as fout:
+            self.json_system.write_predictions(fout, lines=True)
+        with open(self.path('nbest.jsonl')) as fin:
+            self.records = [json.loads(line) for line in fin]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def write_table(self, name, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table(columns)
+        path = self.path(name)
+        if predictions_format(path) == 'parquet':
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        return path
+
+    def record_columns(self, fields=('id', 'pred_label', 'probs', 'logits')):
+        return {
+            field: [record[field] for record in self.records]
+            for field in fields
+        }
+
+    def assert_same_answers(self, path):
+        expected, expected_missing = self.json_system.get_answers(
+            self.gold_answers
+        )
+        qa_system = QASystemForMCOffline(path, id_codec=self.id_codec)
+        answers, missing = qa_system.get_answers(self.gold_answers)
+        self.assertEqual(missing, expected_missing)
+        self.assertEqual(len(answers), len(expected))
+        for ans, other in zip(answers, expected):
+            self.assertEqual(ans.example_id, other.example_id)
+            self.assertEqual(ans.pred_label, other.pred_label)
+            np.testing.assert_allclose(ans.probs, other.probs)
+            np.testing.assert_allclose(ans.logits, other.logits)
+        return answers
+
+    def test_jsonl(self):
+        self.assertEqual(len(self.records), len(self.gold_answers) - 2)
+        self.assert_same_answers(self.path('nbest.jsonl'))
+
+    def test_columnar(self):
+        columns = self.record_columns()
+        for name in ('nbest.parquet', 'nbest.arrow'):
+            answers = self.assert_same_answers(
+                self.write_table(name, columns)
+            )
+            # rows are views of the column values
+            self.assertIsInstance(answers[0].probs, np.ndarray)
+            self.assertIs(answers[0].probs.base, answers[1].probs.base)
+
+    def test_context_question_columns(self):
+        # no pred_label, chosen from probs; nulls for the missing answers
+        columns = self.record_columns(('probs', 'logits'))
+        example_ids = [self.id_codec.as_id(rec['id']) for rec in self.records]
+        columns['context'] = [
+            self.id_codec.context_name(example_id)
+            for example_id in example_ids
+        ]
+        columns['question'] = [
+            self.id_codec.decode(example_id)[1]
+            for example_id in example_ids
+        ]
+        columns['probs'][3] = None
+        answers = read_predictions(
+            self.write_table('nbest.parquet', columns), self.id_codec
+        )
+        self.assertEqual(len(answers), len(self.records) - 1)
+        for record in self.records[:3] + self.records[4:]:
+            ans = answers[self.id_codec.as_id(record['id'])]
+            self.assertEqual(ans.pred_label, record['pred_label'])
+            np.testing.assert_allclose(ans.probs, record['probs'])
+
+    def test_ragged_lists(self):
+        columns = self.record_columns()
+        for field in ('probs', 'logits'):
+            columns[field][0] = columns[field][0][:3]
+        answers = read_predictions(
+            self.write_table('ragged.arrow', columns), self.id_codec
+        )
+        for row, str_id in enumerate(columns['id']):
+            ans = answers[self.id_codec.as_id(str_id)]
+            np.testing.assert_allclose(ans.probs, columns['probs'][row])
+            np.testing.assert_allclose(ans.logits, columns['logits'][row])
+
+    def test_missing_ids(self):
+        path = self.write_table(
+            'noids.parquet', self.record_columns(('pred_label', 'probs'))
+        )
+        with self.assertRaises(ValueError):
+            read_predictions(path, self.id_codec)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""Tests for `mcqa_utils.results_store`."""
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from mcqa_utils import json_codec, mcqa_utils
+from mcqa_utils.results_store import ResultsStore, results_to_rows
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+def run_mcqa(*flags):
+    with mock.patch.object(sys, 'argv', ['mcqa_utils'] + list(flags)):
+        mcqa_utils.mcqa(mcqa_utils.parse_flags())
+
+
+class TestResultsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        data_dir = os.path.join(self.tmp_dir.name, 'data')
+        data = make_dataset(data_dir, no_answer_text='none')
+        self.nbest = write_json(
+            make_nbest(data), os.path.join(self.tmp_dir.name, 'nbest.json')
+        )
+        self.common = [
+            '-d', data_dir, '-T', 'generic', '-n', self.nbest, '--no_cache',
+            '--no_answer_text', 'none',
+        ]
+        self.runs = [
+            ['-m', 'avg', 'C_at_1', '-ft'],
+            ['-m', 'avg', '-t', '0.4', '-uf', '0', '-0.25', '1'],
+            ['-m', 'C_at_1', 'brier', 'ece', '--threshold_cv', '3'],
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_export_matches_merge(self):
+        output = self.path('results.json')
+        database = self.path('results.db')
+        write_json({}, output)
+        for flags in self.runs:
+            run_mcqa(*self.common, *flags, '-o', output, '--merge')
+            run_mcqa(*self.common, *flags, '-o', output,
+                     '--results_db', database)
+        with open(output) as fin:
+            merged = json.load(fin)
+        with ResultsStore(database) as store:
+            self.assertEqual(store.files(), [output])
+            self.assertEqual(store.export(output), merged)
+            self.assertEqual(store.export('other'), {})
+
+    def test_query(self):
+        results = {
+            'avg': 0.5,
+            'has_ans': {'avg': 0.25},
+            'avg_threshold': {'avg': 0.75, 'threshold': 0.4},
+            'threshold_0.3': {'avg': 0.6},
+            'C_at_1_threshold_cv': {'C_at_1_folds': [0.1, 0.2]},
+        }
+        with ResultsStore(self.path('query.db')) as store:
+            run_id = store.add_run(results, file='a', split='dev')
+            store.add_run({'avg': 0.1}, file='b', split='test')
+            rows = store.query(file='a', metric='avg')
+            self.assertEqual(
+                [(row['grp'], row['mask'], row['threshold'], row['value'])
+                 for row in rows],
+                [('', '', None, 0.5), ('', 'has_ans', None, 0.25),
+                 ('avg_threshold', '', 0.4, 0.75),
+                 ('threshold_0.3', '', 0.3, 0.6)],
+            )
+            self.assertEqual(
+                store.query(run_id=run_id, metric='C_at_1_folds')[0]['value'],
+                [0.1, 0.2]
+            )
+            self.assertEqual(
+                [row['value'] for row in store.query(split='test')], [0.1]
+            )
+            self.assertEqual(store.export('a'), results)
+
+    def test_rows_keep_order(self):
+        results = {'b': 1, 'a': {'c': 2, 'd': [1, 2]}}
+        rows = list(results_to_rows(results))
+        self.assertEqual([row['position'] for row in rows], [0, 1, 2])
+        self.assertEqual([row['metric'] for row in rows], ['b', 'c', 'd'])
+
+    def test_numpy_values(self):
+        results = {
+            'avg': np.float64(0.5),
+            'count': np.int64(3),
+            'seen': np.bool_(True),
+            'confusion': {'true_positive': np.array([1, 2, 0, 4])},
+            'matrix': np.arange(4).reshape(2, 2),
+        }
+        rows = {row['metric']: row for row in results_to_rows(results)}
+        self.assertIs(type(rows['avg']['value']), float)
+        self.assertIs(type(rows['count']['value']), int)
+        self.assertEqual(rows['seen']['value_json'], 'true')
+        self.assertEqual(rows['true_positive']['value_json'], '[1,2,0,4]')
+        # the document --merge writes
+        expected = json_codec.loads(json_codec.dumps(results))
+        with ResultsStore(self.path('numpy.db')) as store:
+            store.add_run(results, file='a')
+            self.assertEqual(store.export('a'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+"""Tests for `mcqa_utils.sinks`."""
+import io
+import os
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from unittest import mock
+from contextlib import redirect_stdout
+
+from mcqa_utils import json_codec, mcqa_utils
+from mcqa_utils.sinks import (
+    AsyncSink,
+    FileSink,
+    JsonLinesSink,
+    MlflowSink,
+    MultiSink,
+    ResultSink,
+    SQLiteSink,
+    StdoutSink,
+)
+from mcqa_utils.results_store import ResultsStore
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+try:
+    import mlflow
+except ImportError:
+    mlflow = None
+
+
+class ListSink(ResultSink):
+
+    def __init__(self, fail_write=False, fail_close=False):
+        self.written = []
+        self.closed = False
+        self.failed = None
+        self.fail_write = fail_write
+        self.fail_close = fail_close
+
+    def write(self, results, **metadata):
+        if self.fail_write:
+            raise RuntimeError('write failed')
+        self.written.append((results, metadata))
+
+    def close(self, failed=False):
+        self.closed = True
+        self.failed = failed
+        if self.fail_close:
+            raise RuntimeError('close failed')
+
+
+class TestSinks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_file_sink(self):
+        path = self.path('results.json')
+        FileSink(path).write({'avg': 0.5, 'C_at_1': 0.1})
+        with self.assertRaises(RuntimeError):
+            FileSink(path)
+        FileSink(path, merge=True).write({'avg': 0.7})
+        with open(path) as fin:
+            self.assertEqual(json.load(fin), {'avg': 0.7, 'C_at_1': 0.1})
+        FileSink(path, overwrite=True).write({'avg': 0.2})
+        with open(path) as fin:
+            self.assertEqual(json.load(fin), {'avg': 0.2})
+
+    def test_json_lines_sink(self):
+        path = self.path('results.jsonl')
+        sink = JsonLinesSink(path)
+        sink.write({'avg': 0.5}, predictions='a.json', hash='h1', step=3)
+        sink.write({'avg': 0.6}, predictions='b.json', hash='h2')
+        with open(path, 'a') as fout:
+            fout.write('{"hash": "partial\n')
+        self.assertEqual(list(sink.read_field('hash')), ['h1', 'h2'])
+        JsonLinesSink(path, overwrite=True)
+        self.assertFalse(os.path.exists(path))
+
+    def test_async_sink(self):
+        inner = ListSink()
+        sink = AsyncSink(inner)
+        for step in range(10):
+            sink.write({'step': step}, step=step)
+        sink.flush()
+        self.assertEqual(len(inner.written), 10)
+        sink.close()
+        self.assertTrue(inner.closed)
+        with self.assertRaises(RuntimeError):
+            sink.write({})
+
+    def test_async_sink_errors(self):
+        sink = AsyncSink(ListSink(fail_write=True))
+        sink.write({'avg': 0.5})
+        with self.assertRaisesRegex(RuntimeError, 'write failed'):
+            sink.close()
+
+    def test_multi_sink_closes_all(self):
+        first = AsyncSink(ListSink(fail_write=True))
+        second, third = ListSink(), ListSink(fail_close=True)
+        sinks = MultiSink([first, second, third])
+        sinks.write({'avg': 0.5})
+        # the deferred write error is raised after closing every sink
+        with self.assertRaisesRegex(RuntimeError, 'write failed'):
+            sinks.close()
+        self.assertTrue(first.sink.closed)
+        self.assertTrue(second.closed)
+        self.assertTrue(third.closed)
+        # only the sink whose writes failed knows about it
+        self.assertTrue(first.sink.failed)
+        self.assertFalse(second.failed)
+
+    def test_close_failed(self):
+        first, second = AsyncSink(ListSink()), ListSink()
+        MultiSink([first, second]).close(failed=True)
+        self.assertTrue(first.sink.failed)
+        self.assertTrue(second.failed)
+
+    def test_sqlite_sink(self):
+        database = self.path('results.db')
+        sink = AsyncSink(SQLiteSink(database, 'out.json'))
+        sink.write({'avg': 0.5, 'has_ans': {'avg': 0.1}}, split='dev')
+        sink.close()
+        with ResultsStore(database) as store:
+            self.assertEqual(
+                store.export('out.json'), {'avg': 0.5, 'has_ans': {'avg': 0.1}}
+            )
+
+    def test_numpy_results(self):
+        # as metric outputs hold them
+        results = {
+            'avg': np.float64(0.5),
+            'count': np.int64(3),
+            'has_ans': {'ok': np.bool_(True), 'tp': np.array([1, 2])},
+        }
+        expected = {
+            'avg': 0.5, 'count': 3, 'has_ans': {'ok': True, 'tp': [1, 2]}
+        }
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            StdoutSink(compact=True).write(results)
+        self.assertEqual(json_codec.loads(stdout.getvalue()), expected)
+
+        path = self.path('results.json')
+        FileSink(path).write(results)
+        FileSink(path, merge=True).write({'extra': np.float32(0.25)})
+        self.assertEqual(
+            json_codec.load(path), dict(expected, extra=0.25)
+        )
+
+        sink = JsonLinesSink(self.path('results.jsonl'))
+        sink.write(results, hash='h1')
+        self.assertEqual(list(sink.read_field('results')), [expected])
+
+        database = self.path('results.db')
+        sink = AsyncSink(SQLiteSink(database, 'out.json'))
+        sink.write(results)
+        sink.close()
+        with ResultsStore(database) as store:
+            self.assertEqual(store.export('out.json'), expected)
+
+
+@unittest.skipIf(mlflow is None, 'mlflow is not installed')
+class TestMlflowSink(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        # recent mlflow versions only keep file stores on request
+        self.environ = mock.patch.dict(
+            os.environ, {'MLFLOW_ALLOW_FILE_STORE': 'true'}
+        )
+        self.environ.start()
+        self.previous_uri = mlflow.get_tracking_uri()
+        self.tracking_uri = 'file://' + os.path.join(
+            self.tmp_dir.name, 'mlruns'
+        )
+        mlflow.set_tracking_uri(self.tracking_uri)
+        self.client = mlflow.tracking.MlflowClient()
+        self.results = {'avg': 0.5, 'has_ans': {'avg': 0.25}, 'name': 'x'}
+
+    def tearDown(self):
+        mlflow.set_tracking_uri(self.previous_uri)
+        self.environ.stop()
+        self.tmp_dir.cleanup()
+
+    def write(self, results=None):
+        sink = AsyncSink(MlflowSink(self.tracking_uri, batch_size=1))
+        sink.write(self.results if results is None else results)
+        sink.close()
+        return sink.sink.run_id
+
+    def test_active_run(self):
+        with mlflow.start_run() as run:
+            run_id = self.write()
+            self.assertEqual(run_id, run.info.run_id)
+            self.assertEqual(mlflow.active_run().info.run_id, run_id)
+        data = self.client.get_run(run_id).data
+        self.assertEqual(data.metrics, {'avg': 0.5, 'has_ans.avg': 0.25})
+        self.assertEqual(self.client.get_run(run_id).info.status, 'FINISHED')
+
+    def test_new_run(self):
+        run_id = self.write()
+        self.assertIsNone(mlflow.active_run())
+        run = self.client.get_run(run_id)
+        self.assertEqual(run.info.status, 'FINISHED')
+        self.assertEqual(run.data.metrics['has_ans.avg'], 0.25)
+
+    def test_numpy_results(self):
+        run_id = self.write({
+            'avg': np.float64(0.5),
+            'count': np.int64(3),
+            'has_ans': {'ok': np.bool_(True), 'tp': np.array([1, 2])},
+        })
+        self.assertEqual(
+            self.client.get_run(run_id).data.metrics, {'avg': 0.5, 'count': 3}
+        )
+
+    def test_failed_run(self):
+        # a write error
+        sink = AsyncSink(MlflowSink(self.tracking_uri))
+        with mock.patch.object(
+            sink.sink.client, 'log_batch', side_effect=RuntimeError('down')
+        ):
+            sink.write(self.results)
+            with self.assertRaisesRegex(RuntimeError, 'down'):
+                sink.close()
+        run = self.client.get_run(sink.sink.run_id)
+        self.assertEqual(run.info.status, 'FAILED')
+
+        # closed on an exception path
+        sink = MultiSink([AsyncSink(MlflowSink(self.tracking_uri))])
+        sink.close(failed=True)
+        run = self.client.get_run(sink.sinks[0].sink.run_id)
+        self.assertEqual(run.info.status, 'FAILED')
+
+    def test_failed_evaluation(self):
+        data_dir = os.path.join(self.tmp_dir.name, 'data')
+        nbest = write_json(
+            make_nbest(make_dataset(data_dir)),
+            os.path.join(self.tmp_dir.name, 'nbest.json')
+        )
+        flags = [
+            'mcqa_utils', '-d', data_dir, '-T', 'generic', '-n', nbest,
+            '-m', 'avg', '--no_cache',
+            '-o', os.path.join(self.tmp_dir.name, 'out.json'),
+            '--save_mlflow', '--mlflow_tracking_uri', self.tracking_uri,
+        ]
+        with mock.patch.object(sys, 'argv', flags), mock.patch.object(
+            mcqa_utils, 'get_mcqa_results', side_effect=KeyError('gold')
+        ):
+            with self.assertRaises(KeyError):
+                mcqa_utils.mcqa(mcqa_utils.parse_flags())
+        runs = self.client.search_runs(['0'])
+        self.assertEqual([run.info.status for run in runs], ['FAILED'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,471 @@
+"""Tests for `mcqa_utils.threshold`, checked against brute force."""
+import os
+import csv
+import sys
+import json
+import tempfile
+import unittest
+
+import numpy as np
+
+from unittest import mock
+
+from mcqa_utils import mcqa_utils
+from mcqa_utils.dataset import Dataset
+from mcqa_utils.evaluate import GenericEvaluator
+from mcqa_utils.metric import Average, Brier, C_at_1, UtilityFunction
+from mcqa_utils.question_answering import QASystemForMCOffline
+from mcqa_utils.answer import apply_threshold_to_answers
+from mcqa_utils.threshold import (
+    Threshold,
+    ThresholdSketch,
+    count_sweep,
+    risk_coverage,
+    write_curve,
+)
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+def brute_counts(confidences, correct, unanswered_correct, threshold, mask):
+    answered = confidences > threshold
+    return (
+        np.sum(mask & answered & correct),
+        np.sum(mask & ~answered),
+        np.sum(mask & ~answered & unanswered_correct),
+        np.sum(mask),
+    )
+
+
+class ThresholdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = self.tmp_dir.name
+        data = make_dataset(self.data_dir, nof_contexts=12)
+        self.nbest = write_json(
+            make_nbest(data), os.path.join(self.data_dir, 'nbest.json')
+        )
+        self.dataset = Dataset(data_path=self.data_dir, task='generic')
+        self.gold_answers = self.dataset.get_gold_answers('dev')
+        qa_system = QASystemForMCOffline(
+            self.nbest, id_codec=self.dataset.id_codec
+        )
+        self.answers, _ = qa_system.get_answers(self.gold_answers)
+        self.metrics = [C_at_1(), Average()]
+        self.threshold = Threshold(GenericEvaluator(metrics=self.metrics))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def subset(self, indices):
+        return (
+            [self.gold_answers[index] for index in indices],
+            [self.answers[index] for index in indices],
+        )
+
+    def brute_best(self, metric, gold_answers, answers):
+        # every candidate threshold evaluated on the answers, ties go to
+        # the lowest one
+        candidates = sorted(set(
+            [0.0] + [ans.get_max_prob() for ans in answers]
+        ))
+        values = []
+        for candidate in candidates:
+            apply_threshold_to_answers(answers, candidate)
+            values.append(metric(gold_answers, answers).value)
+        apply_threshold_to_answers(answers, 0.0)
+        return candidates[int(np.argmax(values))], max(values)
+
+
+class TestCountSweep(unittest.TestCase):
+
+    def test_against_brute_force(self):
+        rng = np.random.default_rng(0)
+        confidences = np.round(rng.random(200), 1)
+        confidences[:5] = np.inf
+        confidences[5:10] = -np.inf
+        correct = rng.random(200) < 0.6
+        unanswered_correct = rng.random(200) < 0.2
+        thresholds = np.array([-1.0, 0.0, 0.3, 0.35, 0.5, 0.9, 1.0])
+        masks = rng.random((3, 200)) < 0.5
+        correct_counts, unanswered, unanswered_correct_counts, total = (
+            count_sweep(
+                confidences, correct, unanswered_correct, thresholds, masks
+            )
+        )
+        for row, mask in enumerate(masks):
+            for column, threshold in enumerate(thresholds):
+                self.assertEqual(
+                    (
+                        correct_counts[row, column],
+                        unanswered[row, column],
+                        unanswered_correct_counts[row, column],
+                        total[row, 0],
+                    ),
+                    brute_counts(
+                        confidences, correct, unanswered_correct, threshold,
+                        mask
+                    )
+                )
+
+
+class TestBestThreshold(ThresholdTestCase):
+
+    def test_against_brute_force(self):
+        for metric in self.metrics:
+            expected, _ = self.brute_best(
+                metric, self.gold_answers, self.answers
+            )
+            self.assertEqual(
+                self.threshold.find_best_threshold(
+                    metric, self.gold_answers, self.answers
+                ),
+                expected
+            )
+
+    def test_several_metrics(self):
+        metrics = [C_at_1(), Average(), Brier()]
+        for utility in ([0, -0.25, 1], [0, -1, 1], [0.2, -0.5, 1]):
+            metric = UtilityFunction()
+            metric.utility = utility
+            metrics.append(metric)
+        thresholds = self.threshold.find_best_thresholds(
+            metrics, self.gold_answers, self.answers
+        )
+        for metric, threshold in zip(metrics, thresholds):
+            self.assertEqual(
+                threshold,
+                self.threshold.find_best_threshold(
+                    metric, self.gold_answers, self.answers
+                )
+            )
+            if metric.has_counts:
+                expected, _ = self.brute_best(
+                    metric, self.gold_answers, self.answers
+                )
+                self.assertEqual(threshold, expected)
+        self.assertEqual(metrics[-1].name, 'utility_function_0.2_-0.5_1')
+        self.assertGreater(len(set(thresholds[3:])), 1)
+
+
+class TestCrossValidate(ThresholdTestCase):
+
+    def folds(self, nof_folds):
+        folds = np.zeros(len(self.gold_answers), dtype=np.int64)
+        for fold, (_, test_indices) in enumerate(self.dataset.iter_folds(
+            self.gold_answers, nof_folds, seed=0, group_by_context=True
+        )):
+            folds[test_indices] = fold
+        return folds
+
+    def test_against_brute_force(self):
+        folds = self.folds(4)
+        metric = C_at_1()
+        results = self.threshold.cross_validate(
+            metric, self.gold_answers, self.answers, folds, nof_folds=4
+        )
+        for fold in range(4):
+            train_gold, train_answers = self.subset(
+                np.flatnonzero(folds != fold)
+            )
+            best, train_value = self.brute_best(
+                metric, train_gold, train_answers
+            )
+            test_gold, test_answers = self.subset(
+                np.flatnonzero(folds == fold)
+            )
+            apply_threshold_to_answers(test_answers, best)
+            self.assertEqual(results['thresholds'][fold], best)
+            self.assertAlmostEqual(results['C_at_1_train'][fold], train_value)
+            self.assertAlmostEqual(
+                results['C_at_1_folds'][fold],
+                metric(test_gold, test_answers).value
+            )
+            apply_threshold_to_answers(test_answers, 0.0)
+        self.assertAlmostEqual(
+            results['C_at_1'], np.mean(results['C_at_1_folds'])
+        )
+
+    def test_too_many_folds(self):
+        # 12 contexts, 60 questions
+        with self.assertRaises(ValueError):
+            list(self.dataset.iter_folds(
+                self.gold_answers, 13, group_by_context=True
+            ))
+        self.assertEqual(
+            len(list(self.dataset.iter_folds(self.gold_answers, 13))), 13
+        )
+
+    def test_empty_folds(self):
+        folds = self.folds(3)
+        for bad_folds, nof_folds in (
+            (folds, 4),
+            (np.where(folds == 1, 2, folds), None),
+            (np.zeros_like(folds), None),
+        ):
+            with self.assertRaises(ValueError):
+                self.threshold.cross_validate(
+                    C_at_1(), self.gold_answers, self.answers, bad_folds,
+                    nof_folds=nof_folds,
+                )
+
+    def test_cli_too_many_folds(self):
+        flags = [
+            'mcqa_utils', '-d', self.data_dir, '-T', 'generic', '-n',
+            self.nbest, '--no_cache', '-m', 'C_at_1', '--threshold_cv', '20',
+        ]
+        with mock.patch.object(sys, 'argv', flags):
+            args = mcqa_utils.parse_flags()
+        with self.assertRaisesRegex(ValueError, '20 folds'):
+            mcqa_utils.mcqa(args)
+
+
+class TestThresholdSketch(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.confidences = rng.beta(2, 2, 500)
+        self.confidences[:10] = np.inf
+        self.confidences[10:15] = -np.inf
+        self.correct = rng.random(500) < self.confidences
+        self.unanswered_correct = rng.random(500) < 0.3
+        self.outcomes = (
+            self.confidences, self.correct, self.unanswered_correct
+        )
+        self.metric = C_at_1()
+
+    def value_at(self, threshold):
+        return self.metric.value_from_counts(*brute_counts(
+            *self.outcomes, threshold, np.ones(500, dtype=bool)
+        ))
+
+    def exact_best(self):
+        finite = self.confidences[np.isfinite(self.confidences)]
+        return max(self.value_at(value) for value in np.append(finite, 0.0))
+
+    def test_error_bound(self):
+        exact = self.exact_best()
+        for nof_bins in (1, 8, 64):
+            sketch = ThresholdSketch(0.0, 1.0, nof_bins).update(
+                *self.outcomes
+            )
+            self.assertEqual(len(sketch), 500)
+            best = sketch.best_threshold(self.metric)
+            self.assertAlmostEqual(
+                best['value'], self.value_at(best['threshold'])
+            )
+            self.assertLessEqual(best['value'], exact + 1e-12)
+            self.assertLessEqual(
+                exact - best['value'], best['error_bound'] + 1e-12
+            )
+        with self.assertRaises(ValueError):
+            sketch.best_threshold(Brier())
+
+    def test_merge(self):
+        whole = ThresholdSketch(0.0, 1.0, 32).update(*self.outcomes)
+        merged = ThresholdSketch(0.0, 1.0, 32)
+        for part in np.array_split(np.arange(500), 3):
+            merged.merge(ThresholdSketch(0.0, 1.0, 32).update(
+                *(values[part] for values in self.outcomes)
+            ))
+        np.testing.assert_array_equal(merged.bins, whole.bins)
+        np.testing.assert_array_equal(merged.always, whole.always)
+        np.testing.assert_array_equal(merged.never, whole.never)
+        best, other = (
+            sketch.best_threshold(self.metric) for sketch in (merged, whole)
+        )
+        np.testing.assert_array_equal(best.pop('bins'), other.pop('bins'))
+        self.assertEqual(best, other)
+        with self.assertRaises(ValueError):
+            whole.merge(ThresholdSketch(0.0, 1.0, 16))
+
+    def test_refine(self):
+        exact = self.exact_best()
+        sketch = ThresholdSketch(0.0, 1.0, 16).update(*self.outcomes)
+        chunks = [
+            tuple(values[part] for values in self.outcomes)
+            for part in np.array_split(np.arange(500), 4)
+        ]
+        best = sketch.refine(self.metric, chunks)
+        self.assertEqual(best['error_bound'], 0.0)
+        self.assertAlmostEqual(best['value'], exact)
+        self.assertAlmostEqual(self.value_at(best['threshold']), exact)
+
+
+class TestSketchThreshold(ThresholdTestCase):
+
+    def test_matches_exact_search(self):
+        metric = C_at_1()
+        exact = self.threshold.find_best_threshold(
+            metric, self.gold_answers, self.answers
+        )
+        _, exact_value = self.brute_best(
+            metric, self.gold_answers, self.answers
+        )
+        for refine in (False, True):
+            best = self.threshold.sketch_best_threshold(
+                metric, self.gold_answers, self.answers, nof_bins=4,
+                refine=refine,
+            )
+            self.assertLessEqual(
+                exact_value - best['value'], best['error_bound'] + 1e-12
+            )
+        self.assertAlmostEqual(best['value'], exact_value)
+        self.assertLessEqual(best['threshold'], exact)
+
+
+class TestRiskCoverage(ThresholdTestCase):
+
+    def test_against_brute_force(self):
+        report, curve = risk_coverage(
+            self.gold_answers, self.answers, target_coverages=(0.5, 0.9, 1.1)
+        )
+        confidences = np.array([ans.get_max_prob() for ans in self.answers])
+        thresholds = np.unique(np.append(confidences, 0.0))[::-1]
+        np.testing.assert_array_equal(curve['threshold'], thresholds)
+        metric = C_at_1()
+        aurc, previous = 0.0, 0
+        for index, threshold in enumerate(thresholds):
+            apply_threshold_to_answers(self.answers, threshold)
+            answered = [
+                ans.get_answer() != ans.no_answer for ans in self.answers
+            ]
+            correct = [
+                ans.get_answer() == gold.get_answer()
+                for gold, ans in zip(self.gold_answers, self.answers)
+            ]
+            nof_answered = sum(answered)
+            accuracy = sum(correct) / nof_answered if nof_answered else 1.0
+            self.assertAlmostEqual(
+                curve['coverage'][index], nof_answered / len(self.answers)
+            )
+            self.assertAlmostEqual(
+                curve['selective_accuracy'][index], accuracy
+            )
+            self.assertAlmostEqual(
+                curve['C_at_1'][index],
+                metric(self.gold_answers, self.answers).value
+            )
+            aurc += (nof_answered - previous) * (1 - accuracy)
+            previous = nof_answered
+        apply_threshold_to_answers(self.answers, 0.0)
+        self.assertAlmostEqual(report['aurc'], aurc / len(self.answers))
+
+        for target in (0.5, 0.9):
+            reached = np.flatnonzero(curve['coverage'] >= target)[0]
+            self.assertEqual(
+                report['coverage_targets'][str(target)]['threshold'],
+                thresholds[reached]
+            )
+            if reached > 0:
+                self.assertLess(curve['coverage'][reached - 1], target)
+        self.assertIsNone(report['coverage_targets']['1.1'])
+        self.assertEqual(report['curve']['coverage'][-1], 1.0)
+
+    def test_write_curve(self):
+        _, curve = risk_coverage(self.gold_answers, self.answers)
+        path = os.path.join(self.tmp_dir.name, 'curve.csv')
+        write_curve(path, curve)
+        with open(path, newline='') as fin:
+            rows = list(csv.DictReader(fin))
+        self.assertEqual(len(rows), len(curve['threshold']))
+        for name, values in curve.items():
+            np.testing.assert_allclose(
+                [float(row[name]) for row in rows], values
+            )
+
+
+class TestGroupThresholds(ThresholdTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # context parity, the first question of context 1 on its own
+        id_codec = self.dataset.id_codec
+        self.groups = {
+            f'ctx{context}': ('even', 'odd')[context % 2]
+            for context in range(12)
+        }
+        self.groups['ctx1-00'] = 'alone'
+        self.keys = [
+            'alone' if id_codec.to_str(gold.example_id) == 'ctx1-00'
+            else self.groups[id_codec.context_name(gold.example_id)]
+            for gold in self.gold_answers
+        ]
+
+    def test_against_brute_force(self):
+        metrics = [C_at_1(), Average(), Brier()]
+        names, codes, thresholds = self.threshold.find_group_thresholds(
+            metrics, self.gold_answers, self.answers, self.keys
+        )
+        self.assertEqual(names, ['alone', 'even', 'odd'])
+        self.assertEqual([names[code] for code in codes], self.keys)
+        for row, metric in enumerate(metrics):
+            for group, name in enumerate(names):
+                gold_answers, answers = self.subset(
+                    np.flatnonzero(codes == group)
+                )
+                if metric.has_counts:
+                    expected, _ = self.brute_best(
+                        metric, gold_answers, answers
+                    )
+                else:
+                    expected = self.threshold.find_best_threshold(
+                        metric, gold_answers, answers
+                    )
+                self.assertEqual(thresholds[row, group], expected)
+
+    def test_apply_per_answer(self):
+        per_answer = np.linspace(0.1, 0.9, len(self.answers))
+        apply_threshold_to_answers(self.answers, per_answer)
+        self.assertEqual(
+            [ans.threshold for ans in self.answers], per_answer.tolist()
+        )
+        apply_threshold_to_answers(self.answers, 0.3)
+        self.assertEqual(set(ans.threshold for ans in self.answers), {0.3})
+
+    def run_mcqa(self, *flags):
+        output = os.path.join(self.data_dir, 'results.json')
+        argv = [
+            'mcqa_utils', '-d', self.data_dir, '-T', 'generic', '-n',
+            self.nbest, '--no_cache', '-m', 'C_at_1', 'avg', '-o', output,
+            '--overwrite',
+        ] + list(flags)
+        with mock.patch.object(sys, 'argv', argv):
+            mcqa_utils.mcqa(mcqa_utils.parse_flags())
+        with open(output) as fin:
+            return json.load(fin)
+
+    def test_cli(self):
+        path = os.path.join(self.data_dir, 'groups.json')
+        with open(path, 'w') as fout:
+            json.dump(self.groups, fout)
+        results = self.run_mcqa('--group_threshold', path)
+        metric = C_at_1()
+        group_results = results['C_at_1_group_threshold']
+        for name, threshold in group_results['thresholds'].items():
+            gold_answers, answers = self.subset([
+                index for index, key in enumerate(self.keys) if key == name
+            ])
+            expected, _ = self.brute_best(metric, gold_answers, answers)
+            self.assertEqual(threshold, expected)
+        # every answer under its group threshold
+        apply_threshold_to_answers(self.answers, [
+            group_results['thresholds'][key] for key in self.keys
+        ])
+        self.assertAlmostEqual(
+            group_results['C_at_1'],
+            metric(self.gold_answers, self.answers).value
+        )
+
+        del self.groups['ctx3']
+        with open(path, 'w') as fout:
+            json.dump(self.groups, fout)
+        with self.assertRaisesRegex(ValueError, '5 questions'):
+            self.run_mcqa('--group_threshold', path)
+        with self.assertRaises(ValueError):
+            self.run_mcqa('--group_threshold', 'has_ans')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""Tests for `mcqa_utils.watch`."""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from mcqa_utils import mcqa_utils
+from mcqa_utils.watch import PredictionsWatcher
+
+from tests.helpers import make_dataset, make_nbest, write_json
+
+
+class TestPredictionsWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.tmp_dir.name
+        self.watcher = PredictionsWatcher(
+            self.directory, 'nbest*.json', use_events=False
+        )
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmp_dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fout:
+            fout.write(content)
+        return path
+
+    def test_stable_files(self):
+        path = self.write('checkpoint-1/nbest.json', '{}')
+        self.write('checkpoint-1/other.json', '{}')
+        # reported once size and mtime did not change between two checks
+        self.assertEqual(self.watcher.changes(), [])
+        self.assertEqual(self.watcher.changes(), [path])
+        self.assertEqual(self.watcher.changes(), [])
+        self.write('checkpoint-1/nbest.json', '{"ctx0": []}')
+        self.watcher.changes()
+        self.assertEqual(self.watcher.changes(), [path])
+
+    def test_growing_files(self):
+        path = self.write('nbest.json', '{')
+        self.watcher.changes()
+        with open(path, 'a') as fout:
+            fout.write('"ctx0": []')
+        self.assertEqual(self.watcher.changes(), [])
+        self.assertEqual(self.watcher.changes(), [path])
+
+    def test_removed_files(self):
+        path = self.write('nbest.json', '{}')
+        self.watcher.changes()
+        os.remove(path)
+        self.assertEqual(self.watcher.changes(), [])
+        self.assertEqual(self.watcher._pending, {})
+
+
+class TestWatchPredictions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmp_dir.name, 'data')
+        self.watch_dir = os.path.join(self.tmp_dir.name, 'runs')
+        self.output = os.path.join(self.tmp_dir.name, 'results.jsonl')
+        data = make_dataset(self.data_dir)
+        for step in range(2):
+            checkpoint = os.path.join(self.watch_dir, f'checkpoint-{step}')
+            os.makedirs(checkpoint)
+            write_json(
+                make_nbest(data, seed=step),
+                os.path.join(checkpoint, 'nbest_predictions.json')
+            )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def watch(self):
+        argv = [
+            'mcqa_utils', '-d', self.data_dir, '-T', 'generic', '-m', 'avg',
+            '--watch', self.watch_dir, '--watch_interval', '0.01',
+            '--watch_timeout', '0.1', '-o', self.output,
+        ]
+        with mock.patch.object(sys, 'argv', argv):
+            mcqa_utils.mcqa_watch(mcqa_utils.parse_flags())
+        with open(self.output) as fin:
+            return [json.loads(line) for line in fin]
+
+    def test_watch(self):
+        records = self.watch()
+        self.assertEqual(
+            sorted(os.path.basename(os.path.dirname(record['predictions']))
+                   for record in records),
+            ['checkpoint-0', 'checkpoint-1']
+        )
+        self.assertTrue(all('avg' in record['results'] for record in records))
+        # already evaluated contents are skipped, even under a new name
+        shutil.copy(
+            os.path.join(
+                self.watch_dir, 'checkpoint-0', 'nbest_predictions.json'
+            ),
+            os.path.join(self.watch_dir, 'nbest_predictions.json'),
+        )
+        self.assertEqual(len(self.watch()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()